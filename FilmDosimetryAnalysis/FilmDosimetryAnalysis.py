@@ -56,6 +56,52 @@ class SliceletMainFrame(qt.QDialog):
     self.slicelet = None
     self.deleteLater()
 
+#
+# CalibrationFilmItemDelegate
+#   Film selector of the calibration films table. The node combobox is created only for the cell being edited,
+#   the table itself stores the selected node ID (user role) and name (display role)
+#
+class CalibrationFilmItemDelegate(qt.QStyledItemDelegate):
+  def createEditor(self, parent, option, index):
+    nodeSelector = slicer.qMRMLNodeComboBox(parent)
+    nodeSelector.nodeTypes = ["vtkMRMLScalarVolumeNode"]
+    nodeSelector.addEnabled = False
+    nodeSelector.removeEnabled = False
+    nodeSelector.noneEnabled = True
+    nodeSelector.setMRMLScene(slicer.mrmlScene)
+    nodeSelector.setToolTip("Choose the film image corresponding to the dose on the left")
+    # Commit selection immediately, not only when the editor loses focus
+    nodeSelector.connect('currentNodeChanged(vtkMRMLNode*)', lambda node, editor=nodeSelector: self.commitData(editor))
+    return nodeSelector
+
+  def setEditorData(self, editor, index):
+    editor.blockSignals(True)
+    editor.setCurrentNodeID(index.data(qt.Qt.UserRole) or '')
+    editor.blockSignals(False)
+
+  def setModelData(self, editor, model, index):
+    node = editor.currentNode()
+    model.setData(index, node.GetID() if node is not None else '', qt.Qt.UserRole)
+    model.setData(index, node.GetName() if node is not None else '', qt.Qt.DisplayRole)
+
+#
+# CalibrationDoseItemDelegate
+#   Dose editor of the calibration films table, limited to the valid range of calibration doses
+#
+class CalibrationDoseItemDelegate(qt.QStyledItemDelegate):
+  def createEditor(self, parent, option, index):
+    doseSpinBox = qt.QSpinBox(parent)
+    doseSpinBox.minimum = 0
+    doseSpinBox.maximum = 10000
+    return doseSpinBox
+
+  def setEditorData(self, editor, index):
+    editor.value = int(index.data(qt.Qt.EditRole) or 0)
+
+  def setModelData(self, editor, model, index):
+    editor.interpretText()
+    model.setData(index, editor.value, qt.Qt.EditRole)
+
 #
 # FilmDosimetryAnalysisSlicelet
 #
@@ -112,15 +158,17 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     # Declare member variables (selected at certain steps and then from then on for the workflow)
     self.lastAddedFolder = 0
     self.opticalDensityCurve = None
-
-    # Constants
-    self.maxNumberOfCalibrationFilms = 10
+    self.step4_registrationProgressDialog = None
+    self.step4_observedFilmToDoseSliceTransformNode = None
+    self.observedCalibrationRoiNode = None
 
     # Set observations
     shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
     self.addObserver(shNode, slicer.vtkMRMLSubjectHierarchyNode.SubjectHierarchyItemAddedEvent, self.onSubjectHierarchyItemAdded)
     self.addObserver(shNode, slicer.vtkMRMLSubjectHierarchyNode.SubjectHierarchyEndResolveEvent, self.onSubjectHierarchyResolveEnded)
     self.addObserver(slicer.mrmlScene, slicer.vtkMRMLScene.NodeAddedEvent, self.onNodeAdded)
+    self.addObserver(slicer.mrmlScene, slicer.vtkMRMLScene.NodeRemovedEvent, self.onNodeRemoved)
+    self.addObserver(slicer.mrmlScene, slicer.vtkMRMLScene.EndCloseEvent, self.onSceneEndClose)
 
     # Turn on slice intersections in 2D viewers
     compositeNodes = slicer.util.getNodes("vtkMRMLSliceCompositeNode*")
@@ -161,6 +209,8 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
   #------------------------------------------------------------------------------
   # Disconnect all connections made to the slicelet to enable the garbage collector to destruct the slicelet object on quit
   def disconnect(self):
+    # Stop registration running in the background, its result must not be applied to the closed slicelet
+    self.logic.cancelFilmToPlanDoseRegistration(notifyCaller=False)
     self.selfTestButton.disconnect('clicked()', self.onSelfTestButtonClicked)
     self.step0_viewSelectorComboBox.disconnect('currentIndexChanged(int)', self.onViewSelect)
     self.step1_loadImageFilesButton.disconnect('clicked()', self.onLoadImageFilesButton)
@@ -193,6 +243,11 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     self.step4_rotateCwAction_5Degrees.disconnect('triggered()', self.onStep4_RotateCw5)
     self.step4_flipHorizontalButton.disconnect('clicked()', self.onStep4_FlipHorizontal)
     self.step4_flipVerticalButton.disconnect('clicked()', self.onStep4_FlipVertical)
+    self.step4_findOrientationButton.disconnect('clicked()', self.onStep4_FindOrientation)
+    self.step4_useNativeFilmRegistrationCheckBox.disconnect('toggled(bool)', self.onStep4_UseNativeFilmRegistrationToggled)
+    self.step4_alignmentMetricUpdateTimer.disconnect('timeout()', self.updateStep4_AlignmentMetric)
+    self.step4_alignmentMetricUpdateTimer.stop()
+    self.observeStep4_FilmToDoseSliceTransform(None)
     self.step4_translationSliders.disconnect('valuesChanged()', self.step4_rotationSliders.resetUnactiveSliders)
     self.step5_doseComparisonCollapsibleButton.disconnect('contentsCollapsed(bool)', self.onStep5_DoseComparisonCollapsed)
     self.step5_maskSegmentationSelector.disconnect('currentNodeChanged(vtkMRMLNode*)', self.onStep5_MaskSegmentationSelectionChanged)
@@ -211,6 +266,11 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     self.removeObserver(shNode, slicer.vtkMRMLSubjectHierarchyNode.SubjectHierarchyItemAddedEvent, self.onSubjectHierarchyItemAdded)
     self.removeObserver(shNode, slicer.vtkMRMLSubjectHierarchyNode.SubjectHierarchyEndResolveEvent, self.onSubjectHierarchyResolveEnded)
     self.removeObserver(slicer.mrmlScene, slicer.vtkMRMLScene.NodeAddedEvent, self.onNodeAdded)
+    self.removeObserver(slicer.mrmlScene, slicer.vtkMRMLScene.NodeRemovedEvent, self.onNodeRemoved)
+    self.removeObserver(slicer.mrmlScene, slicer.vtkMRMLScene.EndCloseEvent, self.onSceneEndClose)
+    if self.observedCalibrationRoiNode is not None:
+      self.removeObserver(self.observedCalibrationRoiNode, vtk.vtkCommand.ModifiedEvent, self.onCalibrationRoiModified)
+      self.observedCalibrationRoiNode = None
 
   #------------------------------------------------------------------------------
   def setup_Step0_LayoutSelection(self):
@@ -303,7 +363,7 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     self.step1_numberOfCalibrationFilmsSpinBox = qt.QSpinBox()
     self.step1_numberOfCalibrationFilmsSpinBox.value = 5
     self.step1_numberOfCalibrationFilmsSpinBox.minimum = 1
-    self.step1_numberOfCalibrationFilmsSpinBox.maximum = 10
+    self.step1_numberOfCalibrationFilmsSpinBox.maximum = 1000
     self.step1_numberOfCalibrationFilmsSpinBox.enabled = True
     self.step1_numberOfCalibrationFilmsLabelBefore = qt.QLabel('Number of calibration films: ')
     self.step1_numberOfCalibrationFilmsSelectorLayout.addWidget(self.step1_numberOfCalibrationFilmsLabelBefore)
@@ -328,41 +388,21 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     self.step1_1_middleCalibrationSubLayout = qt.QVBoxLayout()
     self.step1_1_loadCalibrationDataLayout.addLayout(self.step1_1_middleCalibrationSubLayout)
 
-    self.step1_calibrationVolumeLayoutList = []
-    self.step1_calibrationVolumeSelectorLabelBeforeList = []
-    self.step1_calibrationVolumeSelectorCGySpinBoxList = []
-    self.step1_calibrationVolumeSelectorCGyLabelList = []
-    self.step1_calibrationVolumeSelectorComboBoxList = []
-
-    # Create calibration films table
-    for doseToImageLayoutNumber in range(self.maxNumberOfCalibrationFilms):
-      self.step1_doseToImageSelectorRowLayout = qt.QHBoxLayout()
-      self.step1_mainCalibrationVolumeSelectorLabelBefore = qt.QLabel('Calibration ')
-      self.step1_calibrationVolumeSelectorLabelBeforeList.append(self.step1_mainCalibrationVolumeSelectorLabelBefore)
-
-      self.doseToImageSelectorCGySpinBox = qt.QSpinBox()
-      self.doseToImageSelectorCGySpinBox.minimum = 0
-      self.doseToImageSelectorCGySpinBox.maximum = 10000
-      self.step1_calibrationVolumeSelectorCGySpinBoxList.append(self.doseToImageSelectorCGySpinBox)
-
-      self.doseToImageSelectorLabelMiddle = qt.QLabel(' cGy : ')
-      self.step1_calibrationVolumeSelectorCGyLabelList.append(self.doseToImageSelectorLabelMiddle)
-
-      self.doseToImageFilmSelector = slicer.qMRMLNodeComboBox()
-      self.doseToImageFilmSelector.nodeTypes = ["vtkMRMLScalarVolumeNode"]
-      self.doseToImageFilmSelector.addEnabled = False
-      self.doseToImageFilmSelector.removeEnabled = False
-      self.doseToImageFilmSelector.setMRMLScene( slicer.mrmlScene )
-      self.doseToImageFilmSelector.setToolTip("Choose the film image corresponding to the dose on the left")
-      self.step1_calibrationVolumeSelectorComboBoxList.append(self.doseToImageFilmSelector)
-
-      self.step1_doseToImageSelectorRowLayout.addWidget(self.step1_mainCalibrationVolumeSelectorLabelBefore)
-      self.step1_doseToImageSelectorRowLayout.addWidget(self.doseToImageSelectorCGySpinBox)
-      self.step1_doseToImageSelectorRowLayout.addWidget(self.doseToImageSelectorLabelMiddle)
-      self.step1_doseToImageSelectorRowLayout.addWidget(self.doseToImageFilmSelector)
-
-      self.step1_calibrationVolumeLayoutList.append(self.step1_doseToImageSelectorRowLayout)
-      self.step1_1_middleCalibrationSubLayout.addLayout(self.step1_doseToImageSelectorRowLayout)
+    # Create calibration films table. Rows are created when the number of films is increased, and the film
+    # selector of a row is only created while that cell is being edited
+    self.step1_calibrationFilmsTable = qt.QTableWidget(0, 2)
+    self.step1_calibrationFilmsTable.setHorizontalHeaderLabels(['Dose (cGy)', 'Calibration film'])
+    self.step1_calibrationFilmsTable.horizontalHeader().setStretchLastSection(True)
+    self.step1_calibrationFilmsTable.verticalHeader().setVisible(False)
+    self.step1_calibrationFilmsTable.setEditTriggers(qt.QAbstractItemView.AllEditTriggers)
+    self.step1_calibrationFilmsTable.setSelectionMode(qt.QAbstractItemView.SingleSelection)
+    self.step1_calibrationFilmsTable.minimumHeight = 160
+    self.step1_calibrationFilmsTable.toolTip = "Enter the dose and choose the film image for each calibration film"
+    self.step1_calibrationDoseItemDelegate = CalibrationDoseItemDelegate(self.step1_calibrationFilmsTable)
+    self.step1_calibrationFilmsTable.setItemDelegateForColumn(0, self.step1_calibrationDoseItemDelegate)
+    self.step1_calibrationFilmItemDelegate = CalibrationFilmItemDelegate(self.step1_calibrationFilmsTable)
+    self.step1_calibrationFilmsTable.setItemDelegateForColumn(1, self.step1_calibrationFilmItemDelegate)
+    self.step1_1_middleCalibrationSubLayout.addWidget(self.step1_calibrationFilmsTable)
 
     #
     # Step 1.1 bottom sub-layout (the calibration films table needs to be updated within its own layout)
@@ -393,6 +433,63 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     self.step1_addRoiButton.toolTip = "Add ROI (region of interest) that is considered when measuring dose in the calibration images\n\nOnce activated, click in the center of the region to be used for calibration, then do another click to one of the corners. After that the ROI appears and can be adjusted using the colored handles."
     self.step1_2_performCalibrationLayout.addWidget(self.step1_addRoiButton)
 
+    # Live ROI statistics label (updated while the ROI is being adjusted)
+    self.step1_liveRoiStatisticsLabel = qt.QLabel('')
+    self.step1_liveRoiStatisticsLabel.toolTip = "Mean pixel value, standard deviation, and optical density of each film in the calibration ROI"
+    self.step1_2_performCalibrationLayout.addWidget(self.step1_liveRoiStatisticsLabel)
+
+    # Automatic uniform region detection
+    self.step1_automaticRoiCheckBox = qt.QCheckBox('Detect uniform region on each film automatically')
+    self.step1_automaticRoiCheckBox.toolTip = "Find the largest uniform region on each film (avoiding film edges and pen marks) and use it instead of the ROI.\nIf an ROI has been added, then the search is limited to the ROI"
+    self.step1_2_performCalibrationLayout.addWidget(self.step1_automaticRoiCheckBox)
+
+    # Calibration function exponent search range and tolerance
+    self.step1_calibrationExponentLayout = qt.QHBoxLayout()
+    self.step1_calibrationExponentMinimumSpinBox = qt.QDoubleSpinBox()
+    self.step1_calibrationExponentMinimumSpinBox.decimals = 3
+    self.step1_calibrationExponentMinimumSpinBox.minimum = 0.1
+    self.step1_calibrationExponentMinimumSpinBox.maximum = 10.0
+    self.step1_calibrationExponentMinimumSpinBox.singleStep = 0.1
+    self.step1_calibrationExponentMinimumSpinBox.value = self.logic.calibrationExponentBounds[0]
+    self.step1_calibrationExponentMaximumSpinBox = qt.QDoubleSpinBox()
+    self.step1_calibrationExponentMaximumSpinBox.decimals = 3
+    self.step1_calibrationExponentMaximumSpinBox.minimum = 0.1
+    self.step1_calibrationExponentMaximumSpinBox.maximum = 10.0
+    self.step1_calibrationExponentMaximumSpinBox.singleStep = 0.1
+    self.step1_calibrationExponentMaximumSpinBox.value = self.logic.calibrationExponentBounds[1]
+    self.step1_calibrationExponentToleranceSpinBox = qt.QDoubleSpinBox()
+    self.step1_calibrationExponentToleranceSpinBox.decimals = 6
+    self.step1_calibrationExponentToleranceSpinBox.minimum = 0.000001
+    self.step1_calibrationExponentToleranceSpinBox.maximum = 0.1
+    self.step1_calibrationExponentToleranceSpinBox.singleStep = 0.0001
+    self.step1_calibrationExponentToleranceSpinBox.value = self.logic.calibrationExponentTolerance
+    self.step1_calibrationExponentToleranceSpinBox.toolTip = "Absolute tolerance of the exponent N in the calibration function"
+    self.step1_calibrationExponentLayout.addWidget(qt.QLabel('Exponent range: '))
+    self.step1_calibrationExponentLayout.addWidget(self.step1_calibrationExponentMinimumSpinBox)
+    self.step1_calibrationExponentLayout.addWidget(qt.QLabel(' - '))
+    self.step1_calibrationExponentLayout.addWidget(self.step1_calibrationExponentMaximumSpinBox)
+    self.step1_calibrationExponentLayout.addWidget(qt.QLabel(', tolerance: '))
+    self.step1_calibrationExponentLayout.addWidget(self.step1_calibrationExponentToleranceSpinBox)
+    self.step1_2_performCalibrationLayout.addLayout(self.step1_calibrationExponentLayout)
+
+    # Calibration model selection
+    self.step1_calibrationModelLayout = qt.QHBoxLayout()
+    self.step1_calibrationModelComboBox = qt.QComboBox()
+    self.step1_calibrationModelComboBox.addItem(self.logic.automaticCalibrationModelSelection)
+    for calibrationModelName in getCalibrationModelNames():
+      self.step1_calibrationModelComboBox.addItem(calibrationModelName)
+    self.step1_calibrationModelComboBox.setCurrentIndex(self.step1_calibrationModelComboBox.findText(self.logic.calibrationModelSelection))
+    self.step1_calibrationModelComboBox.toolTip = "Calibration function model. All models are fitted and compared, the selected one (or the best ranked one if automatic) is used"
+    self.step1_calibrationModelSelectionCriterionComboBox = qt.QComboBox()
+    self.step1_calibrationModelSelectionCriterionComboBox.addItem('AIC', 'AIC')
+    self.step1_calibrationModelSelectionCriterionComboBox.addItem('Cross-validation', 'CrossValidation')
+    self.step1_calibrationModelSelectionCriterionComboBox.toolTip = "Ranking of the calibration models by Akaike information criterion or by leave-one-out cross-validated dose error"
+    self.step1_calibrationModelLayout.addWidget(qt.QLabel('Calibration model: '))
+    self.step1_calibrationModelLayout.addWidget(self.step1_calibrationModelComboBox)
+    self.step1_calibrationModelLayout.addWidget(qt.QLabel(', ranked by: '))
+    self.step1_calibrationModelLayout.addWidget(self.step1_calibrationModelSelectionCriterionComboBox)
+    self.step1_2_performCalibrationLayout.addLayout(self.step1_calibrationModelLayout)
+
     # Calibration button
     self.step1_performCalibrationButton = qt.QPushButton("Perform calibration")
     self.step1_performCalibrationButton.toolTip = "Finds the calibration function"
@@ -424,7 +521,7 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
 
     self.step1_1_loadCalibrationDataCollapsibleButton.setProperty('collapsed', False)
 
-    # Update calibration films table to set row visibilities
+    # Create initial rows in calibration films table
     self.setNumberOfCalibrationFilmsInTable(self.step1_numberOfCalibrationFilmsSpinBox.value)
 
     # Connections
@@ -585,9 +682,47 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     self.step3_calibrationFunctionLayout.addWidget(self.step3_calibrationFunctionExponentLineEdit,1,3)
     self.step3_applyCalibrationCollapsibleButtonLayout.addLayout(self.step3_calibrationFunctionLayout)
 
+    # Calibration function of other than the power model (which is shown in the input fields)
+    self.step3_calibrationModelLabel = qt.QLabel('')
+    self.step3_calibrationModelLabel.visible = False
+    self.step3_applyCalibrationCollapsibleButtonLayout.addWidget(self.step3_calibrationModelLabel)
+
     # Add empty row
     self.step3_applyCalibrationCollapsibleButtonLayout.addWidget(qt.QLabel(''))
 
+    # Flood field normalization by mean value (lookup table conversion)
+    self.step3_useFloodFieldMeanValueCheckBox = qt.QCheckBox('Normalize with mean flood field value')
+    self.step3_useFloodFieldMeanValueCheckBox.toolTip = "Use the mean of the experimental flood field image instead of its pixel values (as in calibration).\nThen 8 and 16 bit integer films are converted to dose using a lookup table, which is much faster"
+    self.step3_applyCalibrationCollapsibleButtonLayout.addWidget(self.step3_useFloodFieldMeanValueCheckBox)
+
+    # Streaming conversion of large films
+    self.step3_doseConversionTileLayout = qt.QHBoxLayout()
+    self.step3_doseConversionTileNumberOfRowsSpinBox = qt.QSpinBox()
+    self.step3_doseConversionTileNumberOfRowsSpinBox.minimum = 0
+    self.step3_doseConversionTileNumberOfRowsSpinBox.maximum = 100000
+    self.step3_doseConversionTileNumberOfRowsSpinBox.singleStep = 64
+    self.step3_doseConversionTileNumberOfRowsSpinBox.value = self.logic.doseConversionTileNumberOfRows
+    self.step3_doseConversionTileNumberOfRowsSpinBox.specialValueText = 'Whole film'
+    self.step3_doseConversionTileNumberOfRowsSpinBox.toolTip = "Number of film rows converted at a time. Limits the memory needed for very large scans"
+    self.step3_memoryMappedDoseBufferCheckBox = qt.QCheckBox('Store dose in temporary file')
+    self.step3_memoryMappedDoseBufferCheckBox.toolTip = "Write the calculated dose into a memory-mapped temporary file instead of memory"
+    self.step3_doseConversionTileLayout.addWidget(qt.QLabel('Rows per tile: '))
+    self.step3_doseConversionTileLayout.addWidget(self.step3_doseConversionTileNumberOfRowsSpinBox)
+    self.step3_doseConversionTileLayout.addWidget(self.step3_memoryMappedDoseBufferCheckBox)
+    self.step3_numberOfDoseConversionThreadsSpinBox = qt.QSpinBox()
+    self.step3_numberOfDoseConversionThreadsSpinBox.minimum = 1
+    self.step3_numberOfDoseConversionThreadsSpinBox.maximum = 256
+    self.step3_numberOfDoseConversionThreadsSpinBox.value = self.logic.numberOfDoseConversionThreads
+    self.step3_numberOfDoseConversionThreadsSpinBox.toolTip = "Number of threads converting the film to dose in parallel"
+    self.step3_doseConversionTileLayout.addWidget(qt.QLabel(' Threads: '))
+    self.step3_doseConversionTileLayout.addWidget(self.step3_numberOfDoseConversionThreadsSpinBox)
+    self.step3_applyCalibrationCollapsibleButtonLayout.addLayout(self.step3_doseConversionTileLayout)
+
+    # Single precision pipeline
+    self.step3_useSinglePrecisionPipelineCheckBox = qt.QCheckBox('Single precision (float32) dose')
+    self.step3_useSinglePrecisionPipelineCheckBox.toolTip = "Store the calibrated film, the volumes prepared for registration and the dose slice in single precision.\nHalves memory use. The dose error against double precision is checked on a subset of film rows and logged"
+    self.step3_applyCalibrationCollapsibleButtonLayout.addWidget(self.step3_useSinglePrecisionPipelineCheckBox)
+
     # Apply calibration button
     self.step3_applyCalibrationButton = qt.QPushButton("Apply calibration on experimental film")
     self.step3_applyCalibrationButton.toolTip = "Apply calibration to experimental film."
@@ -680,6 +815,11 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     self.step4_scanSetupAlignmentLayout.addWidget(self.step4_flipHorizontalButton,1,2)
     self.step4_scanSetupAlignmentLayout.addWidget(self.step4_flipVerticalButton,1,3)
 
+    # Automatic orientation search
+    self.step4_findOrientationButton = qt.QPushButton('Find orientation automatically')
+    self.step4_findOrientationButton.toolTip = 'Find the flip and rotation of the film that best matches the plan dose slice, and apply it as scan setup alignment'
+    self.step4_scanSetupAlignmentLayout.addWidget(self.step4_findOrientationButton,2,1,1,3)
+
     self.step4_registrationCollapsibleButtonLayout.addLayout(self.step4_scanSetupAlignmentLayout)
 
     # Add empty row
@@ -695,6 +835,17 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     self.step4_performRegistrationButton.toolTip = "Fine-tune film to plan dose slice registration after manual coarse alignment\n "
     self.step4_registrationCollapsibleButtonLayout.addWidget(self.step4_performRegistrationButton)
 
+    # Registration method
+    self.step4_useNativeFilmRegistrationCheckBox = qt.QCheckBox('In-plane (2D) registration')
+    self.step4_useNativeFilmRegistrationCheckBox.checked = self.logic.useNativeFilmRegistration
+    self.step4_useNativeFilmRegistrationCheckBox.toolTip = "Register the film to the dose slice in their plane (rotation and translation) with a multi-resolution search.\nUncheck to use BRAINSFit on the film and dose slice padded to 3D volumes"
+    self.step4_registrationCollapsibleButtonLayout.addWidget(self.step4_useNativeFilmRegistrationCheckBox)
+    self.step4_useMultiStartFilmRegistrationCheckBox = qt.QCheckBox('Multi-start registration')
+    self.step4_useMultiStartFilmRegistrationCheckBox.checked = self.logic.useMultiStartFilmRegistration
+    self.step4_useMultiStartFilmRegistrationCheckBox.enabled = self.logic.useNativeFilmRegistration
+    self.step4_useMultiStartFilmRegistrationCheckBox.toolTip = "Start the in-plane registration from several rotations and translations and keep the best match.\nSlower, but more robust for symmetric dose distributions"
+    self.step4_registrationCollapsibleButtonLayout.addWidget(self.step4_useMultiStartFilmRegistrationCheckBox)
+
     # Add empty row
     self.step4_registrationCollapsibleButtonLayout.addWidget(qt.QLabel(''))
 
@@ -718,6 +869,15 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     self.step4_registrationCollapsibleButtonLayout.addWidget(self.step4_translationSliders)
     self.step4_registrationCollapsibleButtonLayout.addWidget(self.step4_rotationSliders)
 
+    # Live similarity of film and dose slice while adjusting the transform
+    self.step4_alignmentMetricLabel = qt.QLabel('')
+    self.step4_alignmentMetricLabel.toolTip = "Normalized cross correlation (1 is perfect match) and mean absolute dose difference of the film and the plan dose slice, updated while the transform is adjusted"
+    self.step4_registrationCollapsibleButtonLayout.addWidget(self.step4_alignmentMetricLabel)
+    # Updates are throttled so that the sliders stay responsive
+    self.step4_alignmentMetricUpdateTimer = qt.QTimer()
+    self.step4_alignmentMetricUpdateTimer.setSingleShot(True)
+    self.step4_alignmentMetricUpdateTimer.setInterval(50)
+
     self.step4_registrationCollapsibleButtonLayout.addStretch(1)
 
     # Connections
@@ -729,6 +889,9 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     self.step4_rotateCwAction_5Degrees.connect('triggered()', self.onStep4_RotateCw5)
     self.step4_flipHorizontalButton.connect('clicked()', self.onStep4_FlipHorizontal)
     self.step4_flipVerticalButton.connect('clicked()', self.onStep4_FlipVertical)
+    self.step4_findOrientationButton.connect('clicked()', self.onStep4_FindOrientation)
+    self.step4_useNativeFilmRegistrationCheckBox.connect('toggled(bool)', self.onStep4_UseNativeFilmRegistrationToggled)
+    self.step4_alignmentMetricUpdateTimer.connect('timeout()', self.updateStep4_AlignmentMetric)
     self.step4_translationSliders.connect('valuesChanged()', self.step4_rotationSliders.resetUnactiveSliders)
 
   #------------------------------------------------------------------------------
@@ -947,6 +1110,27 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     if addedNode.IsA('vtkMRMLAnnotationROINode'):
       self.logic.lastAddedRoiNode = addedNode
 
+      # Observe ROI to show live statistics while it is adjusted
+      if self.observedCalibrationRoiNode is not None:
+        self.removeObserver(self.observedCalibrationRoiNode, vtk.vtkCommand.ModifiedEvent, self.onCalibrationRoiModified)
+      self.observedCalibrationRoiNode = addedNode
+      self.addObserver(addedNode, vtk.vtkCommand.ModifiedEvent, self.onCalibrationRoiModified)
+
+  #------------------------------------------------------------------------------
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeRemoved(self, caller, event, calldata):
+    removedNode = calldata
+
+    # Free the integral image and flood field log map cached for the removed volume
+    if removedNode.IsA('vtkMRMLScalarVolumeNode'):
+      self.logic.removeCachedVolumeData(removedNode.GetID())
+
+  #------------------------------------------------------------------------------
+  def onSceneEndClose(self, caller, event):
+    # Node IDs are reused in the next scene, so cached volume data must not outlive the scene
+    self.logic.clearIntegralImageCache()
+    self.logic.clearFloodFieldLogarithmCache()
+
   #------------------------------------------------------------------------------
   def onViewSelect(self, layoutIndex):
     if layoutIndex == 0:
@@ -986,37 +1170,62 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
 
   #------------------------------------------------------------------------------
   def setNumberOfCalibrationFilmsInTable(self, numberOfCalibrationFilms):
-    if numberOfCalibrationFilms > self.maxNumberOfCalibrationFilms:
-      message = 'Maximum number of calibration films supported: ' + str(self.maxNumberOfCalibrationFilms) + ', requested: ' + str(numberOfCalibrationFilms)
-      qt.QMessageBox.critical(None, 'Empty directory must be chosen', message)
-      logging.error(message)
-      return
-
-    for row in range(numberOfCalibrationFilms):
-      self.step1_calibrationVolumeSelectorLabelBeforeList[row].visible = True
-      self.step1_calibrationVolumeSelectorCGySpinBoxList[row].visible = True
-      self.step1_calibrationVolumeSelectorCGyLabelList[row].visible = True
-      self.step1_calibrationVolumeSelectorComboBoxList[row].visible = True
-
-    for row in range(numberOfCalibrationFilms, self.maxNumberOfCalibrationFilms):
-      self.step1_calibrationVolumeSelectorLabelBeforeList[row].visible = False
-      self.step1_calibrationVolumeSelectorCGySpinBoxList[row].visible = False
-      self.step1_calibrationVolumeSelectorCGyLabelList[row].visible = False
-      self.step1_calibrationVolumeSelectorComboBoxList[row].visible = False
+    # Only the added rows are populated, existing rows are kept as they are
+    currentNumberOfRows = self.step1_calibrationFilmsTable.rowCount
+    self.step1_calibrationFilmsTable.setRowCount(numberOfCalibrationFilms)
+    for row in range(currentNumberOfRows, numberOfCalibrationFilms):
+      doseItem = qt.QTableWidgetItem()
+      doseItem.setData(qt.Qt.EditRole, 0)
+      self.step1_calibrationFilmsTable.setItem(row, 0, doseItem)
+      filmItem = qt.QTableWidgetItem()
+      filmItem.setData(qt.Qt.UserRole, '')
+      self.step1_calibrationFilmsTable.setItem(row, 1, filmItem)
 
   #------------------------------------------------------------------------------
   def onNumberOfCalibrationFilmsSpinBoxValueChanged(self):
     self.setNumberOfCalibrationFilmsInTable(self.step1_numberOfCalibrationFilmsSpinBox.value)
 
+  #------------------------------------------------------------------------------
+  def setCalibrationFilmInTable(self, row, dose, volumeNode):
+    if row >= self.step1_calibrationFilmsTable.rowCount:
+      self.step1_numberOfCalibrationFilmsSpinBox.value = row + 1
+      self.setNumberOfCalibrationFilmsInTable(row + 1)
+    self.step1_calibrationFilmsTable.item(row, 0).setData(qt.Qt.EditRole, dose)
+    filmItem = self.step1_calibrationFilmsTable.item(row, 1)
+    filmItem.setData(qt.Qt.UserRole, volumeNode.GetID() if volumeNode is not None else '')
+    filmItem.setText(volumeNode.GetName() if volumeNode is not None else '')
+
+  #------------------------------------------------------------------------------
+  def getCalibrationFilmInTable(self, row):
+    currentCalibrationVolumeNodeID = self.step1_calibrationFilmsTable.item(row, 1).data(qt.Qt.UserRole)
+    return slicer.mrmlScene.GetNodeByID(currentCalibrationVolumeNodeID) if currentCalibrationVolumeNodeID else None
+
   #------------------------------------------------------------------------------
   def collectCalibrationFilms(self):
+    """ Map from calibration doses to film volumes. Rows without a selected film are skipped
+        (use checkCalibrationFilmsSelected to report them to the user)
+    """
     calibrationDoseToVolumeNodeMap = OrderedDict()
-    for currentCalibrationVolumeIndex in range(self.step1_numberOfCalibrationFilmsSpinBox.value):
-      currentCalibrationVolumeNode = self.step1_calibrationVolumeSelectorComboBoxList[currentCalibrationVolumeIndex].currentNode()
-      currentCalibrationDose = self.step1_calibrationVolumeSelectorCGySpinBoxList[currentCalibrationVolumeIndex].value
+    for row in range(self.step1_calibrationFilmsTable.rowCount):
+      currentCalibrationVolumeNode = self.getCalibrationFilmInTable(row)
+      if currentCalibrationVolumeNode is None:
+        continue
+      currentCalibrationDose = int(self.step1_calibrationFilmsTable.item(row, 0).data(qt.Qt.EditRole))
       calibrationDoseToVolumeNodeMap[currentCalibrationDose] = currentCalibrationVolumeNode
     return calibrationDoseToVolumeNodeMap
 
+  #------------------------------------------------------------------------------
+  def checkCalibrationFilmsSelected(self, title):
+    """ Show an error and return False if there are rows in the calibration films table without a selected film
+    """
+    rowsWithoutFilm = [row for row in range(self.step1_calibrationFilmsTable.rowCount) if self.getCalibrationFilmInTable(row) is None]
+    if len(rowsWithoutFilm) == 0:
+      return True
+    message = "No film is selected for calibration film " + ", ".join([str(row+1) for row in rowsWithoutFilm]) + ".\n\nSelect the films or decrease the number of calibration films."
+    qt.QMessageBox.critical(None, title, message)
+    logging.error(message)
+    return False
+
   #------------------------------------------------------------------------------
   def onSaveCalibrationBatchButton(self):
     # Show folder selector window
@@ -1025,6 +1234,8 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     # Get flood field image node
     floodFieldImageVolumeNode = self.step1_floodFieldImageSelectorComboBox.currentNode()
     # Collect calibration doses and volumes
+    if not self.checkCalibrationFilmsSelected('Error when saving calibration batch'):
+      return
     calibrationDoseToVolumeNodeMap = self.collectCalibrationFilms()
 
     # Save calibration batch
@@ -1060,6 +1271,7 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     qt.QApplication.setOverrideCursor(qt.QCursor(qt.Qt.BusyCursor))
 
     calibrationBatchMrmlSceneFilePath = os.path.normpath(calibrationBatchDirectoryPath + "/" + calibrationBatchMrmlSceneFileName)
+    self.logic.calibrationBatchDirectoryPath = os.path.normpath(calibrationBatchDirectoryPath)
     success = slicer.util.loadScene(calibrationBatchMrmlSceneFilePath)
 
     # Restore cursor
@@ -1100,11 +1312,10 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
         try:
           # Set dose level
           doseLevel_cGy = int( shNode.GetItemAttribute(childItemID, self.logic.calibrationVolumeDoseAttributeName) )
-          self.step1_calibrationVolumeSelectorCGySpinBoxList[currentCalibrationFilmIndex].value = doseLevel_cGy
 
           # Set calibration film for dose level
           loadedCalibrationVolume = shNode.GetItemDataNode(childItemID)
-          self.step1_calibrationVolumeSelectorComboBoxList[currentCalibrationFilmIndex].setCurrentNode(loadedCalibrationVolume)
+          self.setCalibrationFilmInTable(currentCalibrationFilmIndex, doseLevel_cGy, loadedCalibrationVolume)
 
           lastLoadedCalibrationVolume = loadedCalibrationVolume
           currentCalibrationFilmIndex += 1
@@ -1114,6 +1325,11 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     # Update calibration films table to set row visibilities
     self.step1_numberOfCalibrationFilmsSpinBox.value = currentCalibrationFilmIndex
 
+    # Load saved measurements of the batch images so that calibration does not need to measure them again
+    if self.logic.calibrationBatchDirectoryPath is not None:
+      self.logic.loadCalibrationMeasurementCache(self.logic.calibrationBatchDirectoryPath,
+        [loadedFloodFieldScalarVolume] + list(self.collectCalibrationFilms().values()))
+
     # Reset saved folder item
     self.lastAddedFolder = 0
 
@@ -1151,6 +1367,31 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     if not collapsed:
       # Fit red slice to calibration film image so that ROI can be added more conveniently
       self.layoutWidget.layoutManager().sliceWidget('Red').sliceController().fitSliceToBackground()
+      self.updateLiveRoiStatistics()
+
+  #------------------------------------------------------------------------------
+  def onCalibrationRoiModified(self, caller=None, event=None):
+    self.updateLiveRoiStatistics()
+
+  #------------------------------------------------------------------------------
+  def updateLiveRoiStatistics(self):
+    if self.step1_2_performCalibrationCollapsibleButton.collapsed or self.logic.lastAddedRoiNode is None:
+      return
+
+    liveRoiStatistics = self.logic.computeLiveCalibrationRoiStatistics(
+      self.step1_floodFieldImageSelectorComboBox.currentNode(), self.collectCalibrationFilms(), self.logic.lastAddedRoiNode)
+
+    lines = []
+    for [dose, meanValue, standardDeviation, opticalDensity] in liveRoiStatistics:
+      if dose == self.logic.floodFieldAttributeValue:
+        line = 'Flood field: '
+      else:
+        line = str(dose) + ' cGy: '
+      line += str(round(meanValue,1)) + u' ± ' + str(round(standardDeviation,1))
+      if opticalDensity is not None:
+        line += ', OD = ' + str(round(opticalDensity,4))
+      lines.append(line)
+    self.step1_liveRoiStatisticsLabel.text = '\n'.join(lines)
 
   #------------------------------------------------------------------------------
   def createCalibrationCurvesWindow(self):
@@ -1187,11 +1428,8 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
 
     # Create and populate the calculated dose/OD curve with function
     opticalDensityList = [round(0 + 0.01*opticalDensityIncrement,2) for opticalDensityIncrement in range(120)] #TODO: Magic number 120? Rounding?
-    opticalDensities = []
-
-    for calculatedEntryIndex in range(120):
-      newEntry = [opticalDensityList[calculatedEntryIndex], self.logic.applyCalibrationFunctionOnSingleOpticalDensityValue(opticalDensityList[calculatedEntryIndex], self.logic.calibrationCoefficients[0], self.logic.calibrationCoefficients[1], self.logic.calibrationCoefficients[2], self.logic.calibrationCoefficients[3])]
-      opticalDensities.append(newEntry)
+    calculatedDoses = self.logic.evaluateCalibrationFunction(opticalDensityList)
+    opticalDensities = [[opticalDensity, float(dose)] for opticalDensity, dose in zip(opticalDensityList, calculatedDoses)]
 
     # Create plot for dose calibration fitted curve
     self.opticalDensityToDoseFunctionTable = vtk.vtkTable()
@@ -1215,6 +1453,36 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     self.calculatedDoseLine.SetColor(255, 0, 0, 255)
     self.calculatedDoseLine.SetWidth(2.0)
 
+    # Create plot for the confidence band of the fitted curve (if uncertainty has been estimated)
+    if hasattr(self, 'calculatedDoseLowerBoundLine'):
+      self.calibrationCurveChart.RemovePlotInstance(self.calculatedDoseLowerBoundLine)
+      self.calibrationCurveChart.RemovePlotInstance(self.calculatedDoseUpperBoundLine)
+      del self.calculatedDoseLowerBoundLine
+      del self.calculatedDoseUpperBoundLine
+    doseUncertaintyBand = None
+    if self.logic.calibrationUncertainty is not None:
+      doseUncertaintyBand = self.logic.calibrationUncertainty.getDoseUncertaintyBand(opticalDensityList)
+    if doseUncertaintyBand is not None:
+      self.doseUncertaintyBandTable = vtk.vtkTable()
+      for columnName in ["Optical Density", "Dose lower bound (cGy)", "Dose upper bound (cGy)"]:
+        bandArray = vtk.vtkDoubleArray()
+        bandArray.SetName(columnName)
+        self.doseUncertaintyBandTable.AddColumn(bandArray)
+      self.doseUncertaintyBandTable.SetNumberOfRows(len(opticalDensityList))
+      for rowIndex in range(len(opticalDensityList)):
+        self.doseUncertaintyBandTable.SetValue(rowIndex, 0, opticalDensityList[rowIndex])
+        self.doseUncertaintyBandTable.SetValue(rowIndex, 1, float(doseUncertaintyBand[0][rowIndex]))
+        self.doseUncertaintyBandTable.SetValue(rowIndex, 2, float(doseUncertaintyBand[1][rowIndex]))
+
+      self.calculatedDoseLowerBoundLine = self.calibrationCurveChart.AddPlot(vtk.vtkChart.LINE)
+      self.calculatedDoseLowerBoundLine.SetInputData(self.doseUncertaintyBandTable, 0, 1)
+      self.calculatedDoseUpperBoundLine = self.calibrationCurveChart.AddPlot(vtk.vtkChart.LINE)
+      self.calculatedDoseUpperBoundLine.SetInputData(self.doseUncertaintyBandTable, 0, 2)
+      for boundLine in [self.calculatedDoseLowerBoundLine, self.calculatedDoseUpperBoundLine]:
+        boundLine.SetColor(255, 128, 128, 255)
+        boundLine.SetWidth(1.0)
+        boundLine.GetPen().SetLineType(vtk.vtkPen.DASH_LINE)
+
     # Show chart
     self.calibrationCurveChart.GetAxis(1).SetTitle('Optical Density')
     self.calibrationCurveChart.GetAxis(0).SetTitle('Dose (cGy)')
@@ -1246,6 +1514,8 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     # Get flood field image node
     floodFieldImageVolumeNode = self.step1_floodFieldImageSelectorComboBox.currentNode()
     # Collect calibration doses and volumes
+    if not self.checkCalibrationFilmsSelected('Error when performing calibration'):
+      return
     calibrationDoseToVolumeNodeMap = self.collectCalibrationFilms()
 
     # Check if the images are RGB and extract red channel if so
@@ -1254,10 +1524,9 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
       # Extract red channel from all calibration images
       calibrationDoseToVolumeNodeMap = self.logic.extractRedChannel(calibrationDoseToVolumeNodeMap)
       # Re-populate comboboxes with new nodes
-      for currentCalibrationVolumeIndex in range(self.step1_numberOfCalibrationFilmsSpinBox.value):
-        currentCalibrationDose = self.step1_calibrationVolumeSelectorCGySpinBoxList[currentCalibrationVolumeIndex].value
-        newCurrentCalibrationVolumeNode = calibrationDoseToVolumeNodeMap[currentCalibrationDose]
-        self.step1_calibrationVolumeSelectorComboBoxList[currentCalibrationVolumeIndex].setCurrentNode(newCurrentCalibrationVolumeNode)
+      for row in range(self.step1_calibrationFilmsTable.rowCount):
+        currentCalibrationDose = int(self.step1_calibrationFilmsTable.item(row, 0).data(qt.Qt.EditRole))
+        self.setCalibrationFilmInTable(row, currentCalibrationDose, calibrationDoseToVolumeNodeMap[currentCalibrationDose])
 
       # Extract red channel from flood field image
       floodFieldImageVolumeNode = self.step1_floodFieldImageSelectorComboBox.currentNode()
@@ -1269,6 +1538,11 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     qt.QApplication.setOverrideCursor(qt.QCursor(qt.Qt.BusyCursor))
 
     # Perform calibration
+    self.logic.calibrationExponentBounds = [self.step1_calibrationExponentMinimumSpinBox.value, self.step1_calibrationExponentMaximumSpinBox.value]
+    self.logic.calibrationExponentTolerance = self.step1_calibrationExponentToleranceSpinBox.value
+    self.logic.useAutomaticCalibrationRoi = self.step1_automaticRoiCheckBox.checked
+    self.logic.calibrationModelSelection = self.step1_calibrationModelComboBox.currentText
+    self.logic.calibrationModelSelectionCriterion = self.step1_calibrationModelSelectionCriterionComboBox.itemData(self.step1_calibrationModelSelectionCriterionComboBox.currentIndex)
     message = self.logic.performCalibration(floodFieldImageVolumeNode, calibrationDoseToVolumeNodeMap)
     if message != "":
       qt.QMessageBox.critical(None, 'Error when performing calibration', message)
@@ -1281,26 +1555,42 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     self.createCalibrationCurvesWindow()
     self.showCalibrationCurves()
 
+    # Show calibration function
+    self.updateCalibrationFunctionWidgets()
+
+    calibrationFunctionToolTip = ""
+    if self.logic.calibrationModelName == PowerCalibrationModel.name:
+      calibrationFunctionToolTip = "Exponent found in " + str(self.logic.calibrationExponentOptimizationIterations) + " iterations"
+    if self.logic.calibrationUncertainty is not None and self.logic.calibrationUncertainty.bootstrapCoefficients is not None:
+      confidenceIntervals = self.logic.calibrationUncertainty.getCoefficientConfidenceIntervals()
+      calibrationFunctionToolTip += "\n" + str(int(self.logic.calibrationUncertainty.confidenceLevel*100)) + "% confidence intervals:"
+      for coefficientName, confidenceInterval in zip(['A','B','C','N'], confidenceIntervals):
+        calibrationFunctionToolTip += "\n  " + coefficientName + ": " + str(round(confidenceInterval[0],5)) + " to " + str(round(confidenceInterval[1],5))
+    if len(self.logic.calibrationModelRanking) > 0:
+      calibrationFunctionToolTip += "\nModel ranking (" + self.step1_calibrationModelSelectionCriterionComboBox.currentText + "):"
+      for modelName, score, parameters, leaveOneOutRootMeanSquare in self.logic.calibrationModelRanking:
+        calibrationFunctionToolTip += "\n  " + modelName + ": " + str(round(score,3)) + " (leave-one-out dose error " + str(round(leaveOneOutRootMeanSquare,3)) + " cGy)"
+    self.step1_2_performCalibrationFunctionLabel.toolTip = calibrationFunctionToolTip.strip()
+
+  #------------------------------------------------------------------------------
+  def updateCalibrationFunctionWidgets(self):
+    """ Show the current calibration function in the calibration function label and the step 3 input fields.
+        The input fields are for the power model, for other models they are emptied and the function is shown in a label.
+    """
+    calibrationModel = self.logic.getCalibrationModel()
+    self.step1_2_performCalibrationFunctionLabel.text = calibrationModel.getFunctionString(self.logic.calibrationCoefficients)
+
+    isPowerModel = (self.logic.calibrationModelName == PowerCalibrationModel.name)
+    self.step3_calibrationModelLabel.text = '' if isPowerModel else (calibrationModel.name + ' model: ' + calibrationModel.getFunctionString(self.logic.calibrationCoefficients))
+    self.step3_calibrationModelLabel.visible = not isPowerModel
+
     # Fill calibration entry line edits (so that the rounded values are not written back to the member variable storing the coefficients)
-    aText = str(round(self.logic.calibrationCoefficients[0],5))
-    bText = str(round(self.logic.calibrationCoefficients[1],5))
-    cText = str(round(self.logic.calibrationCoefficients[2],5))
-    nText = str(round(self.logic.calibrationCoefficients[3],5))
-    self.step3_calibrationFunctionOrder0LineEdit.blockSignals(True)
-    self.step3_calibrationFunctionOrder0LineEdit.text = aText
-    self.step3_calibrationFunctionOrder0LineEdit.blockSignals(False)
-    self.step3_calibrationFunctionOrder1LineEdit.blockSignals(True)
-    self.step3_calibrationFunctionOrder1LineEdit.text = bText
-    self.step3_calibrationFunctionOrder1LineEdit.blockSignals(False)
-    self.step3_calibrationFunctionOrder2LineEdit.blockSignals(True)
-    self.step3_calibrationFunctionOrder2LineEdit.text = cText
-    self.step3_calibrationFunctionOrder2LineEdit.blockSignals(False)
-    self.step3_calibrationFunctionExponentLineEdit.blockSignals(True)
-    self.step3_calibrationFunctionExponentLineEdit.text = nText
-    self.step3_calibrationFunctionExponentLineEdit.blockSignals(False)
-
-    # Calibration function label
-    self.step1_2_performCalibrationFunctionLabel.text = "Dose (cGy) = " + aText + " + " + bText + " * OD + " + cText + " * OD^" + nText
+    calibrationFunctionLineEdits = [ self.step3_calibrationFunctionOrder0LineEdit, self.step3_calibrationFunctionOrder1LineEdit,
+      self.step3_calibrationFunctionOrder2LineEdit, self.step3_calibrationFunctionExponentLineEdit ]
+    for coefficientIndex, lineEdit in enumerate(calibrationFunctionLineEdits):
+      lineEdit.blockSignals(True)
+      lineEdit.text = str(round(self.logic.calibrationCoefficients[coefficientIndex],5)) if isPowerModel else ''
+      lineEdit.blockSignals(False)
 
   #------------------------------------------------------------------------------
   def onSaveCalibrationFunctionToFileButton(self):
@@ -1371,6 +1661,11 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
 
   #------------------------------------------------------------------------------
   def onCalibrationFunctionLineEditChanged(self):
+    # The input fields define a power model calibration function
+    if self.logic.calibrationModelName != PowerCalibrationModel.name:
+      self.logic.calibrationModelName = PowerCalibrationModel.name
+      self.logic.calibrationCoefficients = [0,0,0,0]
+      self.step3_calibrationModelLabel.visible = False
     if self.step3_calibrationFunctionOrder0LineEdit.text != '':
       try:
         self.logic.calibrationCoefficients[0] = float(self.step3_calibrationFunctionOrder0LineEdit.text)
@@ -1402,22 +1697,7 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     self.logic.loadCalibrationFunctionFromFile(filePath)
 
     # Display coefficients (rounded to five digits, but the member variable has full accuracy)
-    aText = str(round(self.logic.calibrationCoefficients[0],5))
-    bText = str(round(self.logic.calibrationCoefficients[1],5))
-    cText = str(round(self.logic.calibrationCoefficients[2],5))
-    nText = str(round(self.logic.calibrationCoefficients[3],5))
-    self.step3_calibrationFunctionOrder0LineEdit.blockSignals(True)
-    self.step3_calibrationFunctionOrder0LineEdit.text = aText
-    self.step3_calibrationFunctionOrder0LineEdit.blockSignals(False)
-    self.step3_calibrationFunctionOrder1LineEdit.blockSignals(True)
-    self.step3_calibrationFunctionOrder1LineEdit.text = bText
-    self.step3_calibrationFunctionOrder1LineEdit.blockSignals(False)
-    self.step3_calibrationFunctionOrder2LineEdit.blockSignals(True)
-    self.step3_calibrationFunctionOrder2LineEdit.text = cText
-    self.step3_calibrationFunctionOrder2LineEdit.blockSignals(False)
-    self.step3_calibrationFunctionExponentLineEdit.blockSignals(True)
-    self.step3_calibrationFunctionExponentLineEdit.text = nText
-    self.step3_calibrationFunctionExponentLineEdit.blockSignals(False)
+    self.updateCalibrationFunctionWidgets()
 
   #------------------------------------------------------------------------------
   def onApplyCalibrationButton(self):
@@ -1431,11 +1711,18 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     qt.QApplication.setOverrideCursor(qt.QCursor(qt.Qt.BusyCursor))
 
     # Apply calibration function on experimental image
+    self.logic.useExperimentalFloodFieldMeanValue = self.step3_useFloodFieldMeanValueCheckBox.checked
+    self.logic.doseConversionTileNumberOfRows = self.step3_doseConversionTileNumberOfRowsSpinBox.value
+    self.logic.useMemoryMappedDoseBuffer = self.step3_memoryMappedDoseBufferCheckBox.checked
+    self.logic.numberOfDoseConversionThreads = self.step3_numberOfDoseConversionThreadsSpinBox.value
+    self.logic.useSinglePrecisionPipeline = self.step3_useSinglePrecisionPipelineCheckBox.checked
     message = self.logic.applyCalibrationOnExperimentalFilm()
     if message != '':
       qt.QMessageBox.critical(None, 'Error when applying calibration', message)
       logging.error(message)
       self.step3_calibrationMessageLabel.text = message
+    elif self.logic.experimentalFilmInvalidPixelCount > 0:
+      self.step3_calibrationMessageLabel.text = 'Calibration finished\n(' + str(self.logic.experimentalFilmInvalidPixelCount) + ' invalid pixels set to zero dose)'
     else:
       self.step3_calibrationMessageLabel.text = 'Calibration successfully finished'
 
@@ -1455,6 +1742,9 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
 
   #------------------------------------------------------------------------------
   def onStep4_RegistrationCollapsed(self, collapsed):
+    if not collapsed and self.logic.isFilmToPlanDoseRegistrationRunning():
+      # Initialization would re-create the volumes the running registration is using
+      return
     if not collapsed:
       # Pre-process volumes for registration (cropping, padding),
       # pre-align film and plan dose slice for scan setup alignment
@@ -1509,16 +1799,68 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     self.logic.flipCalibratedExperimentalFilm(False)
 
   #------------------------------------------------------------------------------
-  def onPerformRegistrationButtonClicked(self):
+  def onStep4_FindOrientation(self):
     qt.QApplication.setOverrideCursor(qt.QCursor(qt.Qt.BusyCursor))
+    message = self.logic.findScanSetupAlignment()
+    qt.QApplication.restoreOverrideCursor()
+    if message != "":
+      qt.QMessageBox.critical(None, 'Error when finding film orientation', message)
+      logging.error(message)
 
-    # Perform registration
-    message = self.logic.registerExperimentalFilmToPlanDose()
+  #------------------------------------------------------------------------------
+  def setStep4_ScanSetupAlignmentEnabled(self, enabled):
+    self.step4_rotateCcwButton.enabled = enabled
+    self.step4_rotateCwButton.enabled = enabled
+    self.step4_flipHorizontalButton.enabled = enabled
+    self.step4_flipVerticalButton.enabled = enabled
+    self.step4_findOrientationButton.enabled = enabled
+
+  #------------------------------------------------------------------------------
+  def onStep4_UseNativeFilmRegistrationToggled(self, toggled):
+    # Multi-start is only available for the in-plane registration
+    self.step4_useMultiStartFilmRegistrationCheckBox.setEnabled(toggled)
+
+  #------------------------------------------------------------------------------
+  def onPerformRegistrationButtonClicked(self):
+    # Start registration, the application stays responsive while it runs
+    self.logic.useNativeFilmRegistration = self.step4_useNativeFilmRegistrationCheckBox.checked
+    self.logic.useMultiStartFilmRegistration = self.step4_useMultiStartFilmRegistrationCheckBox.checked
+    self.observeStep4_FilmToDoseSliceTransform(None)
+    message = self.logic.startFilmToPlanDoseRegistration(self.onFilmToPlanDoseRegistrationFinished, self.onFilmToPlanDoseRegistrationProgress)
     if message != "":
-      qt.QMessageBox.critical(None, 'Error when performing calibration', message)
+      qt.QMessageBox.critical(None, 'Error when performing registration', message)
       logging.error(message)
+      return
 
-    qt.QApplication.restoreOverrideCursor()
+    # The films must not be moved or re-initialized while they are being registered
+    self.step4_performRegistrationButton.enabled = False
+    self.setStep4_ScanSetupAlignmentEnabled(False)
+    self.step4_registrationProgressDialog = qt.QProgressDialog(self.parent)
+    self.step4_registrationProgressDialog.setModal(False)
+    self.step4_registrationProgressDialog.setMinimumDuration(150)
+    self.step4_registrationProgressDialog.labelText = "Registering experimental film to plan dose..."
+    self.step4_registrationProgressDialog.connect('canceled()', self.logic.cancelFilmToPlanDoseRegistration)
+    self.step4_registrationProgressDialog.show()
+
+  #------------------------------------------------------------------------------
+  def onFilmToPlanDoseRegistrationProgress(self, progress):
+    if self.step4_registrationProgressDialog:
+      self.step4_registrationProgressDialog.value = progress * 100.0
+
+  #------------------------------------------------------------------------------
+  def onFilmToPlanDoseRegistrationFinished(self, message):
+    if self.step4_registrationProgressDialog:
+      self.step4_registrationProgressDialog.disconnect('canceled()', self.logic.cancelFilmToPlanDoseRegistration)
+      self.step4_registrationProgressDialog.hide()
+      self.step4_registrationProgressDialog = None
+    self.step4_performRegistrationButton.enabled = True
+    self.setStep4_ScanSetupAlignmentEnabled(True)
+    if self.logic.filmToPlanDoseRegistrationJob.status == RegistrationJob.Cancelled:
+      # Cancelled by the user, the films are back at the scan setup alignment
+      return
+    if message != "":
+      qt.QMessageBox.critical(None, 'Error when performing registration', message)
+      return
 
     # Show registered images
     appLogic = slicer.app.applicationLogic()
@@ -1528,10 +1870,7 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     appLogic.PropagateVolumeSelection()
 
     # Disable pre-alignment controls, because they cannot be used after registration
-    self.step4_rotateCcwButton.enabled = False
-    self.step4_rotateCwButton.enabled = False
-    self.step4_flipHorizontalButton.enabled = False
-    self.step4_flipVerticalButton.enabled = False
+    self.setStep4_ScanSetupAlignmentEnabled(False)
 
     # Set transforms to slider widgets
     self.step4_translationSliders.setMRMLTransformNode(self.logic.experimentalFilmToDoseSliceTransformNode)
@@ -1542,6 +1881,34 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     for slider in sliders:
       slider.singleStep = 0.5
 
+    # Show similarity of the registered film and follow the manual adjustments
+    self.observeStep4_FilmToDoseSliceTransform(self.logic.experimentalFilmToDoseSliceTransformNode)
+    self.updateStep4_AlignmentMetric()
+
+  #------------------------------------------------------------------------------
+  def observeStep4_FilmToDoseSliceTransform(self, transformNode):
+    if self.step4_observedFilmToDoseSliceTransformNode is not None:
+      self.removeObserver(self.step4_observedFilmToDoseSliceTransformNode, slicer.vtkMRMLTransformableNode.TransformModifiedEvent, self.onStep4_FilmToDoseSliceTransformModified)
+      self.step4_alignmentMetricLabel.text = ''
+    self.step4_observedFilmToDoseSliceTransformNode = transformNode
+    if transformNode is not None:
+      self.addObserver(transformNode, slicer.vtkMRMLTransformableNode.TransformModifiedEvent, self.onStep4_FilmToDoseSliceTransformModified)
+
+  #------------------------------------------------------------------------------
+  def onStep4_FilmToDoseSliceTransformModified(self, transformNode, event):
+    # Update at most once per timer interval while the sliders are dragged, and once after the last change
+    if not self.step4_alignmentMetricUpdateTimer.isActive():
+      self.step4_alignmentMetricUpdateTimer.start()
+
+  #------------------------------------------------------------------------------
+  def updateStep4_AlignmentMetric(self):
+    normalizedCrossCorrelation, meanAbsoluteDifferenceGy = self.logic.computeFilmToPlanDoseAlignmentMetric()
+    if normalizedCrossCorrelation is None:
+      self.step4_alignmentMetricLabel.text = 'Similarity to plan dose: film and dose slice do not overlap'
+      return
+    self.step4_alignmentMetricLabel.text = 'Similarity to plan dose: correlation {0:.4f}, mean absolute difference {1:.1f} cGy'.format(
+      normalizedCrossCorrelation, meanAbsoluteDifferenceGy * 100.0)
+
   #------------------------------------------------------------------------------
   # Step 5
 
@@ -1770,6 +2137,7 @@ class FilmDosimetryAnalysisSlicelet(VTKObservationMixin):
     # Set up line profile logic
     self.lineProfileLogic.outputPlotSeriesNodes = {}
     self.lineProfileLogic.outputTableNode = self.lineProfileTableNode
+    self.lineProfileLogic.useSinglePrecision = self.logic.useSinglePrecisionPipeline
     self.lineProfileLogic.inputRulerNode = self.stepT1_inputRulerSelector.currentNode()
     self.lineProfileLogic.enableAutoUpdate(True)
 
@@ -0,0 +1,65 @@
+import json
+from collections import OrderedDict
+
+#
+# CalibrationMeasurementCache
+#
+class CalibrationMeasurementCache():
+  """ Least recently used cache of calibration film ROI statistics.
+      Entries are keyed by the fingerprint of the image content and the measured extent, so they stay valid when
+      dose values are edited, films are added or reordered, or the same image is loaded again into another node.
+  """
+
+  def __init__(self, maximumNumberOfEntries=1000):
+    self.maximumNumberOfEntries = maximumNumberOfEntries
+    self.entries = OrderedDict() # Map from (image fingerprint, extent) to [mean, standard deviation, number of voxels]
+    self.numberOfHits = 0
+    self.numberOfMisses = 0
+
+  def getKey(self, fingerprint, extent):
+    return (fingerprint, tuple(int(bound) for bound in extent))
+
+  def getStatistics(self, fingerprint, extent):
+    key = self.getKey(fingerprint, extent)
+    statistics = self.entries.get(key)
+    if statistics is None:
+      self.numberOfMisses += 1
+      return None
+    self.entries.move_to_end(key)
+    self.numberOfHits += 1
+    return statistics
+
+  def setStatistics(self, fingerprint, extent, statistics):
+    key = self.getKey(fingerprint, extent)
+    self.entries[key] = list(statistics)
+    self.entries.move_to_end(key)
+    while len(self.entries) > self.maximumNumberOfEntries:
+      self.entries.popitem(last=False)
+
+  def clear(self):
+    self.entries = OrderedDict()
+    self.numberOfHits = 0
+    self.numberOfMisses = 0
+
+  def writeToFile(self, filePath, imageFingerprints):
+    """ Write the entries of the given images to a JSON file.
+        imageFingerprints maps image file names to [file signature, fingerprint], so that the images can be identified
+        when the file is read without reading their pixels.
+    """
+    fingerprints = set(fingerprint for fileSignature, fingerprint in imageFingerprints.values())
+    measurements = []
+    for (fingerprint, extent), statistics in self.entries.items():
+      if fingerprint in fingerprints:
+        measurements.append({'fingerprint': fingerprint, 'extent': list(extent), 'statistics': statistics})
+    with open(filePath, 'w') as file:
+      json.dump({'images': imageFingerprints, 'measurements': measurements}, file, indent=1)
+
+  def readFromFile(self, filePath):
+    """ Add the entries stored in a JSON file written by writeToFile.
+        Returns the map from image file names to [file signature, fingerprint] stored in the file.
+    """
+    with open(filePath, 'r') as file:
+      cacheContents = json.load(file)
+    for measurement in cacheContents['measurements']:
+      self.setStatistics(measurement['fingerprint'], measurement['extent'], measurement['statistics'])
+    return cacheContents['images']
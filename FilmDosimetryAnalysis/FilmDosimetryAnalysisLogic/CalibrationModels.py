@@ -0,0 +1,209 @@
+import numpy
+from collections import OrderedDict
+
+#
+# CalibrationModel
+#
+class CalibrationModel():
+  """ Base class of optical density to dose calibration models.
+      Models fit their parameters to the calibration points for a batch of point weightings at once (such as the
+      full data set and all leave-one-out subsets), and evaluate the dose on optical density arrays of any shape.
+      New models are made available by registerCalibrationModel.
+  """
+  name = ''
+  parameterNames = []
+  functionString = ''
+  isDefinedEverywhere = True # False if the function has poles, so that the evaluated dose needs to be checked
+
+  def getNumberOfParameters(self):
+    return len(self.parameterNames)
+
+  def fit(self, opticalDensities, doses, weights):
+    """ Weighted least squares fit of the parameters for each row of the weights array (one weight per point).
+        Returns the parameters, one row per weighting.
+    """
+    raise NotImplementedError()
+
+  def evaluate(self, opticalDensities, parameters, out=None):
+    """ Calculate dose for the optical densities. Each parameter can be a scalar or an array broadcastable with the
+        optical densities. If out is given (it may be the optical density array itself) then the dose is written there.
+    """
+    raise NotImplementedError()
+
+  def getFunctionString(self, parameters, digits=5):
+    formattedParameters = dict((name, str(round(float(value),digits))) for name, value in zip(self.parameterNames, parameters))
+    return 'Dose (cGy) = ' + self.functionString.format(**formattedParameters)
+
+#------------------------------------------------------------------------------
+def solveWeightedLeastSquares(functionTermsMatrices, doses, weights):
+  """ Solve weighted linear least squares problems for stacked design matrices (..., points, terms) and point weights
+      (..., points) given in any broadcastable batch shape. Returns the coefficients and the weighted sums of squared errors.
+  """
+  weightedFunctionTermsMatrices = functionTermsMatrices * weights[...,numpy.newaxis]
+  normalMatrices = numpy.matmul(numpy.swapaxes(weightedFunctionTermsMatrices, -1, -2), functionTermsMatrices)
+  rightHandSides = numpy.matmul(numpy.swapaxes(weightedFunctionTermsMatrices, -1, -2), doses[...,numpy.newaxis])
+  # Minimum-norm solution for underdetermined subsets
+  coefficients = numpy.matmul(numpy.linalg.pinv(normalMatrices), rightHandSides)
+  residuals = numpy.matmul(functionTermsMatrices, coefficients)[...,0] - doses
+  return coefficients[...,0], numpy.sum(weights * residuals * residuals, axis=-1)
+
+#------------------------------------------------------------------------------
+def fitProfiledModel(getFunctionTermsMatrices, candidateValues, doses, weights):
+  """ Fit a model that is linear in all parameters except one, by evaluating the candidate values of the nonlinear
+      parameter for all weightings at once, and refining the best candidate with a parabola through its neighbours.
+      getFunctionTermsMatrices returns the design matrices (candidates, points, terms) for an array of candidate values.
+      Returns the linear coefficients and the nonlinear parameter value for each weighting.
+  """
+  # Errors of all candidates for all weightings: [weighting, candidate]
+  functionTermsMatrices = getFunctionTermsMatrices(candidateValues)
+  coefficients, sumsOfSquaredErrors = solveWeightedLeastSquares(
+    functionTermsMatrices[numpy.newaxis,:,:,:], doses, weights[:,numpy.newaxis,:])
+
+  numberOfWeightings = weights.shape[0]
+  weightingIndices = numpy.arange(numberOfWeightings)
+  bestIndices = numpy.clip(numpy.argmin(sumsOfSquaredErrors, axis=1), 1, len(candidateValues)-2)
+  x0, x1, x2 = candidateValues[bestIndices-1], candidateValues[bestIndices], candidateValues[bestIndices+1]
+  f0 = sumsOfSquaredErrors[weightingIndices, bestIndices-1]
+  f1 = sumsOfSquaredErrors[weightingIndices, bestIndices]
+  f2 = sumsOfSquaredErrors[weightingIndices, bestIndices+1]
+  # Vertex of the parabola through three (not necessarily evenly spaced) points
+  numerator = (x1-x0)**2 * (f1-f2) - (x1-x2)**2 * (f1-f0)
+  denominator = (x1-x0) * (f1-f2) - (x1-x2) * (f1-f0)
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    refinedValues = numpy.where(denominator != 0.0, x1 - 0.5 * numerator / denominator, x1)
+  refinedValues = numpy.where(numpy.logical_and(refinedValues >= x0, refinedValues <= x2), refinedValues, x1)
+
+  # Keep the best candidate where the refinement did not improve on it
+  refinedCoefficients, refinedSumsOfSquaredErrors = solveWeightedLeastSquares(
+    getFunctionTermsMatrices(refinedValues), doses, weights)
+  bestCandidateCoefficients = coefficients[weightingIndices, numpy.argmin(sumsOfSquaredErrors, axis=1)]
+  bestCandidateValues = candidateValues[numpy.argmin(sumsOfSquaredErrors, axis=1)]
+  refinementImproved = refinedSumsOfSquaredErrors <= numpy.min(sumsOfSquaredErrors, axis=1)
+  return (numpy.where(refinementImproved[:,numpy.newaxis], refinedCoefficients, bestCandidateCoefficients),
+          numpy.where(refinementImproved, refinedValues, bestCandidateValues))
+
+#
+# PowerCalibrationModel
+#
+class PowerCalibrationModel(CalibrationModel):
+  name = 'Power'
+  parameterNames = ['A', 'B', 'C', 'N']
+  functionString = '{A} + {B} * OD + {C} * OD^{N}'
+
+  def __init__(self):
+    self.exponentBounds = [1.0, 4.0]
+    self.exponentGridSize = 301
+
+  def fit(self, opticalDensities, doses, weights):
+    def getFunctionTermsMatrices(exponents):
+      functionTermsMatrices = numpy.empty((len(exponents), len(opticalDensities), 3))
+      functionTermsMatrices[:,:,0] = 1.0
+      functionTermsMatrices[:,:,1] = opticalDensities
+      functionTermsMatrices[:,:,2] = numpy.power(opticalDensities[numpy.newaxis,:], exponents[:,numpy.newaxis])
+      return functionTermsMatrices
+    exponents = numpy.linspace(min(self.exponentBounds), max(self.exponentBounds), self.exponentGridSize)
+    coefficients, bestExponents = fitProfiledModel(getFunctionTermsMatrices, exponents, doses, weights)
+    return numpy.column_stack([coefficients, bestExponents])
+
+  def evaluate(self, opticalDensities, parameters, out=None):
+    a, b, c, n = parameters
+    exponentialTerm = numpy.power(opticalDensities, n)
+    exponentialTerm *= c
+    if out is None:
+      out = numpy.multiply(opticalDensities, b)
+    else:
+      numpy.multiply(opticalDensities, b, out=out)
+    out += exponentialTerm
+    out += a
+    return out
+
+#
+# RationalCalibrationModel
+#
+class RationalCalibrationModel(CalibrationModel):
+  name = 'Rational'
+  parameterNames = ['A', 'B', 'C']
+  functionString = '{A} + {B} / (OD - {C})'
+  isDefinedEverywhere = False
+
+  def __init__(self):
+    self.poleGridSize = 200 # Candidate pole positions on each side of the measured optical density range
+
+  def fit(self, opticalDensities, doses, weights):
+    def getFunctionTermsMatrices(poles):
+      functionTermsMatrices = numpy.empty((len(poles), len(opticalDensities), 2))
+      functionTermsMatrices[:,:,0] = 1.0
+      functionTermsMatrices[:,:,1] = 1.0 / (opticalDensities[numpy.newaxis,:] - poles[:,numpy.newaxis])
+      return functionTermsMatrices
+    # The pole must be outside the range of the calibration points, candidates are placed at geometrically
+    # increasing distances (large distances approximate a linear response)
+    opticalDensityRange = max(opticalDensities.max() - opticalDensities.min(), 1e-3)
+    distances = opticalDensityRange * numpy.geomspace(1e-3, 1e3, self.poleGridSize)
+    poles = numpy.concatenate([opticalDensities.min() - distances[::-1], opticalDensities.max() + distances])
+    coefficients, bestPoles = fitProfiledModel(getFunctionTermsMatrices, poles, doses, weights)
+    return numpy.column_stack([coefficients, bestPoles])
+
+  def evaluate(self, opticalDensities, parameters, out=None):
+    a, b, c = parameters
+    out = numpy.subtract(opticalDensities, c, out=out)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+      numpy.reciprocal(out, out=out)
+    out *= b
+    out += a
+    return out
+
+#
+# PolynomialCalibrationModel
+#
+class PolynomialCalibrationModel(CalibrationModel):
+  """ Polynomial of the optical density, parameters are the coefficients in increasing order
+  """
+  degree = 3
+
+  def fit(self, opticalDensities, doses, weights):
+    functionTermsMatrix = numpy.power(opticalDensities[:,numpy.newaxis], numpy.arange(self.degree+1)[numpy.newaxis,:])
+    coefficients, sumsOfSquaredErrors = solveWeightedLeastSquares(functionTermsMatrix[numpy.newaxis,:,:], doses, weights)
+    return coefficients
+
+  def evaluate(self, opticalDensities, parameters, out=None):
+    # Horner's scheme
+    dose = numpy.zeros(numpy.broadcast(opticalDensities, *parameters).shape) + parameters[-1]
+    for coefficient in reversed(parameters[:-1]):
+      dose *= opticalDensities
+      dose += coefficient
+    if out is None:
+      return dose
+    out[...] = dose
+    return out
+
+class QuadraticCalibrationModel(PolynomialCalibrationModel):
+  name = 'Quadratic'
+  parameterNames = ['A', 'B', 'C']
+  functionString = '{A} + {B} * OD + {C} * OD^2'
+  degree = 2
+
+class CubicCalibrationModel(PolynomialCalibrationModel):
+  name = 'Cubic'
+  parameterNames = ['A', 'B', 'C', 'D']
+  functionString = '{A} + {B} * OD + {C} * OD^2 + {D} * OD^3'
+  degree = 3
+
+#------------------------------------------------------------------------------
+calibrationModelClasses = OrderedDict() # Map from model names to calibration model classes
+
+def registerCalibrationModel(calibrationModelClass):
+  calibrationModelClasses[calibrationModelClass.name] = calibrationModelClass
+
+def getCalibrationModelNames():
+  return list(calibrationModelClasses.keys())
+
+def createCalibrationModel(name):
+  """ Create a calibration model by name. Returns None for unknown models.
+  """
+  calibrationModelClass = calibrationModelClasses.get(name)
+  return calibrationModelClass() if calibrationModelClass is not None else None
+
+registerCalibrationModel(PowerCalibrationModel)
+registerCalibrationModel(RationalCalibrationModel)
+registerCalibrationModel(QuadraticCalibrationModel)
+registerCalibrationModel(CubicCalibrationModel)
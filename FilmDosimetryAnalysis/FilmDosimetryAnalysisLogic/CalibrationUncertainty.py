@@ -0,0 +1,145 @@
+import logging
+import numpy
+
+#
+# CalibrationUncertainty
+#
+class CalibrationUncertainty():
+  """ Uncertainty of the calibration function dose = a + b*OD + c*OD^n fitted to the measured calibration points.
+      Confidence intervals of the coefficients and a dose uncertainty band are estimated by residual bootstrap.
+      Each resample is refitted including the exponent, with all resamples and candidate exponents solved together
+      in batched array operations. Leave-one-out residuals are computed in closed form from the hat matrix.
+      Batches of resamples can be computed in a thread pool, as the numpy linear algebra releases the GIL.
+  """
+
+  def __init__(self, opticalDensities, doses, exponentBounds):
+    self.opticalDensities = numpy.asarray(opticalDensities, dtype=numpy.float64)
+    self.doses = numpy.asarray(doses, dtype=numpy.float64)
+    self.exponentBounds = [min(exponentBounds), max(exponentBounds)]
+
+    self.numberOfResamples = 2000
+    self.confidenceLevel = 0.95
+    self.exponentGridSize = 121 # Candidate exponents for refitting the resamples, refined by parabolic interpolation
+    self.randomSeed = 0 # Fixed seed so that the reported intervals are reproducible
+    self.numberOfThreads = 1 # Number of threads computing the batches of resamples (1 to compute them in the calling thread)
+    self.numberOfResamplesPerTask = 250
+
+    self.bootstrapCoefficients = None # One [a,b,c,n] row per resample
+    self.leaveOneOutResiduals = None
+
+  def getNumberOfParameters(self):
+    return 4
+
+  def computeLeaveOneOutResiduals(self, coefficients):
+    """ Prediction errors (measured minus predicted dose) of each calibration point when it is left out of the fit,
+        computed in closed form as e_i/(1-h_ii) for the fitted exponent. Also returns their root mean square.
+    """
+    functionTermsMatrix = getFunctionTermsMatrices(self.opticalDensities, [coefficients[3]])[0]
+    hatMatrixDiagonal = numpy.einsum('mi,im->m', functionTermsMatrix, numpy.linalg.pinv(functionTermsMatrix))
+    residuals = self.doses - numpy.dot(functionTermsMatrix, coefficients[0:3])
+    # A point that alone determines a coefficient has h_ii=1, its leave-one-out error is undefined
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+      self.leaveOneOutResiduals = numpy.where(hatMatrixDiagonal < 1.0 - 1e-9, residuals / (1.0 - hatMatrixDiagonal), numpy.nan)
+    return self.leaveOneOutResiduals, float(numpy.sqrt(numpy.nanmean(self.leaveOneOutResiduals ** 2)))
+
+  def computeBootstrapCoefficients(self, coefficients):
+    """ Refit the calibration function to numberOfResamples residual bootstrap resamples of the calibration points.
+        Returns the coefficients [a,b,c,n] of the resamples, or None if there are not enough points.
+    """
+    numberOfPoints = len(self.doses)
+    if numberOfPoints <= self.getNumberOfParameters():
+      logging.info("Calibration uncertainty: At least " + str(self.getNumberOfParameters()+1) + " calibration points are needed for bootstrap, " + str(numberOfPoints) + " given")
+      return None
+
+    fittedDoses = numpy.dot(getFunctionTermsMatrices(self.opticalDensities, [coefficients[3]])[0], coefficients[0:3])
+    # Residuals are inflated to compensate for the degrees of freedom used by the fit
+    residuals = (self.doses - fittedDoses) * numpy.sqrt(float(numberOfPoints) / (numberOfPoints - self.getNumberOfParameters()))
+    residuals -= residuals.mean()
+    exponents = numpy.linspace(self.exponentBounds[0], self.exponentBounds[1], self.exponentGridSize)
+
+    tasks = []
+    for taskIndex, firstResampleIndex in enumerate(range(0, self.numberOfResamples, self.numberOfResamplesPerTask)):
+      numberOfResamplesInTask = min(self.numberOfResamplesPerTask, self.numberOfResamples - firstResampleIndex)
+      tasks.append((self.opticalDensities, fittedDoses, residuals, exponents, self.randomSeed + taskIndex, numberOfResamplesInTask))
+
+    # Each task has its own random seed, so the result does not depend on the number of threads
+    if self.numberOfThreads > 1 and len(tasks) > 1:
+      from concurrent.futures import ThreadPoolExecutor
+      with ThreadPoolExecutor(max_workers=min(self.numberOfThreads, len(tasks))) as executor:
+        coefficientsPerTask = list(executor.map(fitBootstrapResamplesTask, tasks))
+    else:
+      coefficientsPerTask = [fitBootstrapResamplesTask(task) for task in tasks]
+
+    self.bootstrapCoefficients = numpy.concatenate(coefficientsPerTask)
+    return self.bootstrapCoefficients
+
+  def getCoefficientConfidenceIntervals(self):
+    """ Percentile confidence intervals of the coefficients, one [lower, upper] row for each of a, b, c, n
+    """
+    if self.bootstrapCoefficients is None:
+      return None
+    tailPercent = 50.0 * (1.0 - self.confidenceLevel)
+    return numpy.percentile(self.bootstrapCoefficients, [tailPercent, 100.0 - tailPercent], axis=0).T
+
+  def getDoseUncertaintyBand(self, opticalDensities):
+    """ Pointwise percentile confidence band of the calibrated dose at the given optical densities.
+        Returns the lower and upper dose arrays, or None if bootstrap has not been performed.
+    """
+    if self.bootstrapCoefficients is None:
+      return None
+    opticalDensities = numpy.asarray(opticalDensities, dtype=numpy.float64)
+    a, b, c, n = [self.bootstrapCoefficients[:,index,numpy.newaxis] for index in range(4)]
+    bootstrapDoses = a + b * opticalDensities + c * numpy.power(opticalDensities, n)
+    tailPercent = 50.0 * (1.0 - self.confidenceLevel)
+    lowerDoses, upperDoses = numpy.percentile(bootstrapDoses, [tailPercent, 100.0 - tailPercent], axis=0)
+    return lowerDoses, upperDoses
+
+#------------------------------------------------------------------------------
+def getFunctionTermsMatrices(opticalDensities, exponents):
+  """ Stacked design matrices with rows [1, OD, OD^n], one matrix per exponent
+  """
+  exponents = numpy.asarray(exponents, dtype=numpy.float64)
+  functionTermsMatrices = numpy.empty((len(exponents), len(opticalDensities), 3))
+  functionTermsMatrices[:,:,0] = 1.0
+  functionTermsMatrices[:,:,1] = opticalDensities
+  functionTermsMatrices[:,:,2] = numpy.power(opticalDensities[numpy.newaxis,:], exponents[:,numpy.newaxis])
+  return functionTermsMatrices
+
+#------------------------------------------------------------------------------
+def fitBootstrapResamplesTask(task):
+  """ Fit the calibration function to a batch of residual bootstrap resamples (thread pool entry point).
+      Task is (optical densities, fitted doses, residuals, candidate exponents, random seed, number of resamples).
+      Returns the coefficients [a,b,c,n] of the resamples.
+  """
+  opticalDensities, fittedDoses, residuals, exponents, randomSeed, numberOfResamples = task
+  randomState = numpy.random.RandomState(randomSeed)
+  resampledDoses = fittedDoses + residuals[randomState.randint(0, len(residuals), size=(numberOfResamples, len(residuals)))]
+
+  # The design matrices do not depend on the resample, so one pseudo-inverse per exponent serves all resamples
+  functionTermsMatrices = getFunctionTermsMatrices(opticalDensities, exponents)
+  singularValueCutoff = numpy.finfo(numpy.float64).eps * max(len(opticalDensities), 3)
+  pseudoInverses = numpy.linalg.pinv(functionTermsMatrices, singularValueCutoff)
+  linearCoefficients = numpy.einsum('kim,rm->rki', pseudoInverses, resampledDoses) # [resample, exponent, a/b/c]
+  residualsOfFits = numpy.einsum('kmi,rki->rkm', functionTermsMatrices, linearCoefficients) - resampledDoses[:,numpy.newaxis,:]
+  sumsOfSquaredErrors = numpy.einsum('rkm,rkm->rk', residualsOfFits, residualsOfFits)
+
+  # Best candidate exponent of each resample, refined by a parabola through the neighbouring candidates
+  resampleIndices = numpy.arange(numberOfResamples)
+  bestExponentIndices = numpy.clip(numpy.argmin(sumsOfSquaredErrors, axis=1), 1, len(exponents)-2)
+  previousErrors = sumsOfSquaredErrors[resampleIndices, bestExponentIndices-1]
+  bestErrors = sumsOfSquaredErrors[resampleIndices, bestExponentIndices]
+  nextErrors = sumsOfSquaredErrors[resampleIndices, bestExponentIndices+1]
+  curvatures = previousErrors - 2.0 * bestErrors + nextErrors
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    offsets = numpy.where(curvatures > 0.0, 0.5 * (previousErrors - nextErrors) / curvatures, 0.0)
+  exponentStep = exponents[1] - exponents[0]
+  bestExponents = numpy.clip(exponents[bestExponentIndices] + numpy.clip(offsets, -1.0, 1.0) * exponentStep, exponents[0], exponents[-1])
+
+  # Linear coefficients for the refined exponents
+  refinedFunctionTermsMatrices = numpy.empty((numberOfResamples, len(opticalDensities), 3))
+  refinedFunctionTermsMatrices[:,:,0] = 1.0
+  refinedFunctionTermsMatrices[:,:,1] = opticalDensities
+  refinedFunctionTermsMatrices[:,:,2] = numpy.power(opticalDensities[numpy.newaxis,:], bestExponents[:,numpy.newaxis])
+  refinedLinearCoefficients = numpy.einsum('rim,rm->ri', numpy.linalg.pinv(refinedFunctionTermsMatrices, singularValueCutoff), resampledDoses)
+
+  return numpy.column_stack([refinedLinearCoefficients, bestExponents])
@@ -10,6 +10,13 @@ import shutil
 import ntpath
 import math
 from collections import OrderedDict
+from .IntegralImage import IntegralImage
+from .CalibrationMeasurementCache import CalibrationMeasurementCache
+from .CalibrationUncertainty import CalibrationUncertainty, getFunctionTermsMatrices
+from .CalibrationModels import PowerCalibrationModel, createCalibrationModel, getCalibrationModelNames
+from .SharedImageBuffer import SharedImageBufferRegistry
+from .FilmRegistration2D import RigidRegistration2D, MultiStartRigidRegistration2D, OrientationSearch2D, AlignmentMetric2D, computeMomentAlignmentMatrix
+from .RegistrationJob import RegistrationJob, ThreadRegistrationJob, CliRegistrationJob
 
 #
 # FilmDosimetryAnalysisLogic
@@ -24,8 +31,10 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
     self.saveCalibrationBatchFolderItemNamePrefix = "Calibration batch"
     self.calibrationVolumeDoseAttributeName = "Dose"
     self.floodFieldAttributeValue = "FloodField"
+    self.automaticCalibrationModelSelection = "Automatic"
     self.calibrationBatchSceneFileNamePostfix = "CalibrationBatchScene"
     self.calibrationFunctionFileNamePostfix = "FilmDosimetryCalibrationFunctionCoefficients"
+    self.calibrationMeasurementCacheFileName = "CalibrationMeasurements.json"
     self.calibratedExperimentalFilmVolumeNamePostfix = "_Calibrated"
     self.croppedPlanDoseVolumeNamePostfix = "_Slice"
     self.paddedForRegistrationVolumeNamePostfix = "_ForRegistration"
@@ -37,13 +46,47 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
 
     # Declare member variables (mainly for documentation)
     self.lastAddedRoiNode = None
-    self.calibrationCoefficients = [0,0,0,0] # Calibration coefficients [a,b,c,n] in calibration function dose = a + b*OD + c*OD^n
+    self.calibrationBatchDirectoryPath = None # Directory of the last saved or loaded calibration batch, where the measurement cache is persisted
+    self.calibrationBatchFileSignatureSampleSize = 1024 * 1024 # Number of bytes hashed at the start and at the end of the batch image files to detect changes
+    self.calibrationCoefficients = [0,0,0,0] # Parameters of the calibration model, [a,b,c,n] in dose = a + b*OD + c*OD^n for the power model
+    self.calibrationModelName = PowerCalibrationModel.name # Calibration model of the current calibration function (see CalibrationModels)
+    self.calibrationModelSelection = PowerCalibrationModel.name # Calibration model to fit, or automaticCalibrationModelSelection to use the best ranked one
+    self.calibrationModelSelectionCriterion = 'AIC' # Ranking of the calibration models: 'AIC' (Akaike information criterion) or 'CrossValidation' (leave-one-out dose error)
+    self.calibrationModelRanking = [] # [model name, score, parameters, leave-one-out root mean square dose error] for each model, best first
+    self.calibrationExponentBounds = [1.0, 4.0] # Search range of exponent n in the calibration function
+    self.calibrationExponentTolerance = 0.0001 # Absolute tolerance of the exponent optimization
+    self.calibrationExponentCoarseGridSize = 31 # Number of exponents evaluated to find the basin of the minimum before refinement
+    self.calibrationExponentGridSearch = False # Evaluate exponents on a fixed 0.001 grid instead of the bounded optimization
+    self.calibrationExponentOptimizationIterations = 0
+    self.numberOfCalibrationBootstrapResamples = 2000 # Resamples for estimating the calibration uncertainty (0 to disable)
+    self.numberOfCalibrationUncertaintyThreads = min(os.cpu_count() or 1, 8) # Number of threads computing the bootstrap resamples in parallel (1 to disable)
+    self.calibrationUncertainty = None # Bootstrap and leave-one-out uncertainty of the last calibration fit
+    self.numberOfRoiMeasurementThreads = min(os.cpu_count() or 1, 8) # Number of threads measuring calibration films in parallel (1 to disable)
+    self.useAutomaticCalibrationRoi = False # Detect the largest uniform region on each calibration film instead of using the shared ROI
+    self.automaticRoiNoiseWindowSize = 5 # Window size (pixels) for estimating the pixel noise of the films
+    self.automaticRoiUniformityTolerance = 1.5 # Maximum standard deviation of a uniform region relative to the pixel noise
+    self.automaticRoiMinimumSize = 5 # Minimum size (pixels) of the automatically detected ROI
+    self.automaticRoiMinimumOpticalDensity = 0.01 # Minimum optical density of the ROI detected on exposed calibration films relative to the flood field
     self.experimentalFloodFieldVolumeNode = None
     self.experimentalFilmVolumeNode = None
     self.experimentalFilmPixelSpacing = None
     self.experimentalFilmSliceOrientation = ''
     self.experimentalFilmSlicePosition = 0
     self.calculatedDoseDoubleArrayGy = None
+    self.experimentalFilmInvalidPixelCount = 0
+    self.useExperimentalFloodFieldMeanValue = False # Normalize with the mean of the flood field image, which allows lookup table conversion of integer films
+    self.pixelValueToDoseLookupTable = None # [calibration function and flood field value key, dose table, invalid entry table] of the last lookup table conversion
+    self.floodFieldLogarithmCache = OrderedDict() # Map from flood field volume node IDs to [image data modified time, log10 map in the dose scalar type], least recently used first
+    self.floodFieldLogarithmCacheMemoryLimit = 512 * 1024 * 1024 # Maximum memory (bytes) used by the cached flood field log maps
+    self.pixelValueLogarithmTables = {} # Map from (integer pixel type, table scalar type) to log10 tables of all pixel values
+    self.doseConversionTileNumberOfRows = 0 # Number of film rows converted to dose at a time, to bound memory use for large scans (0 to convert the whole film at once)
+    self.useMemoryMappedDoseBuffer = False # Write the calculated dose into a temporary file mapped to memory instead of RAM
+    self.numberOfDoseConversionThreads = min(os.cpu_count() or 1, 16) # Number of threads converting film row blocks to dose in parallel (1 to disable)
+    self.useSinglePrecisionPipeline = False # Carry the calibrated film, the padded volumes and the dose slice in float32 instead of float64
+    self.singlePrecisionAccuracyCheckNumberOfRows = 256 # Number of film rows converted in both precisions to check the float32 dose error (0 to disable)
+    self.singlePrecisionDoseTolerancePercent = 0.01 # Maximum float32 dose error relative to the maximum dose before a warning is logged
+    self.singlePrecisionDoseError = None # [maximum absolute dose error (Gy), maximum error relative to the maximum dose (%)] of the last calibrated film accuracy check
+    self.singlePrecisionPlanDoseSliceError = None # Same for the cast of the last cropped plan dose slice
     self.calibratedExperimentalFilmVolumeNode = None
     self.paddedCalibratedExperimentalFilmVolumeNode = None
     self.planDoseVolumeNode = None
@@ -53,11 +96,32 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
     self.experimentalFilmScanSetupAligmentTransformNode = None
     self.experimentalFilmToDoseSliceInitializationTransformNode = None
     self.experimentalFilmToDoseSliceTransformNode = None
+    self.usePhaseCorrelationInitialization = True # Initialize the film translation by phase correlation with the dose slice instead of only aligning the centers
+    self.useMomentInitialization = True # Initialize the film to dose slice registration by matching dose-weighted centroids and principal axes (phase correlation is used if it fails)
+    self.maximumMomentInitializationAngleDegrees = 30.0 # Larger principal axis rotations are not used for initialization, only the centroid alignment
+    self.useNativeFilmRegistration = True # Register film to dose slice in-plane with RigidRegistration2D instead of BRAINSFit on the padded volumes
+    self.useMultiStartFilmRegistration = False # Start the in-plane registration from several rotations and translations and keep the best result
+    self.numberOfFilmRegistrationThreads = min(os.cpu_count() or 1, 8) # Number of multi-start registrations run in parallel (1 to disable)
+    self.filmRegistration = None # RigidRegistration2D of the last in-plane registration
+    self.filmRegistrationPlaneToRASMatrix = None # Plane geometry of the last in-plane registration
+    self.filmToPlanDoseRegistrationJob = None # RegistrationJob of the last film to dose registration
+    self.filmToPlanDoseRegistrationCallbacks = [None, None] # Finished and progress callbacks of the running film to dose registration
+    self.filmToPlanDoseRegistrationTimeoutSeconds = 300 # Registration is cancelled if it takes longer (None for no limit)
+    self.orientationSearchGridSize = 128 # Approximate number of pixels along the images in the automatic scan setup orientation search
+    self.numberOfOrientationSearchThreads = min(os.cpu_count() or 1, 8) # Number of orientation candidates scored in parallel (1 to disable)
+    self.orientationSearch = None # OrientationSearch2D of the last automatic scan setup orientation search
+    self.alignmentMetricGridSize = 64 # Maximum number of dose slice pixels along each axis for the live alignment metric
+    self.alignmentMetric = None # AlignmentMetric2D with the cached images of the current cropped dose slice and calibrated film
     self.maskSegmentationNode = None
     self.maskSegmentID = None
     self.gammaVolumeNode = None
 
     self.measuredOpticalDensityToDoseMap = [] #TODO: Make it a real map (need to sort by key where it is created)
+    self.integralImageCache = OrderedDict() # Map from volume node IDs to [image data modified time, integral image] for live ROI statistics, least recently used first
+    self.integralImageCacheMemoryLimit = 1024 * 1024 * 1024 # Maximum memory (bytes) used by the cached integral images
+    self.calibrationMeasurementCache = CalibrationMeasurementCache() # ROI statistics keyed by image content fingerprint and extent
+    self.volumeContentFingerprints = {} # Map from volume node IDs to [image data modified time, content fingerprint]
+    self.sharedImageBuffers = SharedImageBufferRegistry() # Numpy arrays used by VTK image data without copying
 
   # ---------------------------------------------------------------------------
   def setAutoWindowLevelToAllDoseVolumes(self):
@@ -98,6 +162,9 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
       return "Flood field image is not selected!"
     if len(calibrationDoseToVolumeNodeMap) < 1:
       return "Empty calibration does to film map!"
+    for calibrationDose, calibrationVolumeNode in calibrationDoseToVolumeNodeMap.items():
+      if calibrationVolumeNode is None:
+        return "No film is selected for the calibration dose " + str(calibrationDose) + " cGy!"
 
     # Create temporary scene for saving
     calibrationBatchMrmlScene = slicer.vtkMRMLScene()
@@ -178,6 +245,10 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
       return "Failed to save calibration batch to " + calibrationBatchDirectoryPath
 
     calibrationBatchMrmlScene.Clear(1)
+
+    # Store the measurements of the batch images (if any) so that the batch can be re-fitted after loading
+    self.calibrationBatchDirectoryPath = calibrationBatchDirectoryPath
+    self.saveCalibrationMeasurementCache(calibrationBatchDirectoryPath, [floodFieldImageVolumeNode] + list(calibrationDoseToVolumeNodeMap.values()))
     return ""
 
   #------------------------------------------------------------------------------
@@ -231,82 +302,609 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
 
   #------------------------------------------------------------------------------
   def findBestFittingCalibrationFunctionCoefficients(self):
-    bestN = [] # Entries are [MSE, n, coefficients]
+    lowerBound = min(self.calibrationExponentBounds)
+    upperBound = max(self.calibrationExponentBounds)
+
+    if self.calibrationExponentGridSearch:
+      # Evaluate all exponents on a 0.001 grid at once (n = 1.000 to 4.000 by default)
+      exponents = numpy.arange(int(round(lowerBound*1000)), int(round(upperBound*1000))+1) / 1000.0
+      coefficients, meanSquaredErrors = self.findCoefficientsForExponents(exponents)
+      bestIndex = int(numpy.argmin(meanSquaredErrors))
+      bestExponent = float(exponents[bestIndex])
+      bestCoefficients = coefficients[bestIndex]
+      bestMeanSquaredError = meanSquaredErrors[bestIndex]
+      self.calibrationExponentOptimizationIterations = len(exponents)
+    else:
+      # Locate the basin of the global minimum on a coarse grid (in one batched solve), then refine the
+      # exponent with bounded Brent minimization of the least squares error profiled over a, b, and c
+      exponents = numpy.linspace(lowerBound, upperBound, self.calibrationExponentCoarseGridSize)
+      coefficients, meanSquaredErrors = self.findCoefficientsForExponents(exponents)
+      bestIndex = int(numpy.argmin(meanSquaredErrors))
+      bracketLowerBound = exponents[max(bestIndex-1, 0)]
+      bracketUpperBound = exponents[min(bestIndex+1, len(exponents)-1)]
+
+      def profiledMeanSquaredError(n):
+        return self.findCoefficientsForExponents([n])[1][0]
+      bestExponent, bestMeanSquaredError, self.calibrationExponentOptimizationIterations = self.minimizeBounded(
+        profiledMeanSquaredError, bracketLowerBound, bracketUpperBound, self.calibrationExponentTolerance)
+
+      # Keep the coarse grid point if the refinement did not improve on it (e.g. minimum at the bound)
+      if meanSquaredErrors[bestIndex] < bestMeanSquaredError:
+        bestExponent = float(exponents[bestIndex])
+        bestMeanSquaredError = meanSquaredErrors[bestIndex]
+      bestCoefficients = self.findCoefficientsForExponents([bestExponent])[0][0]
+
+    self.calibrationModelName = PowerCalibrationModel.name
+    self.calibrationCoefficients = [ float(bestCoefficients[0]), float(bestCoefficients[1]), float(bestCoefficients[2]), float(bestExponent) ]
+    logging.info("Optimized calibration function coefficients: A=" + str(round(self.calibrationCoefficients[0],4)) + ", B=" + str(round(self.calibrationCoefficients[1],4)) + ", C=" + str(round(self.calibrationCoefficients[2],4)) + ", N=" + str(round(self.calibrationCoefficients[3],4)) + " (mean square error: "  + str(round(bestMeanSquaredError,4)) + ", iterations: " + str(self.calibrationExponentOptimizationIterations) + ")")
+
+  #------------------------------------------------------------------------------
+  def getCalibrationModel(self, modelName=None):
+    """ Create calibration model by name (the model of the current calibration function by default)
+    """
+    calibrationModel = createCalibrationModel(modelName if modelName is not None else self.calibrationModelName)
+    if isinstance(calibrationModel, PowerCalibrationModel):
+      calibrationModel.exponentBounds = list(self.calibrationExponentBounds)
+    return calibrationModel
+
+  #------------------------------------------------------------------------------
+  def rankCalibrationModels(self):
+    """ Fit all registered calibration models to the measured calibration points and rank them by the selection criterion.
+        Each model is fitted to all points and to all leave-one-out subsets of the points in one batched pass.
+    """
+    opticalDensities, doses = self.getMeasuredOpticalDensityAndDoseArrays()
+    numberOfPoints = len(doses)
+    weights = numpy.vstack([numpy.ones(numberOfPoints), 1.0 - numpy.eye(numberOfPoints)])
+
+    self.calibrationModelRanking = []
+    for modelName in getCalibrationModelNames():
+      calibrationModel = self.getCalibrationModel(modelName)
+      numberOfParameters = calibrationModel.getNumberOfParameters()
+      if numberOfPoints <= numberOfParameters:
+        logging.info("Calibration: Model " + modelName + " is not ranked, it needs at least " + str(numberOfParameters+1) + " calibration points")
+        continue
+
+      parameters = calibrationModel.fit(opticalDensities, doses, weights)
+      with numpy.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        residuals = calibrationModel.evaluate(opticalDensities, parameters[0]) - doses
+        # Dose of each point predicted by the fit that left it out
+        leaveOneOutDoses = calibrationModel.evaluate(opticalDensities, [parameter[:,numpy.newaxis] for parameter in parameters[1:].T]).diagonal()
+        leaveOneOutRootMeanSquare = float(numpy.sqrt(numpy.mean((leaveOneOutDoses - doses) ** 2)))
+        meanSquaredError = float(numpy.mean(residuals * residuals))
+      if not numpy.isfinite(leaveOneOutRootMeanSquare):
+        leaveOneOutRootMeanSquare = float('inf')
+      if not numpy.isfinite(meanSquaredError):
+        continue
+
+      akaikeInformationCriterion = numberOfPoints * math.log(max(meanSquaredError, 1e-12)) + 2 * numberOfParameters
+      score = leaveOneOutRootMeanSquare if self.calibrationModelSelectionCriterion == 'CrossValidation' else akaikeInformationCriterion
+      self.calibrationModelRanking.append([modelName, score, parameters[0].tolist(), leaveOneOutRootMeanSquare])
+
+    self.calibrationModelRanking.sort(key=lambda rankingEntry: rankingEntry[1])
+    for modelName, score, parameters, leaveOneOutRootMeanSquare in self.calibrationModelRanking:
+      logging.info("Calibration: Model " + modelName + ": " + self.calibrationModelSelectionCriterion + " score " + str(round(score,4)) + ", leave-one-out dose error " + str(round(leaveOneOutRootMeanSquare,4)) + " cGy, " + self.getCalibrationModel(modelName).getFunctionString(parameters, 4))
+
+  #------------------------------------------------------------------------------
+  def fitCalibrationFunction(self):
+    """ Fit the selected calibration model, or the best ranked model if the selection is automatic.
+        The power model is refined by the exponent optimization of findBestFittingCalibrationFunctionCoefficients.
+    """
+    self.rankCalibrationModels()
+
+    modelName = self.calibrationModelSelection
+    if modelName == self.automaticCalibrationModelSelection:
+      modelName = self.calibrationModelRanking[0][0] if len(self.calibrationModelRanking) > 0 else PowerCalibrationModel.name
+      logging.info("Calibration: Model " + modelName + " selected by " + self.calibrationModelSelectionCriterion)
+
+    if modelName == PowerCalibrationModel.name:
+      self.findBestFittingCalibrationFunctionCoefficients()
+      return ""
+
+    rankedParameters = [parameters for rankedModelName, score, parameters, leaveOneOutRootMeanSquare in self.calibrationModelRanking if rankedModelName == modelName]
+    if len(rankedParameters) == 0:
+      return "Failed to fit calibration model " + modelName + " (not enough calibration points)"
+    self.calibrationModelName = modelName
+    self.calibrationCoefficients = [float(parameter) for parameter in rankedParameters[0]]
+    return ""
 
-    for n in range(1000,4001):
-      n/=1000.0
-      coeffs = self.findCoefficientsForExponent(n)
-      MSE = self.meanSquaredError(coeffs[0],coeffs[1],coeffs[2],n)
-      bestN.append([MSE, n, coeffs])
+  #------------------------------------------------------------------------------
+  def minimizeBounded(self, function, lowerBound, upperBound, tolerance, maximumNumberOfIterations=500):
+    """ Brent's method for minimizing a scalar function of one variable within the given bounds
+        (combination of golden-section search and successive parabolic interpolation).
+        Returns the location of the minimum, the function value there, and the number of iterations.
+    """
+    goldenRatioComplement = 0.5 * (3.0 - math.sqrt(5.0))
+    squareRootEpsilon = math.sqrt(numpy.finfo(numpy.float64).eps)
+    a = float(lowerBound)
+    b = float(upperBound)
+    x = w = v = a + goldenRatioComplement * (b - a)
+    fx = fw = fv = function(x)
+    d = e = 0.0
+
+    iterations = 0
+    while iterations < maximumNumberOfIterations:
+      middle = 0.5 * (a + b)
+      tolerance1 = squareRootEpsilon * abs(x) + tolerance / 3.0
+      tolerance2 = 2.0 * tolerance1
+      if abs(x - middle) <= tolerance2 - 0.5 * (b - a):
+        break
+      iterations += 1
+
+      useGoldenSection = True
+      if abs(e) > tolerance1:
+        # Try parabolic interpolation through x, w, v
+        r = (x - w) * (fx - fv)
+        q = (x - v) * (fx - fw)
+        p = (x - v) * q - (x - w) * r
+        q = 2.0 * (q - r)
+        if q > 0.0:
+          p = -p
+        q = abs(q)
+        previousE = e
+        e = d
+        if abs(p) < abs(0.5 * q * previousE) and p > q * (a - x) and p < q * (b - x):
+          d = p / q
+          u = x + d
+          # Do not evaluate too close to the bounds
+          if (u - a) < tolerance2 or (b - u) < tolerance2:
+            d = tolerance1 if middle >= x else -tolerance1
+          useGoldenSection = False
+      if useGoldenSection:
+        e = (b - x) if x < middle else (a - x)
+        d = goldenRatioComplement * e
+
+      # Do not evaluate closer than the tolerance to the current point
+      if abs(d) >= tolerance1:
+        u = x + d
+      else:
+        u = x + (tolerance1 if d > 0.0 else -tolerance1)
+      fu = function(u)
+
+      if fu <= fx:
+        if u < x:
+          b = x
+        else:
+          a = x
+        v, fv = w, fw
+        w, fw = x, fx
+        x, fx = u, fu
+      else:
+        if u < x:
+          a = u
+        else:
+          b = u
+        if fu <= fw or w == x:
+          v, fv = w, fw
+          w, fw = u, fu
+        elif fu <= fv or v == x or v == w:
+          v, fv = u, fu
+
+    return x, fx, iterations
 
-    bestN.sort(key=lambda bestNEntry: bestNEntry[0])
-    self.calibrationCoefficients = [ bestN[0][2][0], bestN[0][2][1], bestN[0][2][2], bestN[0][1] ]
-    logging.info("Optimized calibration function coefficients: A=" + str(round(self.calibrationCoefficients[0],4)) + ", B=" + str(round(self.calibrationCoefficients[1],4)) + ", C=" + str(round(self.calibrationCoefficients[2],4)) + ", N=" + str(round(self.calibrationCoefficients[3],4)) + " (mean square error: "  + str(round(bestN[0][0],4)) + ")")
+  #------------------------------------------------------------------------------
+  def getMeasuredOpticalDensityAndDoseArrays(self):
+    measuredOpticalDensityToDoseArray = numpy.array(self.measuredOpticalDensityToDoseMap, dtype=numpy.float64).reshape(-1,2)
+    return measuredOpticalDensityToDoseArray[:,0], measuredOpticalDensityToDoseArray[:,1]
 
   #------------------------------------------------------------------------------
   def findCoefficientsForExponent(self,n):
-    # Calculate matrix A
-    functionTermsMatrix = []
+    coefficients, meanSquaredErrors = self.findCoefficientsForExponents([n])
+    return coefficients[0].tolist()
 
-    # Optical density
-    for row in range(len(self.measuredOpticalDensityToDoseMap)):
-      opticalDensity = self.measuredOpticalDensityToDoseMap[row][0]
-      functionTermsMatrix.append([1,opticalDensity,opticalDensity**n])
-    functionTermsMatrix = numpy.asmatrix(functionTermsMatrix)
+  #------------------------------------------------------------------------------
+  def findCoefficientsForExponents(self, exponents):
+    """ Fit coefficients a, b, c of the calibration function for a batch of exponents n in one go.
+        The design matrices of all exponents are stacked and solved together.
+        Returns the coefficients (one [a,b,c] row per exponent) and the mean squared error for each exponent.
+    """
+    opticalDensities, doses = self.getMeasuredOpticalDensityAndDoseArrays()
+    exponents = numpy.atleast_1d(numpy.asarray(exponents, dtype=numpy.float64))
 
-    # Calculate constant term coefficient vector
-    functionDoseTerms = []
-    for row in range(len(self.measuredOpticalDensityToDoseMap)):
-      functionDoseTerms += [self.measuredOpticalDensityToDoseMap[row][1]]
-    functionConstantTerms = numpy.linalg.lstsq(functionTermsMatrix,functionDoseTerms,rcond=None)
-    coefficients = functionConstantTerms[0].tolist()
+    # Stacked design matrices with rows [1, OD, OD^n]
+    functionTermsMatrices = getFunctionTermsMatrices(opticalDensities, exponents)
 
-    for coefficientIndex in range(len(coefficients)):
-      coefficients[coefficientIndex] = coefficients[coefficientIndex]
+    # Minimum-norm least squares solution, with the same singular value cutoff as numpy.linalg.lstsq(rcond=None)
+    singularValueCutoff = numpy.finfo(numpy.float64).eps * max(len(opticalDensities), 3)
+    coefficients = numpy.matmul(numpy.linalg.pinv(functionTermsMatrices, singularValueCutoff), doses)
 
-    return coefficients
+    # Score all candidates
+    residuals = numpy.matmul(functionTermsMatrices, coefficients[:,:,numpy.newaxis])[:,:,0] - doses
+    meanSquaredErrors = numpy.mean(residuals * residuals, axis=1)
+
+    return coefficients, meanSquaredErrors
 
   #------------------------------------------------------------------------------
   def meanSquaredError(self, a, b, c, n):
-    sumMeanSquaredError = 0.0
-    for i in range(len(self.measuredOpticalDensityToDoseMap)):
-      calculatedDose = self.applyCalibrationFunctionOnSingleOpticalDensityValue(self.measuredOpticalDensityToDoseMap[i][0], a, b, c, n)
-      sumMeanSquaredError += ((self.measuredOpticalDensityToDoseMap[i][1] - calculatedDose)**2)
-    return sumMeanSquaredError / float(len(self.measuredOpticalDensityToDoseMap))
+    opticalDensities, doses = self.getMeasuredOpticalDensityAndDoseArrays()
+    residuals = doses - self.applyCalibrationFunctionOnSingleOpticalDensityValue(opticalDensities, a, b, c, n)
+    return float(numpy.mean(residuals * residuals))
 
   #------------------------------------------------------------------------------
   def applyCalibrationFunctionOnSingleOpticalDensityValue(self, OD, a, b, c, n):
     return a + b*OD + c*(OD**n)
 
+  #------------------------------------------------------------------------------
+  def getRoiExtentInVolume(self, volumeNode, roiNode):
+    """ Get the extent of the voxels whose centers are inside the ROI box, clamped to the image extent.
+        Along single-slice axes (such as the normal of a film image) it is enough if the ROI overlaps the slice.
+        Returns None if the ROI does not contain any voxel of the volume.
+    """
+    # ROI coordinate system to volume IJK
+    roiToVolumeParentMatrix = vtk.vtkMatrix4x4()
+    slicer.vtkMRMLTransformNode.GetMatrixTransformBetweenNodes(roiNode.GetParentTransformNode(), volumeNode.GetParentTransformNode(), roiToVolumeParentMatrix)
+    rasToIjkMatrix = vtk.vtkMatrix4x4()
+    volumeNode.GetRASToIJKMatrix(rasToIjkMatrix)
+    roiToIjkMatrix = vtk.vtkMatrix4x4()
+    vtk.vtkMatrix4x4.Multiply4x4(rasToIjkMatrix, roiToVolumeParentMatrix, roiToIjkMatrix)
+
+    # Bounding box of the ROI corners in IJK
+    center = [0]*3
+    roiNode.GetXYZ(center)
+    radius = [0]*3
+    roiNode.GetRadiusXYZ(radius)
+    cornersIjk = []
+    for cornerIndex in range(8):
+      corner = [center[axis] + (radius[axis] if (cornerIndex >> axis) & 1 else -radius[axis]) for axis in range(3)] + [1.0]
+      cornersIjk.append(roiToIjkMatrix.MultiplyPoint(corner)[0:3])
+    cornersIjk = numpy.array(cornersIjk)
+
+    imageExtent = volumeNode.GetImageData().GetExtent()
+    roiExtent = [0]*6
+    for axis in range(3):
+      voxelCenterMargin = 0.5 if imageExtent[2*axis] == imageExtent[2*axis+1] else 1e-6
+      roiExtent[2*axis] = max(int(math.ceil(cornersIjk[:,axis].min() - voxelCenterMargin)), imageExtent[2*axis])
+      roiExtent[2*axis+1] = min(int(math.floor(cornersIjk[:,axis].max() + voxelCenterMargin)), imageExtent[2*axis+1])
+      if roiExtent[2*axis] > roiExtent[2*axis+1]:
+        return None
+    return roiExtent
+
+  #------------------------------------------------------------------------------
+  def getVolumeArrayInExtent(self, volumeNode, extent):
+    """ Get a numpy view (no copy) of the voxels of the volume within the given extent, indexed [k,j,i]
+    """
+    imageData = volumeNode.GetImageData()
+    imageExtent = imageData.GetExtent()
+    dimensions = imageData.GetDimensions()
+    volumeArray = self.volumeToNumpyArray(volumeNode).reshape(dimensions[2], dimensions[1], dimensions[0])
+    return volumeArray[ extent[4]-imageExtent[4] : extent[5]-imageExtent[4]+1,
+                        extent[2]-imageExtent[2] : extent[3]-imageExtent[2]+1,
+                        extent[0]-imageExtent[0] : extent[1]-imageExtent[0]+1 ]
+
+  #------------------------------------------------------------------------------
+  def computeRoiStatistics(self, volumeNode, roiNode):
+    """ Compute statistics of the volume voxels within the ROI directly on the image buffer.
+        Returns [mean, standard deviation, number of voxels], or None if the ROI does not overlap the volume.
+    """
+    return self.computeRoiStatisticsForVolumes([volumeNode], roiNode)[0]
+
+  #------------------------------------------------------------------------------
+  def computeRoiStatisticsForVolumes(self, volumeNodes, roiNode):
+    """ Compute ROI statistics for multiple volumes, concurrently if more than one measurement thread is allowed.
+        Returns the statistics (see computeRoiStatistics) in the order of the input volumes.
+    """
+    roiExtents = [self.getRoiExtentInVolume(volumeNode, roiNode) for volumeNode in volumeNodes]
+    return self.computeExtentStatisticsForVolumes(volumeNodes, roiExtents)
+
+  #------------------------------------------------------------------------------
+  def computeExtentStatisticsForVolumes(self, volumeNodes, extents):
+    """ Compute statistics of each volume within its own extent (None if the extent is None).
+        See computeRoiStatisticsForVolumes
+    """
+    # Get the array views in the calling thread, because MRML and VTK objects must not be accessed from the workers
+    roiArrays = []
+    for volumeNode, roiExtent in zip(volumeNodes, extents):
+      roiArrays.append(self.getVolumeArrayInExtent(volumeNode, roiExtent) if roiExtent is not None else None)
+
+    # The numpy reductions release the GIL, so the films can be measured in parallel
+    if self.numberOfRoiMeasurementThreads > 1 and len(roiArrays) > 1:
+      from concurrent.futures import ThreadPoolExecutor
+      with ThreadPoolExecutor(max_workers=min(self.numberOfRoiMeasurementThreads, len(roiArrays))) as executor:
+        return list(executor.map(self.computeArrayStatistics, roiArrays))
+    return [self.computeArrayStatistics(roiArray) for roiArray in roiArrays]
+
+  #------------------------------------------------------------------------------
+  def computeArrayStatistics(self, array):
+    if array is None or array.size == 0:
+      return None
+    return [ float(array.mean(dtype=numpy.float64)), float(array.std(dtype=numpy.float64)), int(array.size) ]
+
+  #------------------------------------------------------------------------------
+  def computeCachedExtentStatisticsForVolumes(self, volumeNodes, extents):
+    """ Same as computeExtentStatisticsForVolumes, but only the images and extents that are not found in the
+        measurement cache are measured
+    """
+    statisticsList = [None] * len(volumeNodes)
+    indicesToMeasure = []
+    fingerprints = {}
+    for index, (volumeNode, extent) in enumerate(zip(volumeNodes, extents)):
+      if extent is None:
+        continue
+      fingerprints[index] = self.getVolumeContentFingerprint(volumeNode)
+      statisticsList[index] = self.calibrationMeasurementCache.getStatistics(fingerprints[index], extent)
+      if statisticsList[index] is None:
+        indicesToMeasure.append(index)
+
+    measuredStatisticsList = self.computeExtentStatisticsForVolumes(
+      [volumeNodes[index] for index in indicesToMeasure], [extents[index] for index in indicesToMeasure])
+    for index, statistics in zip(indicesToMeasure, measuredStatisticsList):
+      statisticsList[index] = statistics
+      if statistics is not None:
+        self.calibrationMeasurementCache.setStatistics(fingerprints[index], extents[index], statistics)
+
+    logging.info("Calibration: " + str(len(indicesToMeasure)) + " of " + str(len(fingerprints)) + " ROI measurements computed, the rest found in cache")
+    return statisticsList
+
+  #------------------------------------------------------------------------------
+  def getVolumeContentFingerprint(self, volumeNode):
+    """ Get a fingerprint of the image content (scalar type, extent, and voxel values).
+        It is memoized per volume node until the image data changes.
+    """
+    import hashlib
+    imageData = volumeNode.GetImageData()
+    memoEntry = self.volumeContentFingerprints.get(volumeNode.GetID())
+    if memoEntry is not None and memoEntry[0] == imageData.GetMTime():
+      return memoEntry[1]
+
+    volumeArray = numpy.ascontiguousarray(self.volumeToNumpyArray(volumeNode))
+    contentHash = hashlib.blake2b(digest_size=16)
+    contentHash.update(repr((volumeArray.dtype.str, volumeArray.shape, imageData.GetExtent())).encode())
+    contentHash.update(volumeArray.data)
+    fingerprint = contentHash.hexdigest()
+    self.volumeContentFingerprints[volumeNode.GetID()] = [imageData.GetMTime(), fingerprint]
+    return fingerprint
+
+  #------------------------------------------------------------------------------
+  def getCalibrationBatchImageFilePath(self, directoryPath, volumeNode):
+    """ Get the path of the image file of the volume within the calibration batch directory.
+        Returns None if the volume was not stored or loaded from a file, or it has been modified since.
+    """
+    storageNode = volumeNode.GetStorageNode()
+    if storageNode is None or not storageNode.GetFileName() or volumeNode.GetModifiedSinceRead():
+      return None
+    filePath = os.path.normpath(directoryPath + '/' + ntpath.basename(storageNode.GetFileName()))
+    if not os.path.isfile(filePath):
+      return None
+    return filePath
+
+  #------------------------------------------------------------------------------
+  def getImageFileSignature(self, filePath):
+    """ Get [size, modification time (ns), hash of the first and last bytes] of the image file,
+        which identifies the file content without reading all of it
+    """
+    import hashlib
+    fileStatus = os.stat(filePath)
+    sampleSize = self.calibrationBatchFileSignatureSampleSize
+    sampleHash = hashlib.blake2b(digest_size=16)
+    with open(filePath, 'rb') as file:
+      sampleHash.update(file.read(sampleSize))
+      if fileStatus.st_size > sampleSize:
+        file.seek(max(sampleSize, fileStatus.st_size - sampleSize))
+        sampleHash.update(file.read(sampleSize))
+    return [fileStatus.st_size, fileStatus.st_mtime_ns, sampleHash.hexdigest()]
+
+  #------------------------------------------------------------------------------
+  def saveCalibrationMeasurementCache(self, directoryPath, volumeNodes):
+    """ Save the cached measurements of those volumes that have their image file in the calibration batch directory.
+        The image fingerprints are stored with the file names and signatures (see getImageFileSignature),
+        so that they can be assigned to the loaded volumes without reading the pixels again.
+    """
+    imageFingerprints = {}
+    for volumeNode in volumeNodes:
+      if volumeNode is None or volumeNode.GetImageData() is None:
+        continue
+      filePath = self.getCalibrationBatchImageFilePath(directoryPath, volumeNode)
+      if filePath is not None:
+        imageFingerprints[ntpath.basename(filePath)] = [self.getImageFileSignature(filePath), self.getVolumeContentFingerprint(volumeNode)]
+    if len(imageFingerprints) == 0:
+      return
+
+    cacheFilePath = os.path.normpath(directoryPath + '/' + self.calibrationMeasurementCacheFileName)
+    try:
+      self.calibrationMeasurementCache.writeToFile(cacheFilePath, imageFingerprints)
+    except (IOError, OSError) as e:
+      logging.warning("Failed to save calibration measurements to " + cacheFilePath + ": " + str(e))
+
+  #------------------------------------------------------------------------------
+  def loadCalibrationMeasurementCache(self, directoryPath, volumeNodes):
+    """ Load the measurements saved in the calibration batch directory and assign the stored fingerprints
+        to the volumes loaded from the batch image files, if the files have not changed since the measurements were saved
+    """
+    cacheFilePath = os.path.normpath(directoryPath + '/' + self.calibrationMeasurementCacheFileName)
+    if not os.path.isfile(cacheFilePath):
+      return
+    try:
+      imageFingerprints = self.calibrationMeasurementCache.readFromFile(cacheFilePath)
+    except (IOError, OSError, ValueError, KeyError) as e:
+      logging.warning("Failed to load calibration measurements from " + cacheFilePath + ": " + str(e))
+      return
+
+    for volumeNode in volumeNodes:
+      if volumeNode is None or volumeNode.GetImageData() is None:
+        continue
+      filePath = self.getCalibrationBatchImageFilePath(directoryPath, volumeNode)
+      if filePath is None or ntpath.basename(filePath) not in imageFingerprints:
+        continue
+      fileSignature, fingerprint = imageFingerprints[ntpath.basename(filePath)]
+      if fileSignature == self.getImageFileSignature(filePath):
+        self.volumeContentFingerprints[volumeNode.GetID()] = [volumeNode.GetImageData().GetMTime(), fingerprint]
+      else:
+        logging.info("Calibration: Saved measurements are not used for " + filePath + ", because the file has changed")
+
+  #------------------------------------------------------------------------------
+  def getIntegralImage(self, volumeNode):
+    """ Get the cached integral image of the volume. It is rebuilt if the image data has changed since it was cached
+        (VTK modified times are globally unique, so replacing the image data object is detected as well).
+        Least recently used integral images are evicted to keep the cache within integralImageCacheMemoryLimit.
+    """
+    imageData = volumeNode.GetImageData()
+    cacheEntry = self.integralImageCache.get(volumeNode.GetID())
+    if cacheEntry is not None and cacheEntry[0] == imageData.GetMTime():
+      self.integralImageCache.move_to_end(volumeNode.GetID())
+      return cacheEntry[1]
+
+    dimensions = imageData.GetDimensions()
+    integralImage = IntegralImage(self.volumeToNumpyArray(volumeNode).reshape(dimensions[2], dimensions[1], dimensions[0]))
+    self.integralImageCache[volumeNode.GetID()] = [imageData.GetMTime(), integralImage]
+    self.integralImageCache.move_to_end(volumeNode.GetID())
+    self.evictIntegralImages()
+    return integralImage
+
+  #------------------------------------------------------------------------------
+  def evictIntegralImages(self):
+    """ Remove least recently used integral images until the cache fits in integralImageCacheMemoryLimit.
+        The most recently used one is kept even if it alone exceeds the limit.
+    """
+    while len(self.integralImageCache) > 1 and self.getIntegralImageCacheMemorySize() > self.integralImageCacheMemoryLimit:
+      self.integralImageCache.popitem(last=False)
+
+  #------------------------------------------------------------------------------
+  def getIntegralImageCacheMemorySize(self):
+    return sum(cacheEntry[1].getMemorySize() for cacheEntry in self.integralImageCache.values())
+
+  #------------------------------------------------------------------------------
+  def clearIntegralImageCache(self):
+    self.integralImageCache = OrderedDict()
+
+  #------------------------------------------------------------------------------
+  def removeCachedVolumeData(self, volumeNodeID):
+    """ Drop the integral image and flood field log map cached for a volume (e.g. when the node is removed from the scene)
+    """
+    self.integralImageCache.pop(volumeNodeID, None)
+    self.floodFieldLogarithmCache.pop(volumeNodeID, None)
+
+  #------------------------------------------------------------------------------
+  def computeRoiStatisticsFromIntegralImage(self, volumeNode, roiNode):
+    """ Constant-time version of computeRoiStatistics using the cached integral image of the volume
+    """
+    roiExtent = self.getRoiExtentInVolume(volumeNode, roiNode)
+    if roiExtent is None:
+      return None
+    imageExtent = volumeNode.GetImageData().GetExtent()
+    box = [ roiExtent[4]-imageExtent[4], roiExtent[5]-imageExtent[4],
+            roiExtent[2]-imageExtent[2], roiExtent[3]-imageExtent[2],
+            roiExtent[0]-imageExtent[0], roiExtent[1]-imageExtent[0] ]
+    return self.getIntegralImage(volumeNode).getBoxStatistics(box)
+
+  #------------------------------------------------------------------------------
+  def computeLiveCalibrationRoiStatistics(self, floodFieldImageVolumeNode, calibrationDoseToVolumeNodeMap, roiNode):
+    """ Measure the flood field and calibration images in the ROI using the integral images, for interactive feedback.
+        Returns a list of [dose (or flood field attribute value), mean, standard deviation, optical density] entries,
+        the flood field first and then the calibration films in dose order. Optical density is None where unavailable.
+    """
+    liveRoiStatistics = []
+    meanValueFloodField = None
+    if floodFieldImageVolumeNode is not None and floodFieldImageVolumeNode.GetImageData() is not None:
+      floodFieldRoiStatistics = self.computeRoiStatisticsFromIntegralImage(floodFieldImageVolumeNode, roiNode)
+      if floodFieldRoiStatistics is not None:
+        meanValueFloodField = floodFieldRoiStatistics[0]
+        liveRoiStatistics.append([self.floodFieldAttributeValue, floodFieldRoiStatistics[0], floodFieldRoiStatistics[1], None])
+
+    for currentCalibrationDose in sorted(calibrationDoseToVolumeNodeMap.keys()):
+      currentCalibrationVolumeNode = calibrationDoseToVolumeNodeMap[currentCalibrationDose]
+      if currentCalibrationVolumeNode is None or currentCalibrationVolumeNode.GetImageData() is None:
+        continue
+      calibrationRoiStatistics = self.computeRoiStatisticsFromIntegralImage(currentCalibrationVolumeNode, roiNode)
+      if calibrationRoiStatistics is None:
+        continue
+      opticalDensity = None
+      if meanValueFloodField is not None and meanValueFloodField > 0.0 and calibrationRoiStatistics[0] > 0.0:
+        opticalDensity = max(math.log10(meanValueFloodField/calibrationRoiStatistics[0]), 0.0)
+      liveRoiStatistics.append([currentCalibrationDose, calibrationRoiStatistics[0], calibrationRoiStatistics[1], opticalDensity])
+
+    return liveRoiStatistics
+
+  #------------------------------------------------------------------------------
+  def findUniformRoiExtentInVolume(self, volumeNode, searchExtent=None, meanRange=None):
+    """ Find the largest square region with uniform pixel values (no film edge, pen mark, or dose gradient)
+        using sliding window statistics on the integral image of the volume.
+        If a search extent is given (such as the extent of the user-defined ROI), then only that region is searched.
+        If a mean range is given, then only regions with mean pixel value strictly within it are accepted.
+        Regions saturated at the limits of integer pixel types are never accepted.
+        Returns the extent of the detected region, or None if no uniform region is found.
+    """
+    integralImage = self.getIntegralImage(volumeNode)
+    imageExtent = volumeNode.GetImageData().GetExtent()
+    searchBox = None
+    if searchExtent is not None:
+      searchBox = [ searchExtent[2]-imageExtent[2], searchExtent[3]-imageExtent[2],
+                    searchExtent[0]-imageExtent[0], searchExtent[1]-imageExtent[0] ]
+
+    if meanRange is None:
+      meanRange = [-numpy.inf, numpy.inf]
+    scalarType = self.volumeToNumpyArray(volumeNode).dtype
+    if numpy.issubdtype(scalarType, numpy.integer):
+      meanRange = [max(meanRange[0], numpy.iinfo(scalarType).min), min(meanRange[1], numpy.iinfo(scalarType).max)]
+
+    noiseStandardDeviation = integralImage.estimateNoiseStandardDeviation(self.automaticRoiNoiseWindowSize, searchBox)
+    uniformBox = integralImage.findLargestUniformWindow(
+      self.automaticRoiUniformityTolerance * noiseStandardDeviation, self.automaticRoiMinimumSize, searchBox, meanRange)
+    if uniformBox is None:
+      return None
+
+    return [ uniformBox[4]+imageExtent[0], uniformBox[5]+imageExtent[0],
+             uniformBox[2]+imageExtent[2], uniformBox[3]+imageExtent[2],
+             uniformBox[0]+imageExtent[4], uniformBox[1]+imageExtent[4] ]
+
+  #------------------------------------------------------------------------------
+  def findAutomaticCalibrationRoiExtents(self, floodFieldImageVolumeNode, calibrationDoses, calibrationVolumeNodes):
+    """ Detect uniform ROI on the flood field and on each calibration film, within the last added ROI if there is one.
+        The ROI on a calibration film must not be brighter than the flood field (which excludes the scanner background),
+        and on exposed films it must be darker by at least automaticRoiMinimumOpticalDensity.
+        Returns the extents of the flood field and then the calibration films (None where no region is found).
+    """
+    floodFieldRoiExtent = self.findUniformRoiExtentInCalibrationRoi(floodFieldImageVolumeNode)
+    roiExtents = [floodFieldRoiExtent]
+    if floodFieldRoiExtent is None:
+      return roiExtents + [None] * len(calibrationVolumeNodes)
+    meanValueFloodField = self.computeArrayStatistics(self.getVolumeArrayInExtent(floodFieldImageVolumeNode, floodFieldRoiExtent))[0]
+
+    for calibrationDose, volumeNode in zip(calibrationDoses, calibrationVolumeNodes):
+      minimumOpticalDensity = self.automaticRoiMinimumOpticalDensity if calibrationDose > 0 else -self.automaticRoiMinimumOpticalDensity
+      meanRange = [0.0, meanValueFloodField * 10.0 ** (-minimumOpticalDensity)]
+      roiExtents.append(self.findUniformRoiExtentInCalibrationRoi(volumeNode, meanRange))
+    return roiExtents
+
+  #------------------------------------------------------------------------------
+  def findUniformRoiExtentInCalibrationRoi(self, volumeNode, meanRange=None):
+    searchExtent = None
+    if self.lastAddedRoiNode is not None:
+      searchExtent = self.getRoiExtentInVolume(volumeNode, self.lastAddedRoiNode)
+      if searchExtent is None:
+        return None
+    roiExtent = self.findUniformRoiExtentInVolume(volumeNode, searchExtent, meanRange)
+    logging.info("Calibration: Uniform region detected in " + volumeNode.GetName() + ": extent " + str(roiExtent))
+    return roiExtent
+
   # ---------------------------------------------------------------------------
   def performCalibration(self, floodFieldImageVolumeNode, calibrationDoseToVolumeNodeMap):
-    if not hasattr(slicer.modules, 'cropvolume'):
-      return "Crop Volume module missing!"
-    if self.lastAddedRoiNode is None:
+    if self.lastAddedRoiNode is None and not self.useAutomaticCalibrationRoi:
       return 'No ROI created for calibration!'
     if floodFieldImageVolumeNode is None:
       return "Flood field image is not selected!"
     if len(calibrationDoseToVolumeNodeMap) < 1:
       return "Empty calibration does to film map!"
-
-    cropVolumeLogic = slicer.modules.cropvolume.logic()
-
-    # Crop flood field volume by defined ROI into a cloned volume node
-    shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-    floodFieldItemID = shNode.GetItemByDataNode(floodFieldImageVolumeNode)
-    floodFieldVolumeNodeNodeCloneName = floodFieldImageVolumeNode.GetName() + '_Cropped'
-    croppedFloodFieldItemID = slicer.vtkSlicerSubjectHierarchyModuleLogic.CloneSubjectHierarchyItem(shNode, floodFieldItemID, floodFieldVolumeNodeNodeCloneName)
-    croppedFloodFieldVolumeNode = shNode.GetItemDataNode(croppedFloodFieldItemID)
-    cropVolumeLogic.CropVoxelBased(self.lastAddedRoiNode, floodFieldImageVolumeNode, croppedFloodFieldVolumeNode)
-
-    # Measure average pixel value of the cropped flood field image
-    imageStat = vtk.vtkImageAccumulate()
-    imageStat.SetInputData(croppedFloodFieldVolumeNode.GetImageData())
-    imageStat.Update()
-    meanValueFloodField = imageStat.GetMean()[0]
+    for calibrationDose, calibrationVolumeNode in calibrationDoseToVolumeNodeMap.items():
+      if calibrationVolumeNode is None:
+        return "No film is selected for the calibration dose " + str(calibrationDose) + " cGy!"
+
+    # Measure the flood field and all calibration images in the ROI at once
+    calibrationDoses = sorted(calibrationDoseToVolumeNodeMap.keys())
+    volumeNodesToMeasure = [floodFieldImageVolumeNode] + [calibrationDoseToVolumeNodeMap[dose] for dose in calibrationDoses]
+    if self.useAutomaticCalibrationRoi:
+      roiExtents = self.findAutomaticCalibrationRoiExtents(floodFieldImageVolumeNode, calibrationDoses, volumeNodesToMeasure[1:])
+      for calibrationDose, roiExtent in zip([self.floodFieldAttributeValue] + calibrationDoses, roiExtents):
+        if roiExtent is None:
+          return "No uniform region found on the calibration image for " + str(calibrationDose) + (" cGy!" if calibrationDose != self.floodFieldAttributeValue else "!")
+    else:
+      roiExtents = [self.getRoiExtentInVolume(volumeNode, self.lastAddedRoiNode) for volumeNode in volumeNodesToMeasure]
+    roiStatisticsList = self.computeCachedExtentStatisticsForVolumes(volumeNodesToMeasure, roiExtents)
+
+    # Average pixel value of the flood field image in the ROI
+    floodFieldRoiStatistics = roiStatisticsList[0]
+    if floodFieldRoiStatistics is None:
+      return "Calibration ROI does not overlap the flood field image!"
+    meanValueFloodField = floodFieldRoiStatistics[0]
     logging.info("Calibration: Mean value for flood field image in ROI = " + str(round(meanValueFloodField,4)))
-    # Remove cropped volume
-    slicer.mrmlScene.RemoveNode(croppedFloodFieldVolumeNode)
 
     calibrationValues = [] # [entered dose, measured pixel value]   #TODO: Order is just reversed compared to measuredOpticalDensityToDoseMap
     calibrationValues.append([self.floodFieldAttributeValue, meanValueFloodField])
@@ -315,25 +913,12 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
 
     #TODO check this OD calculation
 
-    for currentCalibrationDose in calibrationDoseToVolumeNodeMap:
-      # Get current calibration image node
-      currentCalibrationVolumeNode = calibrationDoseToVolumeNodeMap[currentCalibrationDose]
-
-      # Crop calibration images by last defined ROI into a cloned volume node
-      calibrationFilmItemID = shNode.GetItemByDataNode(currentCalibrationVolumeNode)
-      calibrationVolumeNodeNodeCloneName = currentCalibrationVolumeNode.GetName() + '_Cropped'
-      croppedCalibrationFilmItemID = slicer.vtkSlicerSubjectHierarchyModuleLogic.CloneSubjectHierarchyItem(shNode, calibrationFilmItemID, calibrationVolumeNodeNodeCloneName)
-      croppedCalibrationFilmVolumeNode = shNode.GetItemDataNode(croppedCalibrationFilmItemID)
-      cropVolumeLogic.CropVoxelBased(self.lastAddedRoiNode, currentCalibrationVolumeNode, croppedCalibrationFilmVolumeNode)
-
-      # Measure average pixel value of the cropped calibration image
-      imageStat = vtk.vtkImageAccumulate()
-      imageStat.SetInputData(croppedCalibrationFilmVolumeNode.GetImageData())
-      imageStat.Update()
-      meanValue = imageStat.GetMean()[0]
+    for currentCalibrationDose, calibrationRoiStatistics in zip(calibrationDoses, roiStatisticsList[1:]):
+      # Average pixel value of the calibration image in the ROI
+      if calibrationRoiStatistics is None:
+        return "Calibration ROI does not overlap the calibration image for " + str(currentCalibrationDose) + " cGy!"
+      meanValue = calibrationRoiStatistics[0]
       calibrationValues.append([meanValue, currentCalibrationDose])
-      # Remove cropped volume
-      slicer.mrmlScene.RemoveNode(croppedCalibrationFilmVolumeNode)
 
       # Optical density calculation
       opticalDensity = math.log10(float(meanValueFloodField)/meanValue)
@@ -342,15 +927,41 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
 
       # x = optical density, y = dose
       self.measuredOpticalDensityToDoseMap.append([opticalDensity, currentCalibrationDose])
-      logging.info("Calibration: Mean value for calibration image for " + str(round(currentCalibrationDose,4)) + " cGy in ROI = " + str(round(meanValue,4)) + ", OD = " + str(round(opticalDensity,4)))
+      logging.info("Calibration: Mean value for calibration image for " + str(round(currentCalibrationDose,4)) + " cGy in ROI = " + str(round(meanValue,4)) + " (standard deviation " + str(round(calibrationRoiStatistics[1],4)) + ", " + str(calibrationRoiStatistics[2]) + " pixels), OD = " + str(round(opticalDensity,4)))
 
     self.measuredOpticalDensityToDoseMap.sort(key=lambda doseODPair: doseODPair[1])
 
     # Perform calibration of OD to dose
-    self.findBestFittingCalibrationFunctionCoefficients()
+    message = self.fitCalibrationFunction()
+    if message != "":
+      return message
+    self.computeCalibrationUncertainty()
 
     return ""
 
+  #------------------------------------------------------------------------------
+  def computeCalibrationUncertainty(self):
+    """ Estimate confidence intervals of the calibration coefficients and the dose uncertainty band by bootstrap,
+        and the leave-one-out prediction errors of the calibration points
+    """
+    self.calibrationUncertainty = None
+    if self.numberOfCalibrationBootstrapResamples < 1 or self.calibrationModelName != PowerCalibrationModel.name:
+      return
+
+    opticalDensities, doses = self.getMeasuredOpticalDensityAndDoseArrays()
+    calibrationUncertainty = CalibrationUncertainty(opticalDensities, doses, self.calibrationExponentBounds)
+    calibrationUncertainty.numberOfResamples = self.numberOfCalibrationBootstrapResamples
+    calibrationUncertainty.numberOfThreads = self.numberOfCalibrationUncertaintyThreads
+
+    leaveOneOutResiduals, leaveOneOutRootMeanSquare = calibrationUncertainty.computeLeaveOneOutResiduals(self.calibrationCoefficients)
+    logging.info("Calibration: Leave-one-out dose errors (cGy): " + str([round(float(residual),2) for residual in leaveOneOutResiduals]) + ", root mean square: " + str(round(leaveOneOutRootMeanSquare,4)))
+
+    if calibrationUncertainty.computeBootstrapCoefficients(self.calibrationCoefficients) is not None:
+      confidenceIntervals = calibrationUncertainty.getCoefficientConfidenceIntervals()
+      logging.info("Calibration: " + str(int(calibrationUncertainty.confidenceLevel*100)) + "% confidence intervals from " + str(calibrationUncertainty.numberOfResamples) + " bootstrap resamples: "
+        + ", ".join([name + "=[" + str(round(interval[0],4)) + ", " + str(round(interval[1],4)) + "]" for name, interval in zip(['A','B','C','N'], confidenceIntervals)]))
+    self.calibrationUncertainty = calibrationUncertainty
+
   #------------------------------------------------------------------------------
   # Step 3
 
@@ -366,7 +977,10 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
 
     file = open(fileName, 'w')
     file.write('# Film dosimetry calibration function coefficients (' + strftime("%Y.%m.%d. %H:%M:%S", gmtime()) + ')\n')
-    file.write('# Coefficients in order: A, B, C, N\n')
+    # The model is only written for other than the power model, so that the files remain readable by earlier versions
+    if self.calibrationModelName != PowerCalibrationModel.name:
+      file.write('# Calibration model: ' + self.calibrationModelName + '\n')
+    file.write('# Coefficients in order: ' + ', '.join(self.getCalibrationModel().parameterNames) + '\n')
     for coefficient in self.calibrationCoefficients:
       file.write(str(coefficient) + '\n')
     file.close()
@@ -375,19 +989,34 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
   def loadCalibrationFunctionFromFile(self, filePath):
     file = open(filePath, 'r+')
     lines = file.readlines()
-    if len(lines) != 6:
+    file.close()
+
+    # Calibration model is stored in a comment line (power model if missing), coefficients in the non-comment lines
+    modelName = PowerCalibrationModel.name
+    calibrationModelLinePrefix = '# Calibration model:'
+    coefficientLines = []
+    for line in lines:
+      if line.startswith(calibrationModelLinePrefix):
+        modelName = line[len(calibrationModelLinePrefix):].strip()
+      elif not line.startswith('#') and line.strip() != '':
+        coefficientLines.append(line.strip())
+
+    calibrationModel = self.getCalibrationModel(modelName)
+    if calibrationModel is None or len(coefficientLines) != calibrationModel.getNumberOfParameters():
       message = "Invalid calibration coefficients file!"
       logging.error(message)
       qt.QMessageBox.critical(None, 'Error', message)
       return
 
     # Store coefficients
-    self.calibrationCoefficients[0] = float(lines[2].rstrip())
-    self.calibrationCoefficients[1] = float(lines[3].rstrip())
-    self.calibrationCoefficients[2] = float(lines[4].rstrip())
-    self.calibrationCoefficients[3] = float(lines[5].rstrip())
-
-    file.close()
+    try:
+      self.calibrationCoefficients = [float(coefficientLine) for coefficientLine in coefficientLines]
+    except ValueError:
+      message = "Invalid calibration coefficients file!"
+      logging.error(message)
+      qt.QMessageBox.critical(None, 'Error', message)
+      return
+    self.calibrationModelName = modelName
 
   #------------------------------------------------------------------------------
   def applyCalibrationOnExperimentalFilm(self):
@@ -399,7 +1028,8 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
       message = "Invalid experimental flood field image selection!"
       logging.error(message)
       return message
-    if self.calibrationCoefficients is None or len(self.calibrationCoefficients) != 4:
+    calibrationModel = self.getCalibrationModel()
+    if calibrationModel is None or self.calibrationCoefficients is None or len(self.calibrationCoefficients) != calibrationModel.getNumberOfParameters():
       message = "Invalid calibration function"
       logging.error(message)
       return message
@@ -408,12 +1038,14 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
 
     # Perform calibration
     self.calculatedDoseDoubleArrayGy = self.calculateDoseFromExperimentalFilmImage(self.experimentalFilmVolumeNode, self.experimentalFloodFieldVolumeNode)
-
-    # Convert numpy array to VTK image data
-    calculatedDoseVolumeScalarsGy = numpy_support.numpy_to_vtk(self.calculatedDoseDoubleArrayGy,1)
-    calculatedDoseImageData = vtk.vtkImageData()
-    calculatedDoseImageData.GetPointData().SetScalars(calculatedDoseVolumeScalarsGy)
-    calculatedDoseImageData.SetExtent(experimentalFilmExtent[0],experimentalFilmExtent[1], experimentalFilmExtent[2],experimentalFilmExtent[3], 0,0)
+    if self.calculatedDoseDoubleArrayGy is None:
+      return "Failed to calculate dose from experimental film"
+    if self.useSinglePrecisionPipeline and self.singlePrecisionAccuracyCheckNumberOfRows > 0:
+      self.checkSinglePrecisionDoseAccuracy(self.experimentalFilmVolumeNode, self.experimentalFloodFieldVolumeNode)
+
+    # Create image data sharing the dose buffer, so that the calibrated film is stored only once
+    calculatedDoseImageData = self.sharedImageBuffers.createImageData(self.calculatedDoseDoubleArrayGy,
+      [experimentalFilmExtent[0],experimentalFilmExtent[1], experimentalFilmExtent[2],experimentalFilmExtent[3], 0,0])
     # Create scalar volume node for calibrated film
     self.calibratedExperimentalFilmVolumeNode = slicer.vtkMRMLScalarVolumeNode()
     self.calibratedExperimentalFilmVolumeNode.SetName(self.experimentalFilmVolumeNode.GetName() + self.calibratedExperimentalFilmVolumeNamePostfix)
@@ -429,33 +1061,355 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
 
   #------------------------------------------------------------------------------
   def calculateDoseFromExperimentalFilmImage(self, experimentalFilmVolumeNode, experimentalFloodFieldVolumeNode):
-    #TODO: This should be done in SimpleITK
     experimentalFilmArray = self.volumeToNumpyArray(experimentalFilmVolumeNode)
     floodFieldArray = self.volumeToNumpyArray(experimentalFloodFieldVolumeNode)
-
-    if len(experimentalFilmArray) != len(floodFieldArray):
+    numberOfColumns = experimentalFilmVolumeNode.GetImageData().GetDimensions()[0]
+
+    floodFieldPixelValue = None
+    if self.useExperimentalFloodFieldMeanValue:
+      # Dose only depends on the film pixel value, so integer films can be converted using a lookup table
+      floodFieldPixelValue = float(floodFieldArray.mean(dtype=numpy.float64))
+      logging.info("Calibration: Mean value of experimental flood field image = " + str(round(floodFieldPixelValue,4)))
+    elif len(experimentalFilmArray) != len(floodFieldArray):
       message = "Experimental and flood field images must be the same size! (Experimental: " + str(len(experimentalFilmArray)) + ", FloodField: " + str(len(floodFieldArray))
       logging.error(message)
       qt.QMessageBox.critical(None, 'Error', message)
       return
 
-    doseArray_cGy = numpy.zeros(len(floodFieldArray))
-    for index in range(len(experimentalFilmArray)):
-      opticalDensity = 0.0
-      try:
-        opticalDensity = math.log10(float(floodFieldArray[index])/experimentalFilmArray[index])
-      except:
-        logging.error('Failure when calculating optical density for experimental film image. Failing values: FloodField=' + str(floodFieldArray[index]) + ', PixelValue=' + str(experimentalFilmArray[index]))
-        opticalDensity = 0.0
-      if opticalDensity <= 0.0:
-        opticalDensity = 0.0
-      doseArray_cGy[index] = self.applyCalibrationFunctionOnSingleOpticalDensityValue(opticalDensity, self.calibrationCoefficients[0], self.calibrationCoefficients[1], self.calibrationCoefficients[2], self.calibrationCoefficients[3]) / 100.0
-      if doseArray_cGy[index] < 0.0:
-        doseArray_cGy[index] = 0.0
-      # if index%1000==0: # Debugging snippet
-        # print('DEBUG: ExpFilm=' + str(experimentalFilmArray[index]) + ', Flood=' + str(floodFieldArray[index]) + ', OD=' + str(opticalDensity) + ', Dose=' + str(doseArray_cGy[index]))
+    doseArrayGy, self.experimentalFilmInvalidPixelCount = self.calculateDoseFromFilmRows(
+      experimentalFilmArray, numberOfColumns, experimentalFloodFieldVolumeNode, floodFieldPixelValue)
+
+    if self.experimentalFilmInvalidPixelCount > 0:
+      logging.warning('Failed to calculate optical density for ' + str(self.experimentalFilmInvalidPixelCount) + ' of ' + str(len(experimentalFilmArray)) + ' experimental film pixels (zero or negative film or flood field value). Dose is set to zero for these pixels')
+
+    return doseArrayGy
+
+  #------------------------------------------------------------------------------
+  def calculateDoseFromFilmRows(self, experimentalFilmArray, numberOfColumns, experimentalFloodFieldVolumeNode, floodFieldPixelValue=None, rowIndices=None):
+    """ Convert the experimental film to dose (Gy) with the conversion selected by the current settings (lookup table,
+        threaded tiles with a scalar or streamed flood field, or the cached flood field log map) and the current scalar type.
+        If row indices are given, then only those film rows are converted.
+        Returns the dose array and the number of invalid pixels.
+    """
+    def selectRows(array):
+      return array if rowIndices is None else array.reshape(-1, numberOfColumns)[rowIndices].ravel()
+    experimentalFilmArray = selectRows(experimentalFilmArray)
+
+    # Preallocate the output if the film is converted in tiles or to a memory-mapped buffer, otherwise the
+    # dose array is allocated by the conversion itself
+    doseArrayGy = None
+    if self.doseConversionTileNumberOfRows > 0 or self.useMemoryMappedDoseBuffer:
+      doseArrayGy = self.allocateDoseArray(len(experimentalFilmArray))
+
+    if floodFieldPixelValue is not None and self.isLookupTableConversionSupported(experimentalFilmArray.dtype):
+      return self.calculateDoseFromPixelValueArrayUsingLookupTable(experimentalFilmArray, floodFieldPixelValue, doseArrayGy)
+    elif floodFieldPixelValue is not None:
+      return self.calculateDoseInTiles(experimentalFilmArray, numberOfColumns, doseArrayGy, floodFieldPixelValue=floodFieldPixelValue)
+    elif self.doseConversionTileNumberOfRows > 0:
+      # Streaming conversion computes the flood field logarithm tile by tile, so that no full-size map is allocated
+      floodFieldArray = selectRows(self.volumeToNumpyArray(experimentalFloodFieldVolumeNode))
+      return self.calculateDoseInTiles(experimentalFilmArray, numberOfColumns, doseArrayGy, floodFieldPixelValue=floodFieldArray)
+    else:
+      # The log map of the flood field is shared by all films scanned with it
+      floodFieldLogarithmArray = selectRows(self.getFloodFieldLogarithmArray(experimentalFloodFieldVolumeNode))
+      return self.calculateDoseInTiles(experimentalFilmArray, numberOfColumns, doseArrayGy, floodFieldLogarithmArray=floodFieldLogarithmArray)
+
+  #------------------------------------------------------------------------------
+  def allocateDoseArray(self, numberOfPixels):
+    """ Allocate the dose (Gy) output array, in a temporary memory-mapped file if requested.
+        The file is deleted by the operating system when the array is released.
+    """
+    if self.useMemoryMappedDoseBuffer:
+      import tempfile
+      doseBufferFile = tempfile.TemporaryFile(dir=slicer.app.temporaryPath, suffix='.dose')
+      return numpy.memmap(doseBufferFile, dtype=self.getDoseScalarType(), mode='w+', shape=(numberOfPixels,))
+    return numpy.empty(numberOfPixels, dtype=self.getDoseScalarType())
+
+  #------------------------------------------------------------------------------
+  def getDoseScalarType(self):
+    """ Scalar type of the optical density and dose arrays, float32 in single precision pipeline mode
+    """
+    return numpy.float32 if self.useSinglePrecisionPipeline else numpy.float64
+
+  #------------------------------------------------------------------------------
+  def castToDoseScalarType(self, array):
+    """ Convert array to float32 in single precision pipeline mode (without copying if it already is),
+        other arrays are returned as they are
+    """
+    if self.useSinglePrecisionPipeline:
+      return array.astype(numpy.float32, copy=False)
+    return array
+
+  #------------------------------------------------------------------------------
+  def checkSinglePrecisionDoseAccuracy(self, experimentalFilmVolumeNode, experimentalFloodFieldVolumeNode):
+    """ Compare the float32 dose against the exact float64 dose on singlePrecisionAccuracyCheckNumberOfRows evenly spaced
+        film rows, so that the check costs a fraction of the conversion. The float32 dose is computed by calculateDoseFromFilmRows,
+        so the check covers the same conversion path (lookup table, threaded tiles, or flood field log map) as the film.
+        The reference is computed from the raw film and flood field pixel values in float64, not through cached tables or maps.
+        Returns the maximum absolute dose error (Gy) and the maximum error relative to the maximum dose (%).
+    """
+    experimentalFilmArray = self.volumeToNumpyArray(experimentalFilmVolumeNode)
+    floodFieldArray = self.volumeToNumpyArray(experimentalFloodFieldVolumeNode)
+    numberOfColumns = max(experimentalFilmVolumeNode.GetImageData().GetDimensions()[0], 1)
+    numberOfRows = len(experimentalFilmArray) // numberOfColumns
+    rowIndices = numpy.unique(numpy.linspace(0, numberOfRows-1, min(self.singlePrecisionAccuracyCheckNumberOfRows, numberOfRows)).astype(int))
+    floodFieldPixelValue = None
+    if self.useExperimentalFloodFieldMeanValue:
+      floodFieldPixelValue = float(floodFieldArray.mean(dtype=numpy.float64))
+      referenceFloodFieldPixelValue = floodFieldPixelValue
+    else:
+      referenceFloodFieldPixelValue = floodFieldArray.reshape(-1, numberOfColumns)[rowIndices].ravel()
+
+    useSinglePrecisionPipeline = self.useSinglePrecisionPipeline
+    useMemoryMappedDoseBuffer = self.useMemoryMappedDoseBuffer
+    try:
+      self.useMemoryMappedDoseBuffer = False
+      self.useSinglePrecisionPipeline = False
+      doubleDoseArrayGy = self.calculateDoseFromPixelValueArray(experimentalFilmArray.reshape(-1, numberOfColumns)[rowIndices].ravel(), referenceFloodFieldPixelValue)[0]
+      self.useSinglePrecisionPipeline = True
+      singleDoseArrayGy = self.calculateDoseFromFilmRows(experimentalFilmArray, numberOfColumns, experimentalFloodFieldVolumeNode, floodFieldPixelValue, rowIndices)[0]
+    finally:
+      self.useSinglePrecisionPipeline = useSinglePrecisionPipeline
+      self.useMemoryMappedDoseBuffer = useMemoryMappedDoseBuffer
+
+    self.singlePrecisionDoseError = self.reportSinglePrecisionDoseError(
+      "calibrated film (" + str(len(rowIndices)) + " rows)", doubleDoseArrayGy, singleDoseArrayGy)
+    return self.singlePrecisionDoseError
+
+  #------------------------------------------------------------------------------
+  def reportSinglePrecisionDoseError(self, name, doubleDoseArrayGy, singleDoseArrayGy):
+    """ Log the maximum difference between the float64 and float32 dose, with a warning if it exceeds singlePrecisionDoseTolerancePercent.
+        Returns the maximum absolute dose error (Gy) and the maximum error relative to the maximum dose (%).
+    """
+    maximumDoseGy = float(doubleDoseArrayGy.max()) if doubleDoseArrayGy.size > 0 else 0.0
+    maximumDoseErrorGy = float(numpy.abs(singleDoseArrayGy.astype(numpy.float64) - doubleDoseArrayGy).max()) if doubleDoseArrayGy.size > 0 else 0.0
+    maximumRelativeDoseErrorPercent = 100.0 * maximumDoseErrorGy / maximumDoseGy if maximumDoseGy > 0.0 else 0.0
+
+    message = "Single precision dose error of " + name + ": maximum " + str(maximumDoseErrorGy) + " Gy (" + str(round(maximumRelativeDoseErrorPercent,6)) + "% of the maximum dose)"
+    if maximumRelativeDoseErrorPercent > self.singlePrecisionDoseTolerancePercent:
+      logging.warning(message + ", exceeds tolerance of " + str(self.singlePrecisionDoseTolerancePercent) + "%")
+    else:
+      logging.info(message)
+    return [maximumDoseErrorGy, maximumRelativeDoseErrorPercent]
+
+  #------------------------------------------------------------------------------
+  def calculateDoseInTiles(self, pixelValueArray, numberOfColumns, doseArrayGy=None, floodFieldPixelValue=None, floodFieldLogarithmArray=None):
+    """ Convert film pixel values to dose (Gy) in tiles of doseConversionTileNumberOfRows image rows, so that the
+        temporary arrays are only allocated for the tiles being processed. The tiles are converted in parallel
+        by numberOfDoseConversionThreads threads. If the tile size is zero, then the film is split evenly among the threads.
+        The flood field is given either as pixel values (scalar or array) or as log10 map (see getFloodFieldLogarithmArray).
+        The dose is written into doseArrayGy if given, otherwise a new array is returned.
+        Returns the dose array and the number of invalid pixels.
+    """
+    numberOfPixels = len(pixelValueArray)
+    numberOfThreads = max(self.numberOfDoseConversionThreads, 1)
+    numberOfRows = max(numberOfPixels // max(numberOfColumns, 1), 1)
+    if self.doseConversionTileNumberOfRows > 0:
+      tileNumberOfRows = self.doseConversionTileNumberOfRows
+    else:
+      tileNumberOfRows = (numberOfRows + numberOfThreads - 1) // numberOfThreads
+    tileNumberOfPixels = max(tileNumberOfRows * numberOfColumns, 1)
+    tileStarts = list(range(0, numberOfPixels, tileNumberOfPixels))
+
+    # A single tile is returned without copying, multiple tiles are written into their part of the output
+    if doseArrayGy is None and len(tileStarts) > 1:
+      doseArrayGy = numpy.empty(numberOfPixels, dtype=self.getDoseScalarType())
+
+    def convertTile(tileStart):
+      tileEnd = min(tileStart + tileNumberOfPixels, numberOfPixels)
+      if floodFieldLogarithmArray is not None:
+        opticalDensityTile, invalidPixelMaskTile = self.calculateOpticalDensityArrayFromFloodFieldLogarithm(
+          pixelValueArray[tileStart:tileEnd], floodFieldLogarithmArray[tileStart:tileEnd])
+      else:
+        floodFieldTile = floodFieldPixelValue[tileStart:tileEnd] if numpy.ndim(floodFieldPixelValue) > 0 else floodFieldPixelValue
+        opticalDensityTile, invalidPixelMaskTile = self.calculateOpticalDensityArray(pixelValueArray[tileStart:tileEnd], floodFieldTile)
+      doseTileGy, invalidPixelMaskTile = self.calculateDoseFromOpticalDensityArray(opticalDensityTile, invalidPixelMaskTile)
+      if doseArrayGy is not None:
+        doseArrayGy[tileStart:tileEnd] = doseTileGy
+        doseTileGy = None
+      return int(numpy.count_nonzero(invalidPixelMaskTile)), doseTileGy
+
+    # Tiles are independent and write disjoint parts of the output, numpy releases the GIL in the array operations
+    if numberOfThreads > 1 and len(tileStarts) > 1:
+      from concurrent.futures import ThreadPoolExecutor
+      with ThreadPoolExecutor(max_workers=min(numberOfThreads, len(tileStarts))) as executor:
+        tileResults = list(executor.map(convertTile, tileStarts))
+    else:
+      tileResults = [convertTile(tileStart) for tileStart in tileStarts]
+
+    if doseArrayGy is None:
+      doseArrayGy = tileResults[0][1] if len(tileResults) > 0 else numpy.empty(0, dtype=self.getDoseScalarType())
+    return doseArrayGy, sum(numberOfInvalidPixels for numberOfInvalidPixels, doseTileGy in tileResults)
+
+  #------------------------------------------------------------------------------
+  def calculateDoseFromPixelValueArray(self, pixelValueArray, floodFieldPixelValue):
+    """ Convert film pixel values to dose (Gy) using the current calibration function, array at a time.
+        The flood field can be a single value or an array of the same size as the film.
+        Returns the dose array and the number of invalid pixels.
+    """
+    doseArrayGy, invalidPixelMask = self.calculateDoseAndInvalidPixelMaskFromPixelValueArray(pixelValueArray, floodFieldPixelValue)
+    return doseArrayGy, int(numpy.count_nonzero(invalidPixelMask))
+
+  #------------------------------------------------------------------------------
+  def calculateDoseAndInvalidPixelMaskFromPixelValueArray(self, pixelValueArray, floodFieldPixelValue):
+    """ See calculateDoseFromPixelValueArray. Returns the dose array and the mask of invalid pixels.
+    """
+    opticalDensityArray, invalidPixelMask = self.calculateOpticalDensityArray(pixelValueArray, floodFieldPixelValue)
+    return self.calculateDoseFromOpticalDensityArray(opticalDensityArray, invalidPixelMask)
+
+  #------------------------------------------------------------------------------
+  def calculateDoseFromOpticalDensityArray(self, opticalDensityArray, invalidPixelMask):
+    """ Convert optical densities to dose (Gy) in place using the current calibration function.
+        Pixels where the calibration function is undefined are added to the invalid pixel mask.
+        Dose of the invalid pixels is set to zero. Returns the dose array and the mask of invalid pixels.
+    """
+    calibrationModel = self.getCalibrationModel()
+    doseArrayGy = calibrationModel.evaluate(opticalDensityArray, self.calibrationCoefficients, out=opticalDensityArray)
+    if not calibrationModel.isDefinedEverywhere:
+      # Dose is undefined at the poles of the calibration function
+      invalidPixelMask |= numpy.logical_not(numpy.isfinite(doseArrayGy))
+    # Otherwise invalid pixels would get the dose of zero optical density
+    numpy.copyto(doseArrayGy, 0.0, where=invalidPixelMask)
+    doseArrayGy /= 100.0
+    numpy.maximum(doseArrayGy, 0.0, out=doseArrayGy)
+    return doseArrayGy, invalidPixelMask
+
+  #------------------------------------------------------------------------------
+  def calculateOpticalDensityArray(self, pixelValueArray, floodFieldPixelValue):
+    """ Calculate optical density OD = log10(floodField/pixel) for an array of pixel values.
+        Negative optical densities are clamped to zero. Pixels where either the film or the flood field
+        value is zero or negative are invalid, and their optical density is set to zero.
+        Returns the optical density array and the mask of invalid pixels.
+    """
+    pixelValueArray = numpy.asarray(pixelValueArray, dtype=self.getDoseScalarType())
+    floodFieldPixelValue = numpy.asarray(floodFieldPixelValue, dtype=self.getDoseScalarType())
+    validPixelMask = numpy.logical_and(pixelValueArray > 0.0, floodFieldPixelValue > 0.0)
+
+    opticalDensityArray = numpy.zeros(validPixelMask.shape, dtype=self.getDoseScalarType())
+    numpy.divide(floodFieldPixelValue, pixelValueArray, out=opticalDensityArray, where=validPixelMask)
+    numpy.log10(opticalDensityArray, out=opticalDensityArray, where=validPixelMask)
+    numpy.maximum(opticalDensityArray, 0.0, out=opticalDensityArray)
+
+    return opticalDensityArray, numpy.logical_not(validPixelMask)
+
+  #------------------------------------------------------------------------------
+  def calculateOpticalDensityArrayFromFloodFieldLogarithm(self, pixelValueArray, floodFieldLogarithmArray):
+    """ Same as calculateOpticalDensityArray, but using the precomputed log10 map of the flood field,
+        so that the optical density is log10(floodField) - log10(pixel).
+        The logarithm of 8 and 16 bit integer pixel values is taken from a table.
+    """
+    pixelValueArray = numpy.asarray(pixelValueArray)
+    pixelType = pixelValueArray.dtype
+    if numpy.issubdtype(pixelType, numpy.integer) and pixelType.itemsize <= 2:
+      opticalDensityArray = self.getPixelValueLogarithmTable(pixelType, self.getDoseScalarType())[pixelValueArray.view(numpy.dtype('u' + str(pixelType.itemsize)))]
+    else:
+      # Logarithm of invalid (zero or negative) pixels is NaN
+      opticalDensityArray = numpy.full(pixelValueArray.shape, numpy.nan, dtype=self.getDoseScalarType())
+      numpy.log10(pixelValueArray, out=opticalDensityArray, where=(pixelValueArray > 0), dtype=self.getDoseScalarType())
+    numpy.subtract(floodFieldLogarithmArray, opticalDensityArray, out=opticalDensityArray)
+
+    # Invalid film or flood field pixels result in NaN, fmax sets them to zero like the negative values
+    invalidPixelMask = numpy.isnan(opticalDensityArray)
+    numpy.fmax(opticalDensityArray, 0.0, out=opticalDensityArray)
+    return opticalDensityArray, invalidPixelMask
+
+  #------------------------------------------------------------------------------
+  def getPixelValueLogarithmTable(self, pixelType, scalarType=numpy.float64):
+    """ Get the table of log10 of every value of an 8 or 16 bit integer pixel type (NaN for zero or negative values),
+        indexed by the pixel values reinterpreted as unsigned integers
+    """
+    pixelType = numpy.dtype(pixelType)
+    scalarType = numpy.dtype(scalarType)
+    pixelValueLogarithmTable = self.pixelValueLogarithmTables.get((pixelType.str, scalarType.str))
+    if pixelValueLogarithmTable is None:
+      pixelValues = numpy.arange(2 ** (8 * pixelType.itemsize), dtype=numpy.dtype('u' + str(pixelType.itemsize))).view(pixelType)
+      pixelValueLogarithmTable = numpy.full(pixelValues.shape, numpy.nan, dtype=scalarType)
+      # Integer inputs would otherwise be evaluated in the float32 loop of the ufunc
+      numpy.log10(pixelValues, out=pixelValueLogarithmTable, where=(pixelValues > 0), dtype=scalarType)
+      self.pixelValueLogarithmTables[(pixelType.str, scalarType.str)] = pixelValueLogarithmTable
+    return pixelValueLogarithmTable
+
+  #------------------------------------------------------------------------------
+  def getFloodFieldLogarithmArray(self, floodFieldVolumeNode):
+    """ Get the cached log10 map of the flood field image (NaN for zero or negative pixels) in the dose scalar type,
+        so that the float64 dose is not limited by a float32 map. It is recomputed if the image data or the scalar
+        type has changed. Least recently used maps are evicted to keep the cache within floodFieldLogarithmCacheMemoryLimit.
+    """
+    imageData = floodFieldVolumeNode.GetImageData()
+    scalarType = numpy.dtype(self.getDoseScalarType())
+    cacheEntry = self.floodFieldLogarithmCache.get(floodFieldVolumeNode.GetID())
+    if cacheEntry is not None and cacheEntry[0] == imageData.GetMTime() and cacheEntry[1].dtype == scalarType:
+      self.floodFieldLogarithmCache.move_to_end(floodFieldVolumeNode.GetID())
+      return cacheEntry[1]
+
+    floodFieldArray = self.volumeToNumpyArray(floodFieldVolumeNode)
+    floodFieldLogarithmArray = numpy.full(floodFieldArray.shape, numpy.nan, dtype=scalarType)
+    numpy.log10(floodFieldArray, out=floodFieldLogarithmArray, where=(floodFieldArray > 0), dtype=scalarType)
+
+    self.floodFieldLogarithmCache[floodFieldVolumeNode.GetID()] = [imageData.GetMTime(), floodFieldLogarithmArray]
+    self.floodFieldLogarithmCache.move_to_end(floodFieldVolumeNode.GetID())
+    while len(self.floodFieldLogarithmCache) > 1 and self.getFloodFieldLogarithmCacheMemorySize() > self.floodFieldLogarithmCacheMemoryLimit:
+      self.floodFieldLogarithmCache.popitem(last=False)
+    logging.info("Flood field log map cached for " + floodFieldVolumeNode.GetName() + " (" + str(len(self.floodFieldLogarithmCache)) + " maps, " + str(self.getFloodFieldLogarithmCacheMemorySize() // (1024*1024)) + " MB)")
+    return floodFieldLogarithmArray
 
-    return doseArray_cGy
+  #------------------------------------------------------------------------------
+  def getFloodFieldLogarithmCacheMemorySize(self):
+    return sum(cacheEntry[1].nbytes for cacheEntry in self.floodFieldLogarithmCache.values())
+
+  #------------------------------------------------------------------------------
+  def clearFloodFieldLogarithmCache(self):
+    self.floodFieldLogarithmCache = OrderedDict()
+
+  #------------------------------------------------------------------------------
+  def getPixelValueToDoseLookupTable(self, pixelType, floodFieldPixelValue):
+    """ Get the table of dose (Gy) for every value of an 8 or 16 bit integer pixel type with a scalar flood field value,
+        and the table of invalid values. Tables are indexed by the pixel values reinterpreted as unsigned integers.
+        The tables are cached, and rebuilt when the calibration function or the flood field value changes.
+    """
+    pixelType = numpy.dtype(pixelType)
+    lookupTableKey = (self.calibrationModelName, tuple(self.calibrationCoefficients), float(floodFieldPixelValue), pixelType.str, numpy.dtype(self.getDoseScalarType()).str)
+    if self.pixelValueToDoseLookupTable is not None and self.pixelValueToDoseLookupTable[0] == lookupTableKey:
+      return self.pixelValueToDoseLookupTable[1], self.pixelValueToDoseLookupTable[2]
+
+    indexType = numpy.dtype('u' + str(pixelType.itemsize))
+    pixelValues = numpy.arange(2 ** (8 * pixelType.itemsize), dtype=indexType).view(pixelType)
+    doseTableGy, invalidValueTable = self.calculateDoseAndInvalidPixelMaskFromPixelValueArray(pixelValues, floodFieldPixelValue)
+    self.pixelValueToDoseLookupTable = [lookupTableKey, doseTableGy, invalidValueTable]
+    return doseTableGy, invalidValueTable
+
+  #------------------------------------------------------------------------------
+  def isLookupTableConversionSupported(self, pixelType):
+    pixelType = numpy.dtype(pixelType)
+    return numpy.issubdtype(pixelType, numpy.integer) and pixelType.itemsize <= 2
+
+  #------------------------------------------------------------------------------
+  def calculateDoseFromPixelValueArrayUsingLookupTable(self, pixelValueArray, floodFieldPixelValue, doseArrayGy=None):
+    """ Same as calculateDoseFromPixelValueArray for a scalar flood field value, but 8 and 16 bit integer images
+        are converted by indexing a lookup table instead of evaluating the calibration function for each pixel.
+        The dose is written into doseArrayGy if given, without temporary arrays.
+    """
+    pixelValueArray = numpy.asarray(pixelValueArray)
+    pixelType = pixelValueArray.dtype
+    if not self.isLookupTableConversionSupported(pixelType):
+      return self.calculateDoseInTiles(pixelValueArray.reshape(-1), pixelValueArray.size, doseArrayGy, floodFieldPixelValue=floodFieldPixelValue)
+
+    doseTableGy, invalidValueTable = self.getPixelValueToDoseLookupTable(pixelType, floodFieldPixelValue)
+    pixelIndices = pixelValueArray.view(numpy.dtype('u' + str(pixelType.itemsize)))
+    doseArrayGy = numpy.take(doseTableGy, pixelIndices, out=doseArrayGy)
+    numberOfInvalidPixels = 0
+    if invalidValueTable.any():
+      # Count invalid pixels from the histogram of the pixel values
+      pixelValueCounts = numpy.bincount(pixelIndices.ravel(), minlength=len(invalidValueTable))
+      numberOfInvalidPixels = int(pixelValueCounts[invalidValueTable].sum())
+    return doseArrayGy, numberOfInvalidPixels
+
+  #------------------------------------------------------------------------------
+  def evaluateCalibrationFunction(self, opticalDensities):
+    """ Calculate dose (cGy) for an array of optical densities using the current calibration function
+    """
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+      return self.getCalibrationModel().evaluate(numpy.asarray(opticalDensities, dtype=numpy.float64), self.calibrationCoefficients)
 
   #------------------------------------------------------------------------------
   def volumeToNumpyArray(self, currentVolume):
@@ -472,15 +1426,18 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
     if self.experimentalFilmPixelSpacing is None:
       return "Invalid mm/pixel resolution for the experimental film must be entered"
 
-    # Set spacing of the experimental film volume
+    if self.experimentalFilmSliceOrientation not in SLICE_ORIENTATION_FILM_AXES:
+      return "Invalid slice orientation: " + str(self.experimentalFilmSliceOrientation)
+
+    # Cropped dose slice is recreated
+    self.alignmentMetric = None
+
+    # Set spacing and orientation of the experimental film volume
     if self.calibratedExperimentalFilmVolumeNode is None:
       return "Unable to access calibrated experimental film"
-    if self.experimentalFilmSliceOrientation == AXIAL:
-      self.calibratedExperimentalFilmVolumeNode.SetSpacing(self.experimentalFilmPixelSpacing, self.experimentalFilmPixelSpacing, self.planDoseVolumeNode.GetSpacing()[0])
-    elif self.experimentalFilmSliceOrientation == CORONAL:
-      self.calibratedExperimentalFilmVolumeNode.SetSpacing(self.experimentalFilmPixelSpacing, self.planDoseVolumeNode.GetSpacing()[1], self.experimentalFilmPixelSpacing)
-    elif self.experimentalFilmSliceOrientation == SAGITTAL:
-      self.calibratedExperimentalFilmVolumeNode.SetSpacing(self.planDoseVolumeNode.GetSpacing()[2], self.experimentalFilmPixelSpacing, self.experimentalFilmPixelSpacing)
+    filmNormalAxis = SLICE_ORIENTATION_FILM_AXES[self.experimentalFilmSliceOrientation][2]
+    self.calibratedExperimentalFilmVolumeNode.SetSpacing(self.experimentalFilmPixelSpacing, self.experimentalFilmPixelSpacing, self.planDoseVolumeNode.GetSpacing()[filmNormalAxis])
+    self.orientExperimentalFilmVolumeToSlicePlane(self.calibratedExperimentalFilmVolumeNode)
 
     # Crop the dose volume to the specified slice in the specified orientation
     message = self.cropPlanDoseVolumeToSlice()
@@ -508,6 +1465,20 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
 
     return ''
 
+  #------------------------------------------------------------------------------
+  def orientExperimentalFilmVolumeToSlicePlane(self, volumeNode):
+    """ Place a film volume in the plane of the slice orientation by permuting the axes of the IJK to RAS direction
+        matrix of the experimental film. The image data keeps the axial memory layout (columns, rows, slices),
+        so no voxels are moved or copied.
+    """
+    experimentalFilmDirectionMatrix = vtk.vtkMatrix4x4()
+    self.experimentalFilmVolumeNode.GetIJKToRASDirectionMatrix(experimentalFilmDirectionMatrix)
+    directionMatrix = vtk.vtkMatrix4x4()
+    for filmAxis, experimentalFilmAxis in enumerate(SLICE_ORIENTATION_FILM_AXES[self.experimentalFilmSliceOrientation]):
+      for rasAxis in range(3):
+        directionMatrix.SetElement(rasAxis, filmAxis, experimentalFilmDirectionMatrix.GetElement(rasAxis, experimentalFilmAxis))
+    volumeNode.SetIJKToRASDirectionMatrix(directionMatrix)
+
   #------------------------------------------------------------------------------
   def cropPlanDoseVolumeToSlice(self):
     if self.croppedPlanDoseSliceVolumeNode is not None:
@@ -553,6 +1524,17 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
     self.croppedPlanDoseSliceVolumeNode = slicer.mrmlScene.GetNodeByID(cropVolumeParameterNode.GetOutputVolumeNodeID())
     croppedPlanDoseVolumeName = slicer.mrmlScene.GenerateUniqueName(self.planDoseVolumeNode.GetName() + self.croppedPlanDoseVolumeNamePostfix)
     self.croppedPlanDoseSliceVolumeNode.SetName(croppedPlanDoseVolumeName)
+    if self.useSinglePrecisionPipeline and self.croppedPlanDoseSliceVolumeNode.GetImageData().GetScalarType() != vtk.VTK_FLOAT:
+      # Resampled dose slice is compared with the calibrated film in the same precision
+      castFilter = vtk.vtkImageCast()
+      castFilter.SetInputData(self.croppedPlanDoseSliceVolumeNode.GetImageData())
+      castFilter.SetOutputScalarTypeToFloat()
+      castFilter.Update()
+      if self.singlePrecisionAccuracyCheckNumberOfRows > 0:
+        # The padded dose slice repeats the cast values, so this is the only rounding of the plan dose
+        self.singlePrecisionPlanDoseSliceError = self.reportSinglePrecisionDoseError(self.croppedPlanDoseSliceVolumeNode.GetName(),
+          self.volumeToNumpyArray(self.croppedPlanDoseSliceVolumeNode).astype(numpy.float64), numpy_support.vtk_to_numpy(castFilter.GetOutput().GetPointData().GetScalars()))
+      self.croppedPlanDoseSliceVolumeNode.SetAndObserveImageData(castFilter.GetOutput())
 
     # Delete ROI and parameter nodes (comment out only for debugging)
     slicer.mrmlScene.RemoveNode(roiNode)
@@ -571,96 +1553,31 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
       logging.error(message)
       return message
 
-    # Expand the calibrated image to multiple slices for registration
-    paddedCalculatedDoseVolumeArrayGy = numpy.tile(self.calculatedDoseDoubleArrayGy, self.numberOfSlicesToPad)
-
-    # Make film images have the orientation of the dose slice so that processing can be done on the same plane
+    # Film images keep their axial memory layout, the slice orientation is set by their direction matrix
+    # (see orientExperimentalFilmVolumeToSlicePlane). Only the padding repeats the slices, in their memory order,
+    # and the padded arrays are shared with the VTK image data (see SharedImageBufferRegistry)
     experimentalFilmExtent = self.experimentalFilmVolumeNode.GetImageData().GetExtent() # Axial volume, so extent elements 4 and 5 will be 0 and 1, respectively
-    croppedPlanDoseExtent = self.croppedPlanDoseSliceVolumeNode.GetImageData().GetExtent()
-    croppedDoseSliceDimensions = self.croppedPlanDoseSliceVolumeNode.GetImageData().GetDimensions()
-    message = ""
-    if self.experimentalFilmSliceOrientation == AXIAL:
-      if croppedPlanDoseExtent[4] == croppedPlanDoseExtent[5]:
-        # Pad cropped dose volume slice into multiple slices in coronal orientation
-        croppedPlanDoseArray = self.volumeToNumpyArray(self.croppedPlanDoseSliceVolumeNode)
-        paddedPlanDoseArray = numpy.tile(croppedPlanDoseArray, self.numberOfSlicesToPad)
-        paddedPlanDoseImageScalars = numpy_support.numpy_to_vtk(paddedPlanDoseArray, 1)
-        paddedPlanDoseImageDataExtent = [0,croppedDoseSliceDimensions[0]-1, 0,croppedDoseSliceDimensions[1]-1, 0,self.numberOfSlicesToPad-1]
-      else:
-        message = "Invalid cropped axial plan dose slice"
+    numberOfFilmRows = experimentalFilmExtent[3]-experimentalFilmExtent[2]+1
+    numberOfFilmColumns = experimentalFilmExtent[1]-experimentalFilmExtent[0]+1
 
-    elif self.experimentalFilmSliceOrientation == CORONAL:
-      if croppedPlanDoseExtent[2] != croppedPlanDoseExtent[3]:
-        message = "Invalid cropped coronal plan dose slice"
-      else:
-        # Rotate calibrated experimental film image data to coronal
-        coronalExperimentalFilmExtent = [experimentalFilmExtent[0],experimentalFilmExtent[1],0,0,experimentalFilmExtent[2],experimentalFilmExtent[3]]
-        calculatedDoseDoubleArrayGy3D = self.calculatedDoseDoubleArrayGy.reshape(1, experimentalFilmExtent[3]-experimentalFilmExtent[2]+1, experimentalFilmExtent[1]-experimentalFilmExtent[0]+1)
-        coronalCalculatedDoseDoubleArrayGy3D = numpy.swapaxes(calculatedDoseDoubleArrayGy3D,0,1)
-        coronalCalculatedDoseDoubleArrayGy = numpy.ravel(coronalCalculatedDoseDoubleArrayGy3D)
-        calibratedExperimentalFilmImageData = self.calibratedExperimentalFilmVolumeNode.GetImageData()
-        calibratedExperimentalFilmImageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(coronalCalculatedDoseDoubleArrayGy,1))
-        calibratedExperimentalFilmImageData.SetExtent(coronalExperimentalFilmExtent)
-        self.calibratedExperimentalFilmVolumeNode.SetAndObserveImageData(calibratedExperimentalFilmImageData)
-
-        # Rotate padded calibrated experimental film image data to coronal
-        paddedCoronalExperimentalFilmExtent = [experimentalFilmExtent[0],experimentalFilmExtent[1],0,self.numberOfSlicesToPad-1,experimentalFilmExtent[2],experimentalFilmExtent[3]]
-        paddedCalculatedDoseVolumeArrayGy3D = paddedCalculatedDoseVolumeArrayGy.reshape(self.numberOfSlicesToPad, experimentalFilmExtent[3]-experimentalFilmExtent[2]+1, experimentalFilmExtent[1]-experimentalFilmExtent[0]+1)
-        coronalPaddedCalculatedDoseVolumeArrayGy3D = numpy.swapaxes(paddedCalculatedDoseVolumeArrayGy3D,0,1)
-        coronalPaddedCalculatedDoseVolumeArrayGy = numpy.ravel(coronalPaddedCalculatedDoseVolumeArrayGy3D)
-        paddedCalibratedExperimentalFilmImageData = vtk.vtkImageData()
-        paddedCalibratedExperimentalFilmImageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(coronalPaddedCalculatedDoseVolumeArrayGy,1))
-        paddedCalibratedExperimentalFilmImageData.SetExtent(paddedCoronalExperimentalFilmExtent)
-
-        # Pad cropped dose volume slice into multiple slices in coronal orientation
-        self.croppedPlanDoseSliceVolumeNode.GetImageData().SetExtent(croppedPlanDoseExtent[0],croppedPlanDoseExtent[1], croppedPlanDoseExtent[4],croppedPlanDoseExtent[5], 0,0) # Set extent to axial so that padding works properly
-        croppedPlanDoseArray = self.volumeToNumpyArray(self.croppedPlanDoseSliceVolumeNode)
-        paddedPlanDoseArray = numpy.tile(croppedPlanDoseArray, self.numberOfSlicesToPad)
-        paddedPlanDoseArrayGy3D = paddedPlanDoseArray.reshape(self.numberOfSlicesToPad, croppedPlanDoseExtent[5]-croppedPlanDoseExtent[4]+1, croppedPlanDoseExtent[1]-croppedPlanDoseExtent[0]+1)
-        coronalPaddedPlanDoseArrayGy3D = numpy.swapaxes(paddedPlanDoseArrayGy3D,0,1)
-        coronalPaddedPlanDoseArrayGy = numpy.ravel(coronalPaddedPlanDoseArrayGy3D)
-        paddedPlanDoseImageScalars = numpy_support.numpy_to_vtk(coronalPaddedPlanDoseArrayGy, 1)
-        paddedPlanDoseImageDataExtent = [0,croppedDoseSliceDimensions[0]-1, 0,self.numberOfSlicesToPad-1, 0,croppedDoseSliceDimensions[2]-1]
-        self.croppedPlanDoseSliceVolumeNode.GetImageData().SetExtent(croppedPlanDoseExtent) # Restore extent for further processing
-
-    elif self.experimentalFilmSliceOrientation == SAGITTAL:
-      if croppedPlanDoseExtent[0] != croppedPlanDoseExtent[1]:
-        message = "Invalid cropped sagittal plan dose slice"
-      else:
-        # Rotate calibrated experimental film image data to sagittal
-        sagittalExperimentalFilmExtent = [0,0,experimentalFilmExtent[0],experimentalFilmExtent[1],experimentalFilmExtent[2],experimentalFilmExtent[3]]
-        calculatedDoseDoubleArrayGy3D = self.calculatedDoseDoubleArrayGy.reshape(1, experimentalFilmExtent[3]-experimentalFilmExtent[2]+1, experimentalFilmExtent[1]-experimentalFilmExtent[0]+1)
-        sagittalCalculatedDoseDoubleArrayGy3D = numpy.swapaxes(numpy.swapaxes(calculatedDoseDoubleArrayGy3D,0,1),1,2)
-        sagittalCalculatedDoseDoubleArrayGy = numpy.ravel(sagittalCalculatedDoseDoubleArrayGy3D)
-        calibratedExperimentalFilmImageData = self.calibratedExperimentalFilmVolumeNode.GetImageData()
-        calibratedExperimentalFilmImageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(sagittalCalculatedDoseDoubleArrayGy,1))
-        calibratedExperimentalFilmImageData.SetExtent(sagittalExperimentalFilmExtent)
-        self.calibratedExperimentalFilmVolumeNode.SetAndObserveImageData(calibratedExperimentalFilmImageData)
-
-        # Rotate padded calibrated experimental film image data to sagittal
-        paddedSagittalExperimentalFilmExtent = [0,self.numberOfSlicesToPad-1,experimentalFilmExtent[0],experimentalFilmExtent[1],experimentalFilmExtent[2],experimentalFilmExtent[3]]
-        paddedCalculatedDoseVolumeArrayGy3D = paddedCalculatedDoseVolumeArrayGy.reshape(self.numberOfSlicesToPad, experimentalFilmExtent[3]-experimentalFilmExtent[2]+1, experimentalFilmExtent[1]-experimentalFilmExtent[0]+1)
-        sagittalPaddedCalculatedDoseVolumeArrayGy3D = numpy.swapaxes(numpy.swapaxes(paddedCalculatedDoseVolumeArrayGy3D,0,1),1,2)
-        sagittalPaddedCalculatedDoseVolumeArrayGy = numpy.ravel(sagittalPaddedCalculatedDoseVolumeArrayGy3D)
-        paddedCalibratedExperimentalFilmImageData = vtk.vtkImageData()
-        paddedCalibratedExperimentalFilmImageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(sagittalPaddedCalculatedDoseVolumeArrayGy,1))
-        paddedCalibratedExperimentalFilmImageData.SetExtent(paddedSagittalExperimentalFilmExtent)
-
-        # Pad cropped dose volume slice into multiple slices in sagittal orientation
-        self.croppedPlanDoseSliceVolumeNode.GetImageData().SetExtent(croppedPlanDoseExtent[0],croppedPlanDoseExtent[1], croppedPlanDoseExtent[4],croppedPlanDoseExtent[5], 0,0) # Set extent to axial so that padding works properly
-        croppedPlanDoseArray = self.volumeToNumpyArray(self.croppedPlanDoseSliceVolumeNode)
-        paddedPlanDoseArray = numpy.tile(croppedPlanDoseArray, self.numberOfSlicesToPad)
-        paddedPlanDoseArrayGy3D = paddedPlanDoseArray.reshape(self.numberOfSlicesToPad, croppedPlanDoseExtent[5]-croppedPlanDoseExtent[4]+1, croppedPlanDoseExtent[3]-croppedPlanDoseExtent[2]+1)
-        sagittalPaddedPlanDoseArrayGy3D = numpy.swapaxes(numpy.swapaxes(paddedPlanDoseArrayGy3D,0,1),1,2)
-        sagittalPaddedPlanDoseArrayGy = numpy.ravel(sagittalPaddedPlanDoseArrayGy3D)
-        paddedPlanDoseImageScalars = numpy_support.numpy_to_vtk(sagittalPaddedPlanDoseArrayGy, 1)
-        paddedPlanDoseImageDataExtent = [0,self.numberOfSlicesToPad-1, 0,croppedDoseSliceDimensions[1]-1, 0,croppedDoseSliceDimensions[2]-1]
-        self.croppedPlanDoseSliceVolumeNode.GetImageData().SetExtent(croppedPlanDoseExtent) # Restore extent for further processing
-
-    if message != "":
+    croppedPlanDoseNormalAxis = self.getCroppedPlanDoseSliceNormalAxis()
+    croppedPlanDoseExtent = self.croppedPlanDoseSliceVolumeNode.GetImageData().GetExtent()
+    if croppedPlanDoseExtent[2*croppedPlanDoseNormalAxis] != croppedPlanDoseExtent[2*croppedPlanDoseNormalAxis+1]:
+      message = "Invalid cropped " + self.experimentalFilmSliceOrientation.lower() + " plan dose slice"
       logging.error(message)
       return message
 
+    # Pad calibrated film and cropped dose volume slice into multiple slices along their normal
+    paddedExperimentalFilmExtent = [experimentalFilmExtent[0],experimentalFilmExtent[1], experimentalFilmExtent[2],experimentalFilmExtent[3], 0,self.numberOfSlicesToPad-1]
+    paddedCalculatedDoseArrayGy = numpy.repeat(self.calculatedDoseDoubleArrayGy.reshape(1, numberOfFilmRows, numberOfFilmColumns), self.numberOfSlicesToPad, axis=0)
+    paddedCalibratedExperimentalFilmImageData = self.sharedImageBuffers.createImageData(paddedCalculatedDoseArrayGy, paddedExperimentalFilmExtent)
+
+    croppedDoseSliceDimensions = self.croppedPlanDoseSliceVolumeNode.GetImageData().GetDimensions()
+    croppedPlanDoseArray = self.castToDoseScalarType(self.volumeToNumpyArray(self.croppedPlanDoseSliceVolumeNode))
+    paddedPlanDoseArray = numpy.repeat(croppedPlanDoseArray.reshape(croppedDoseSliceDimensions[::-1]), self.numberOfSlicesToPad, axis=2-croppedPlanDoseNormalAxis)
+    paddedPlanDoseImageDataExtent = list(croppedPlanDoseExtent)
+    paddedPlanDoseImageDataExtent[2*croppedPlanDoseNormalAxis+1] = croppedPlanDoseExtent[2*croppedPlanDoseNormalAxis] + self.numberOfSlicesToPad-1
+
     # Create scalar volume node for padded calibrated film
     self.paddedCalibratedExperimentalFilmVolumeNode = slicer.vtkMRMLScalarVolumeNode()
     self.paddedCalibratedExperimentalFilmVolumeNode.SetAndObserveImageData(paddedCalibratedExperimentalFilmImageData)
@@ -675,10 +1592,8 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
     self.paddedCalibratedExperimentalFilmVolumeNode.CreateDefaultDisplayNodes()
     self.paddedCalibratedExperimentalFilmVolumeNode.GetDisplayNode().AutoWindowLevelOn()
 
-    # Set padded scalars into image data
-    paddedPlanDoseImageData = vtk.vtkImageData()
-    paddedPlanDoseImageData.GetPointData().SetScalars(paddedPlanDoseImageScalars)
-    paddedPlanDoseImageData.SetExtent(paddedPlanDoseImageDataExtent)
+    # Create image data sharing the padded dose buffer
+    paddedPlanDoseImageData = self.sharedImageBuffers.createImageData(paddedPlanDoseArray, paddedPlanDoseImageDataExtent)
     # Create padded dose slice volume
     self.paddedPlanDoseSliceVolumeNode = slicer.vtkMRMLScalarVolumeNode()
     paddedPlanDoseSliceVolumeName = slicer.mrmlScene.GenerateUniqueName(self.planDoseVolumeNode.GetName() + self.paddedForRegistrationVolumeNamePostfix)
@@ -724,8 +1639,80 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
     self.paddedCalibratedExperimentalFilmVolumeNode.SetAndObserveTransformNodeID(self.experimentalFilmPreAlignmentTransformNode.GetID())
     self.calibratedExperimentalFilmVolumeNode.SetAndObserveTransformNodeID(self.experimentalFilmPreAlignmentTransformNode.GetID())
 
+    # Refine the center alignment by the image content
+    if self.usePhaseCorrelationInitialization:
+      translationRAS = self.estimateFilmToPlanDoseSliceTranslation()
+      if translationRAS is not None:
+        # Translation is in world coordinates, the pre-alignment transform is applied before its parent transforms
+        worldToParentMatrix = vtk.vtkMatrix4x4()
+        if self.experimentalFilmPreAlignmentTransformNode.GetParentTransformNode() is not None:
+          self.experimentalFilmPreAlignmentTransformNode.GetParentTransformNode().GetMatrixTransformFromWorld(worldToParentMatrix)
+        experimentalFilmPreAlignmentTransform.Translate(numpy.dot(self.getNumpyArrayFromVtkMatrix(worldToParentMatrix)[0:3,0:3], translationRAS))
+        self.experimentalFilmPreAlignmentTransformNode.SetMatrixTransformToParent(experimentalFilmPreAlignmentTransform.GetMatrix())
+
     return ""
 
+  #------------------------------------------------------------------------------
+  def estimateFilmToPlanDoseSliceTranslation(self):
+    """ Estimate the in-plane translation that aligns the calibrated film (with its current transforms) to the cropped
+        dose slice, by phase correlation on a common grid (see RigidRegistration2D.estimateInitialTranslation).
+        The scan setup orientation of the film may not be known yet, so the estimate is only accepted if it
+        increases the normalized cross correlation of the images compared to the current (center) alignment.
+        Returns the translation in RAS, or None if it cannot be estimated or is rejected.
+    """
+    if self.croppedPlanDoseSliceVolumeNode is None or self.calibratedExperimentalFilmVolumeNode is None:
+      return None
+    fixedArray, fixedSpacing, planeToRASMatrix = self.getPlanDoseSlicePlaneGeometry()
+    if fixedArray is None:
+      return None
+    planeToMovingIndexMatrix = self.getPlaneToVolumeIndexMatrix(self.calibratedExperimentalFilmVolumeNode, planeToRASMatrix)
+    registration = RigidRegistration2D(fixedArray, fixedSpacing, self.getCalibratedExperimentalFilmArray2D(), planeToMovingIndexMatrix[0:2,:])
+    translation, peak = registration.estimateInitialTranslation()
+    logging.info("Phase correlation translation of film to dose slice: [" + str(round(translation[0],2)) + ", " + str(round(translation[1],2)) + "] mm (peak " + str(round(peak,4)) + ")")
+
+    fullResolutionLevel = registration.createFullResolutionLevel()
+    centerMetric = registration.computeMetric([0.0, 0.0, 0.0], fullResolutionLevel)
+    translatedMetric = registration.computeMetric([0.0, translation[0], translation[1]], fullResolutionLevel)
+    if translatedMetric is None or (centerMetric is not None and translatedMetric <= centerMetric):
+      logging.info("Phase correlation translation rejected, it does not improve the normalized cross correlation of the center alignment ("
+        + str(None if translatedMetric is None else round(translatedMetric,4)) + " vs. " + str(None if centerMetric is None else round(centerMetric,4)) + ")")
+      return None
+    return numpy.dot(planeToRASMatrix[0:3,0:2], translation)
+
+  #------------------------------------------------------------------------------
+  def estimateFilmToPlanDoseSliceMomentAlignment(self):
+    """ Estimate the in-plane transform that matches the dose-weighted centroid and principal axes of the calibrated film
+        (with its current transforms) to those of the cropped dose slice (see computeMomentAlignmentMatrix).
+        Principal axes are not reliable if the film only partially covers the dose distribution, so the transform is
+        only used if it increases the normalized cross correlation compared to the current alignment. The centroid
+        alignment without rotation is used instead if that correlates better.
+        Returns the transform as RAS matrix, or None if it cannot be estimated or does not improve the alignment.
+    """
+    if self.croppedPlanDoseSliceVolumeNode is None or self.calibratedExperimentalFilmVolumeNode is None:
+      return None
+    fixedArray, fixedSpacing, planeToRASMatrix = self.getPlanDoseSlicePlaneGeometry()
+    if fixedArray is None:
+      return None
+    planeToMovingIndexMatrix = self.getPlaneToVolumeIndexMatrix(self.calibratedExperimentalFilmVolumeNode, planeToRASMatrix)
+    movingArray = self.getCalibratedExperimentalFilmArray2D()
+    registration = RigidRegistration2D(fixedArray, fixedSpacing, movingArray, planeToMovingIndexMatrix[0:2,:])
+    fullResolutionLevel = registration.createFullResolutionLevel()
+    bestMetric = registration.computeMetric([0.0, 0.0, 0.0], fullResolutionLevel)
+    planeTransformMatrix = None
+    for maximumAngleDegrees in [self.maximumMomentInitializationAngleDegrees, 0.0]:
+      candidateMatrix = computeMomentAlignmentMatrix(fixedArray, fixedSpacing, movingArray, planeToMovingIndexMatrix[0:2,:], maximumAngleDegrees=maximumAngleDegrees)
+      if candidateMatrix is None:
+        return None
+      metric = registration.computeMetric(registration.getParametersFromPlaneTransformMatrix(candidateMatrix), fullResolutionLevel)
+      if metric is not None and (bestMetric is None or metric > bestMetric):
+        planeTransformMatrix, bestMetric = candidateMatrix, metric
+    if planeTransformMatrix is None:
+      logging.info("Moment alignment of film to dose slice rejected, it does not improve the normalized cross correlation of the current alignment")
+      return None
+    logging.info("Moment alignment of film to dose slice: rotation " + str(round(math.degrees(math.atan2(planeTransformMatrix[1,0], planeTransformMatrix[0,0])),2))
+      + " degrees, translation [" + str(round(planeTransformMatrix[0,2],2)) + ", " + str(round(planeTransformMatrix[1,2],2)) + "] mm, normalized cross correlation " + str(round(bestMetric,4)))
+    return self.createInPlaneRigidTransformMatrix(planeTransformMatrix, planeToRASMatrix)
+
   #------------------------------------------------------------------------------
   def initializeScanSetupAlignmentTransform(self):
     if self.experimentalFilmPreAlignmentTransformNode is None:
@@ -802,8 +1789,65 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
 
     self.experimentalFilmScanSetupAligmentTransformNode.Modified()
 
+  #------------------------------------------------------------------------------
+  def findScanSetupAlignment(self):
+    """ Find the flip and rotation of the calibrated film that best matches the cropped dose slice (see OrientationSearch2D),
+        and apply it on the scan setup alignment transform. Replaces finding the orientation with the rotate and flip buttons.
+    """
+    if self.experimentalFilmScanSetupAligmentTransformNode is None:
+      message = "Scan setup alignment transform has not been created"
+      logging.error(message)
+      return message
+    if self.croppedPlanDoseSliceVolumeNode is None or self.calibratedExperimentalFilmVolumeNode is None:
+      return "Film to plan dose registration has not been initialized"
+    fixedArray, fixedSpacing, planeToRASMatrix = self.getPlanDoseSlicePlaneGeometry()
+    if fixedArray is None:
+      return "Invalid cropped plan dose slice"
+    planeToMovingIndexMatrix = self.getPlaneToVolumeIndexMatrix(self.calibratedExperimentalFilmVolumeNode, planeToRASMatrix)
+
+    startTime = time.time()
+    self.orientationSearch = OrientationSearch2D(fixedArray, fixedSpacing, self.getCalibratedExperimentalFilmArray2D(), planeToMovingIndexMatrix[0:2,:], self.orientationSearchGridSize)
+    self.orientationSearch.numberOfThreads = max(self.numberOfOrientationSearchThreads, 1)
+    score, flip, angleDegrees, planeTransformMatrix = self.orientationSearch.search()
+    if score <= -1.0:
+      return "Film and plan dose slice do not overlap enough to find the orientation"
+    logging.info("Scan setup orientation search: " + ("flipped, " if flip else "") + "rotation " + str(round(angleDegrees,2)) + " degrees, normalized cross correlation "
+      + str(round(score,4)) + " (" + str(len(self.orientationSearch.results)) + " candidates, " + str(round(time.time()-startTime,3)) + " s)")
+
+    # The found transform is in world coordinates, the scan setup transform is applied before its parent transforms
+    worldTransformMatrix = self.getNumpyArrayFromVtkMatrix(self.createInPlaneRigidTransformMatrix(planeTransformMatrix, planeToRASMatrix))
+    worldToParentMatrix = vtk.vtkMatrix4x4()
+    if self.experimentalFilmScanSetupAligmentTransformNode.GetParentTransformNode() is not None:
+      self.experimentalFilmScanSetupAligmentTransformNode.GetParentTransformNode().GetMatrixTransformFromWorld(worldToParentMatrix)
+    worldToParent = self.getNumpyArrayFromVtkMatrix(worldToParentMatrix)
+    parentTransformMatrix = numpy.dot(worldToParent, numpy.dot(worldTransformMatrix, numpy.linalg.inv(worldToParent)))
+
+    experimentalFilmScanSetupAligmentTransform = self.experimentalFilmScanSetupAligmentTransformNode.GetTransformToParent()
+    experimentalFilmScanSetupAligmentTransform.PostMultiply()
+    experimentalFilmScanSetupAligmentTransform.Concatenate(parentTransformMatrix.ravel().tolist())
+    self.experimentalFilmScanSetupAligmentTransformNode.Modified()
+    return ""
+
   #------------------------------------------------------------------------------
   def registerExperimentalFilmToPlanDose(self):
+    """ Register the calibrated film to the plan dose slice and wait for the result (for scripted use)
+    """
+    message = self.startFilmToPlanDoseRegistration()
+    if message != '':
+      return message
+    return self.filmToPlanDoseRegistrationJob.wait()
+
+  #------------------------------------------------------------------------------
+  def startFilmToPlanDoseRegistration(self, onFinished=None, onProgress=None):
+    """ Start registering the calibrated film to the plan dose slice without blocking the application.
+        onFinished is called with the error message (empty on success) after the result has been applied,
+        onProgress with the fraction done. The registration can be stopped by cancelFilmToPlanDoseRegistration,
+        and is stopped after filmToPlanDoseRegistrationTimeoutSeconds.
+        Returns an error message if the registration could not be started (then onFinished is not called).
+    """
+    if self.isFilmToPlanDoseRegistrationRunning():
+      return "Film to plan dose registration is already running"
+
     # Setup initialization transform
     if self.experimentalFilmToDoseSliceInitializationTransformNode is None:
       self.experimentalFilmToDoseSliceInitializationTransformNode = slicer.vtkMRMLLinearTransformNode()
@@ -811,6 +1855,18 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
       slicer.mrmlScene.AddNode(self.experimentalFilmToDoseSliceInitializationTransformNode)
     preAlignmentInitializationTransformMatrix = vtk.vtkMatrix4x4()
     self.experimentalFilmPreAlignmentTransformNode.GetMatrixTransformToWorld(preAlignmentInitializationTransformMatrix)
+    momentAlignmentTransformMatrix = None
+    if self.useMomentInitialization:
+      momentAlignmentTransformMatrix = self.estimateFilmToPlanDoseSliceMomentAlignment()
+    if momentAlignmentTransformMatrix is not None:
+      # Start from the centroid and principal axis alignment after the scan setup alignment
+      vtk.vtkMatrix4x4.Multiply4x4(momentAlignmentTransformMatrix, preAlignmentInitializationTransformMatrix, preAlignmentInitializationTransformMatrix)
+    elif self.usePhaseCorrelationInitialization:
+      # Start from the translation found by phase correlation after the scan setup alignment
+      translationRAS = self.estimateFilmToPlanDoseSliceTranslation()
+      if translationRAS is not None:
+        for axis in range(3):
+          preAlignmentInitializationTransformMatrix.SetElement(axis, 3, preAlignmentInitializationTransformMatrix.GetElement(axis, 3) + translationRAS[axis])
     self.experimentalFilmToDoseSliceInitializationTransformNode.SetAndObserveMatrixTransformToParent(preAlignmentInitializationTransformMatrix)
 
     # Harden initialization transform on the film images. It is necessary to harden, and not
@@ -826,26 +1882,63 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
     slicer.mrmlScene.AddNode(self.experimentalFilmToDoseSliceTransformNode)
     self.experimentalFilmToDoseSliceTransformNode.SetName(self.experimentalFilmToDoseSliceTransformName)
 
-    # Perform registration with BRAINS
-    parametersRigid = {}
-    parametersRigid["fixedVolume"] = self.paddedPlanDoseSliceVolumeNode
-    parametersRigid["movingVolume"] = self.paddedCalibratedExperimentalFilmVolumeNode
-    parametersRigid["useRigid"] = True
-    parametersRigid["samplingPercentage"] = 0.05
-    parametersRigid["maximumStepLength"] = 15 # Start with long-range translations
-    parametersRigid["relaxationFactor"] = 0.8 # Relax quickly
-    parametersRigid["translationScale"] = 10000000 # Suppress rotation
-    parametersRigid["linearTransform"] = self.experimentalFilmToDoseSliceTransformNode.GetID()
+    self.filmToPlanDoseRegistrationCallbacks = [onFinished, onProgress]
+    def onJobFinished(job):
+      self.onFilmToPlanDoseRegistrationJobFinished(job)
+      if self.filmToPlanDoseRegistrationCallbacks[0] is not None:
+        self.filmToPlanDoseRegistrationCallbacks[0](job.message)
+    def onJobProgress(job):
+      if self.filmToPlanDoseRegistrationCallbacks[1] is not None:
+        self.filmToPlanDoseRegistrationCallbacks[1](job.progress)
+
+    # Start registration
+    if self.useNativeFilmRegistration:
+      self.filmToPlanDoseRegistrationJob = self.createInPlaneRegistrationJob()
+    else:
+      self.filmToPlanDoseRegistrationJob = self.createBrainsFitRegistrationJob()
+    if self.filmToPlanDoseRegistrationJob is None:
+      message = "Invalid cropped plan dose slice"
+    else:
+      self.filmToPlanDoseRegistrationJob.onFinished = onJobFinished
+      self.filmToPlanDoseRegistrationJob.onProgress = onJobProgress
+      self.filmToPlanDoseRegistrationJob.timeoutSeconds = self.filmToPlanDoseRegistrationTimeoutSeconds
+      message = self.filmToPlanDoseRegistrationJob.start()
+    if message != '':
+      logging.error(message)
+      self.revertFilmToPlanDoseRegistrationInitialization()
+    return message
 
-    # Runs the registration
-    cliBrainsFitRigidNode = slicer.cli.run(slicer.modules.brainsfit, None, parametersRigid)
-    waitCount = 0
-    while cliBrainsFitRigidNode.GetStatusString() != 'Completed' and waitCount < 20:
-      self.delayDisplay( "Register experimental film to dose using rigid registration... %d" % waitCount )
-      waitCount += 1
-    self.delayDisplay("Register experimental film to dose using rigid registration finished")
+  #------------------------------------------------------------------------------
+  def isFilmToPlanDoseRegistrationRunning(self):
+    return self.filmToPlanDoseRegistrationJob is not None and self.filmToPlanDoseRegistrationJob.isRunning()
 
-    logging.info("Registration status: " + cliBrainsFitRigidNode.GetStatusString())
+  #------------------------------------------------------------------------------
+  def cancelFilmToPlanDoseRegistration(self, notifyCaller=True):
+    """ Stop the running registration. A BRAINSFit registration only ends (and the films are restored) when the CLI
+        reports that it stopped. If notifyCaller is False, then the callbacks given to startFilmToPlanDoseRegistration
+        are not called any more (e.g. when their widgets are being destroyed).
+    """
+    if not notifyCaller:
+      self.filmToPlanDoseRegistrationCallbacks = [None, None]
+    if self.filmToPlanDoseRegistrationJob is not None:
+      self.filmToPlanDoseRegistrationJob.cancel()
+
+  #------------------------------------------------------------------------------
+  def onFilmToPlanDoseRegistrationJobFinished(self, job):
+    """ Apply the registration result on the calibrated film if the job completed with a valid result,
+        otherwise restore the films as they were before the registration
+    """
+    if job.status == RegistrationJob.Completed:
+      if self.useNativeFilmRegistration:
+        job.message = self.applyInPlaneRegistrationResult(job.result)
+      else:
+        logging.info("Registration status: " + job.cliNode.GetStatusString())
+      if job.message != '':
+        job.status = RegistrationJob.Failed
+    if job.status != RegistrationJob.Completed:
+      logging.error(job.message)
+      self.revertFilmToPlanDoseRegistrationInitialization()
+      return
 
     # Set transform to calibrated experimental film
     self.calibratedExperimentalFilmVolumeNode.SetAndObserveTransformNodeID(self.experimentalFilmToDoseSliceTransformNode.GetID())
@@ -861,8 +1954,179 @@ class FilmDosimetryAnalysisLogic(ScriptedLoadableModuleLogic):
 
     #TODO: Check AP translation and rotation parameters, warn if transform takes slice off-plane
 
+  #------------------------------------------------------------------------------
+  def revertFilmToPlanDoseRegistrationInitialization(self):
+    """ Undo hardening the initialization transform on the film images and remove the output transform,
+        so that the scan setup alignment can be changed and the registration started again
+    """
+    initializationToWorldMatrix = vtk.vtkMatrix4x4()
+    self.experimentalFilmToDoseSliceInitializationTransformNode.GetMatrixTransformToParent(initializationToWorldMatrix)
+    initializationToWorldMatrix.Invert()
+    self.experimentalFilmToDoseSliceInitializationTransformNode.SetMatrixTransformToParent(initializationToWorldMatrix)
+    for filmVolumeNode in [self.paddedCalibratedExperimentalFilmVolumeNode, self.calibratedExperimentalFilmVolumeNode]:
+      filmVolumeNode.SetAndObserveTransformNodeID(self.experimentalFilmToDoseSliceInitializationTransformNode.GetID())
+      slicer.vtkSlicerTransformLogic.hardenTransform(filmVolumeNode)
+      filmVolumeNode.SetAndObserveTransformNodeID(self.experimentalFilmPreAlignmentTransformNode.GetID())
+    initializationToWorldMatrix.Invert()
+    self.experimentalFilmToDoseSliceInitializationTransformNode.SetMatrixTransformToParent(initializationToWorldMatrix)
+
+    if self.experimentalFilmToDoseSliceTransformNode is not None:
+      slicer.mrmlScene.RemoveNode(self.experimentalFilmToDoseSliceTransformNode)
+      self.experimentalFilmToDoseSliceTransformNode = None
+
+  #------------------------------------------------------------------------------
+  def createBrainsFitRegistrationJob(self):
+    """ Job registering the padded film volume to the padded dose slice volume with BRAINSFit (3D rigid registration).
+        BRAINSFit writes the result into the film to dose slice transform when it completes.
+    """
+    parametersRigid = {}
+    parametersRigid["fixedVolume"] = self.paddedPlanDoseSliceVolumeNode
+    parametersRigid["movingVolume"] = self.paddedCalibratedExperimentalFilmVolumeNode
+    parametersRigid["useRigid"] = True
+    parametersRigid["samplingPercentage"] = 0.05
+    parametersRigid["maximumStepLength"] = 15 # Start with long-range translations
+    parametersRigid["relaxationFactor"] = 0.8 # Relax quickly
+    parametersRigid["translationScale"] = 10000000 # Suppress rotation
+    parametersRigid["linearTransform"] = self.experimentalFilmToDoseSliceTransformNode.GetID()
+
+    return CliRegistrationJob("BRAINSFit film to dose registration", slicer.modules.brainsfit, parametersRigid)
+
+  #------------------------------------------------------------------------------
+  def createInPlaneRegistrationJob(self):
+    """ Job registering the calibrated film to the cropped dose slice in their common plane with RigidRegistration2D
+        (or MultiStartRigidRegistration2D) in a background thread. The images are copied so that the thread does not access the scene.
+        Returns None if the cropped dose slice is invalid.
+    """
+    fixedArray, fixedSpacing, planeToRASMatrix = self.getPlanDoseSlicePlaneGeometry()
+    if fixedArray is None:
+      return None
+    movingArray = numpy.array(self.getCalibratedExperimentalFilmArray2D())
+    planeToMovingIndexMatrix = self.getPlaneToVolumeIndexMatrix(self.calibratedExperimentalFilmVolumeNode, planeToRASMatrix)
+    if self.useMultiStartFilmRegistration:
+      filmRegistration = MultiStartRigidRegistration2D(numpy.array(fixedArray), fixedSpacing, movingArray, planeToMovingIndexMatrix[0:2,:])
+      filmRegistration.numberOfThreads = max(self.numberOfFilmRegistrationThreads, 1)
+    else:
+      filmRegistration = RigidRegistration2D(numpy.array(fixedArray), fixedSpacing, movingArray, planeToMovingIndexMatrix[0:2,:])
+    self.filmRegistration = filmRegistration
+    self.filmRegistrationPlaneToRASMatrix = planeToRASMatrix
+
+    def register(progressCallback):
+      filmRegistration.progressCallback = progressCallback
+      filmRegistration.register()
+      return filmRegistration.getPlaneTransformMatrix()
+    return ThreadRegistrationJob("In-plane film to dose registration", register, cancelFunction=filmRegistration.cancel)
+
+  #------------------------------------------------------------------------------
+  def applyInPlaneRegistrationResult(self, planeTransformMatrix):
+    """ Set the in-plane rotation and translation found by RigidRegistration2D to the film to dose slice transform
+    """
+    if self.filmRegistration.normalizedCrossCorrelation is None or self.filmRegistration.normalizedCrossCorrelation <= -1.0:
+      return "Film and plan dose slice do not overlap enough for registration"
+    angleDegrees, translationU, translationV = self.filmRegistration.parameters
+    logging.info("In-plane registration: rotation " + str(round(angleDegrees,3)) + " degrees, translation [" + str(round(translationU,3)) + ", " + str(round(translationV,3))
+      + "] mm, normalized cross correlation " + str(round(self.filmRegistration.normalizedCrossCorrelation,4))
+      + " (" + str(self.filmRegistration.numberOfMetricEvaluations) + " evaluations)")
+    if self.useMultiStartFilmRegistration:
+      logging.info("Multi-start registration scores: " + ", ".join(str(round(score,4)) for score, parameters in self.filmRegistration.results))
+
+    self.experimentalFilmToDoseSliceTransformNode.SetMatrixTransformToParent(
+      self.createInPlaneRigidTransformMatrix(planeTransformMatrix, self.filmRegistrationPlaneToRASMatrix))
     return ""
 
+  #------------------------------------------------------------------------------
+  def computeFilmToPlanDoseAlignmentMetric(self):
+    """ Normalized cross correlation and mean absolute dose difference (Gy) of the calibrated film with its current
+        transforms and the cropped dose slice, on a cached downsampled grid (fast enough to follow interactive changes).
+        Returns None for both if they cannot be computed.
+    """
+    if self.croppedPlanDoseSliceVolumeNode is None or self.calibratedExperimentalFilmVolumeNode is None:
+      return None, None
+    fixedArray, fixedSpacing, planeToRASMatrix = self.getPlanDoseSlicePlaneGeometry()
+    if fixedArray is None:
+      return None, None
+    planeToMovingIndexMatrix = self.getPlaneToVolumeIndexMatrix(self.calibratedExperimentalFilmVolumeNode, planeToRASMatrix)
+    if self.alignmentMetric is None:
+      movingPixelSize = math.sqrt(abs(numpy.linalg.det(numpy.linalg.inv(planeToMovingIndexMatrix[0:2,0:2]))))
+      self.alignmentMetric = AlignmentMetric2D(fixedArray, fixedSpacing, self.getCalibratedExperimentalFilmArray2D(), movingPixelSize, self.alignmentMetricGridSize)
+    return self.alignmentMetric.compute(planeToMovingIndexMatrix)
+
+  #------------------------------------------------------------------------------
+  def getCroppedPlanDoseSliceNormalAxis(self):
+    """ IJK axis of the cropped dose slice that is closest to the patient axis normal to the film
+    """
+    croppedPlanDoseDirectionMatrix = vtk.vtkMatrix4x4()
+    self.croppedPlanDoseSliceVolumeNode.GetIJKToRASDirectionMatrix(croppedPlanDoseDirectionMatrix)
+    filmNormalAxis = SLICE_ORIENTATION_FILM_AXES[self.experimentalFilmSliceOrientation][2]
+    return max(range(3), key=lambda ijkAxis: abs(croppedPlanDoseDirectionMatrix.GetElement(filmNormalAxis, ijkAxis)))
+
+  #------------------------------------------------------------------------------
+  def getPlanDoseSlicePlaneGeometry(self):
+    """ In-plane array of the cropped dose slice [row, column], its pixel spacing, and the 4x3 matrix that maps
+        plane coordinates (u, v, 1) to RAS. Plane coordinates are in mm from the first pixel along the rows and columns.
+        Returns None for all three if the cropped volume is not a single slice.
+    """
+    normalAxis = self.getCroppedPlanDoseSliceNormalAxis()
+    imageData = self.croppedPlanDoseSliceVolumeNode.GetImageData()
+    extent = imageData.GetExtent()
+    if extent[2*normalAxis] != extent[2*normalAxis+1]:
+      return None, None, None
+    columnAxis, rowAxis = [axis for axis in range(3) if axis != normalAxis]
+    fixedArray = self.volumeToNumpyArray(self.croppedPlanDoseSliceVolumeNode).reshape(imageData.GetDimensions()[::-1])
+    fixedArray = numpy.squeeze(fixedArray, axis=2-normalAxis) # Remaining axes are [rowAxis, columnAxis]
+    spacing = self.croppedPlanDoseSliceVolumeNode.GetSpacing()
+
+    ijkToRASMatrix = vtk.vtkMatrix4x4()
+    self.croppedPlanDoseSliceVolumeNode.GetIJKToRASMatrix(ijkToRASMatrix)
+    ijkToRAS = self.getNumpyArrayFromVtkMatrix(ijkToRASMatrix)
+    firstPixelIJK = numpy.array([extent[0], extent[2], extent[4], 1.0])
+    planeToRASMatrix = numpy.column_stack([ijkToRAS[:,columnAxis] / spacing[columnAxis], ijkToRAS[:,rowAxis] / spacing[rowAxis], numpy.dot(ijkToRAS, firstPixelIJK)])
+    return fixedArray, [spacing[columnAxis], spacing[rowAxis]], planeToRASMatrix
+
+  #------------------------------------------------------------------------------
+  def getCalibratedExperimentalFilmArray2D(self):
+    """ Calibrated film dose as [row, column] array (film images keep the axial memory layout)
+    """
+    dimensions = self.calibratedExperimentalFilmVolumeNode.GetImageData().GetDimensions()
+    return self.volumeToNumpyArray(self.calibratedExperimentalFilmVolumeNode).reshape(dimensions[1], dimensions[0])
+
+  #------------------------------------------------------------------------------
+  def getPlaneToVolumeIndexMatrix(self, volumeNode, planeToRASMatrix):
+    """ 3x3 matrix mapping plane coordinates (u, v, 1) to the (i, j) indices of the volume relative to its extent start,
+        taking the parent transforms of the volume into account
+    """
+    worldToParentMatrix = vtk.vtkMatrix4x4()
+    if volumeNode.GetParentTransformNode() is not None:
+      volumeNode.GetParentTransformNode().GetMatrixTransformFromWorld(worldToParentMatrix)
+    rasToIJKMatrix = vtk.vtkMatrix4x4()
+    volumeNode.GetRASToIJKMatrix(rasToIJKMatrix)
+    worldToIJK = numpy.dot(self.getNumpyArrayFromVtkMatrix(rasToIJKMatrix), self.getNumpyArrayFromVtkMatrix(worldToParentMatrix))
+    planeToIJKMatrix = numpy.dot(worldToIJK, planeToRASMatrix)
+    extent = volumeNode.GetImageData().GetExtent()
+    planeToIndexMatrix = numpy.vstack([planeToIJKMatrix[0:2,:], [0.0, 0.0, 1.0]])
+    planeToIndexMatrix[0:2,2] -= [extent[0], extent[2]]
+    return planeToIndexMatrix
+
+  #------------------------------------------------------------------------------
+  def createInPlaneRigidTransformMatrix(self, planeTransformMatrix, planeToRASMatrix):
+    """ Convert a 3x3 rigid transform of plane coordinates (rotation, optionally with flip) to a 4x4 RAS transform matrix
+    """
+    planeAxesRAS = planeToRASMatrix[0:3,0:2]
+    planeOriginRAS = planeToRASMatrix[0:3,2]
+    # RAS = A p + o, so the transform is A T A^+ applied to (RAS - o), plus o. The normal component is kept.
+    planeAxesPseudoInverse = numpy.linalg.pinv(planeAxesRAS)
+    linearPart = numpy.identity(3) + numpy.dot(planeAxesRAS, numpy.dot(planeTransformMatrix[0:2,0:2] - numpy.identity(2), planeAxesPseudoInverse))
+    translationPart = planeOriginRAS + numpy.dot(planeAxesRAS, planeTransformMatrix[0:2,2]) - numpy.dot(linearPart, planeOriginRAS)
+    transformMatrix = vtk.vtkMatrix4x4()
+    for row in range(3):
+      for column in range(3):
+        transformMatrix.SetElement(row, column, linearPart[row,column])
+      transformMatrix.SetElement(row, 3, translationPart[row])
+    return transformMatrix
+
+  #------------------------------------------------------------------------------
+  def getNumpyArrayFromVtkMatrix(self, vtkMatrix):
+    return numpy.array([[vtkMatrix.GetElement(row, column) for column in range(4)] for row in range(4)])
+
 
 
 #
@@ -872,6 +2136,10 @@ AXIAL = 'Axial'
 CORONAL = 'Coronal'
 SAGITTAL = 'Sagittal'
 
+# Axes of the experimental film IJK (and of the patient) along which the film columns, rows and normal are
+# placed in each slice orientation
+SLICE_ORIENTATION_FILM_AXES = { AXIAL: [0,1,2], CORONAL: [0,2,1], SAGITTAL: [1,2,0] }
+
 
 
 # Notes:
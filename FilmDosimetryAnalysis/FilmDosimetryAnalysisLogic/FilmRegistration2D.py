@@ -0,0 +1,596 @@
+import math
+import threading
+import numpy
+
+#
+# RigidRegistration2D
+#
+class RigidRegistration2D():
+  """ In-plane rigid registration of a moving image (film) to a fixed image (dose slice).
+      Images are 2D arrays indexed [row, column]. The fixed image defines the plane coordinates (mm) by its pixel
+      spacing, and the moving image is sampled through an affine matrix that maps plane coordinates to its
+      pixel indices, so that the film does not need to be resampled to the dose grid beforehand.
+      The transform rotates the moving image around the center of the fixed image and translates it. It is found
+      by a pattern search maximizing normalized cross correlation, from the coarsest level of an image pyramid to
+      the finest. Only depends on numpy.
+  """
+
+  def __init__(self, fixedArray, fixedSpacing, movingArray, planeToMovingIndexMatrix):
+    # Fixed pixel [row, column] is at plane coordinates (column*fixedSpacing[0], row*fixedSpacing[1])
+    self.fixedArray = numpy.asarray(fixedArray, dtype=numpy.float64)
+    self.fixedSpacing = [float(fixedSpacing[0]), float(fixedSpacing[1])]
+    self.movingArray = numpy.asarray(movingArray, dtype=numpy.float64)
+    # 2x3 matrix mapping plane coordinates (u, v, 1) to moving pixel indices (column, row)
+    self.planeToMovingIndexMatrix = numpy.array(planeToMovingIndexMatrix, dtype=numpy.float64).reshape(2,3)
+
+    self.numberOfLevels = 4
+    self.minimumLevelSize = 8 # Minimum number of fixed pixels along both axes on the coarsest level
+    self.minimumOverlapFraction = 0.25 # Minimum fraction of the footprint of the moving image on the fixed grid that has to overlap the fixed image
+    self.minimumNumberOfOverlapPixels = 4 # Minimum number of overlapping fixed pixels regardless of the footprint
+    self.initialAngleStepDegrees = 2.0 # Pattern search step of the rotation on the coarsest level
+    self.minimumAngleStepDegrees = 0.01
+    self.minimumTranslationStepMm = 0.01
+    self.maximumNumberOfIterationsPerLevel = 500
+    self.maximumPhaseCorrelationGridSize = 512 # Maximum number of pixels of the common grid along each axis for phase correlation
+    self.progressCallback = None # Called with the fraction of the levels done (from the thread running the registration)
+    self.cancelRequested = False # Can be set from another thread to stop the optimization with the current parameters
+
+    self.center = [0.5 * (self.fixedArray.shape[1]-1) * self.fixedSpacing[0], 0.5 * (self.fixedArray.shape[0]-1) * self.fixedSpacing[1]]
+    self.parameters = [0.0, 0.0, 0.0] # Rotation angle (degrees), translation along the plane axes (mm)
+    self.normalizedCrossCorrelation = None
+    self.numberOfMetricEvaluations = 0
+    self.levels = None
+
+  def getPlaneTransformMatrix(self, parameters=None):
+    """ 3x3 homogeneous matrix mapping moving plane coordinates to fixed plane coordinates,
+        p = R(angle) (q - center) + center + translation
+    """
+    if parameters is None:
+      parameters = self.parameters
+    angle = math.radians(parameters[0])
+    rotation = numpy.array([[math.cos(angle), -math.sin(angle)], [math.sin(angle), math.cos(angle)]])
+    matrix = numpy.identity(3)
+    matrix[0:2,0:2] = rotation
+    matrix[0:2,2] = numpy.array(self.center) - numpy.dot(rotation, self.center) + numpy.array(parameters[1:3])
+    return matrix
+
+  def getParametersFromPlaneTransformMatrix(self, matrix):
+    """ Rotation angle (degrees) and translation (mm) of a rigid plane transform matrix (inverse of getPlaneTransformMatrix)
+    """
+    angleDegrees = math.degrees(math.atan2(matrix[1,0], matrix[0,0]))
+    rotationCenterOffset = numpy.array(self.center) - numpy.dot(self.getPlaneTransformMatrix([angleDegrees, 0.0, 0.0])[0:2,0:2], self.center)
+    translation = numpy.array(matrix[0:2,2]) - rotationCenterOffset
+    return [angleDegrees, float(translation[0]), float(translation[1])]
+
+  def cancel(self):
+    self.cancelRequested = True
+
+  def getMovingPixelSize(self):
+    return math.sqrt(abs(numpy.linalg.det(numpy.linalg.inv(self.planeToMovingIndexMatrix[:,0:2]))))
+
+  def estimateInitialTranslation(self):
+    """ Estimate the translation of the moving image by phase correlation, and set it as the initial translation.
+        Both images are resampled to a common grid covering both of them, so that the shift is found in one
+        transform regardless of the initial offset. Returns the translation (mm) and the phase correlation peak.
+    """
+    # Bounds of the fixed and the moving image in plane coordinates
+    fixedSize = [(self.fixedArray.shape[1]-1) * self.fixedSpacing[0], (self.fixedArray.shape[0]-1) * self.fixedSpacing[1]]
+    movingIndexToPlaneMatrix = numpy.linalg.inv(self.planeToMovingIndexMatrix[:,0:2])
+    movingCorners = numpy.array([[0, 0], [self.movingArray.shape[1]-1, 0], [0, self.movingArray.shape[0]-1], [self.movingArray.shape[1]-1, self.movingArray.shape[0]-1]], dtype=numpy.float64)
+    movingCornersPlane = numpy.dot(movingIndexToPlaneMatrix, (movingCorners - self.planeToMovingIndexMatrix[:,2]).T)
+    lowerBounds = numpy.minimum([0.0, 0.0], movingCornersPlane.min(axis=1))
+    upperBounds = numpy.maximum(fixedSize, movingCornersPlane.max(axis=1))
+    gridSpacing = max(min(self.fixedSpacing), (upperBounds - lowerBounds).max() / (self.maximumPhaseCorrelationGridSize-1))
+    gridSize = [int(math.ceil((upperBounds[axis] - lowerBounds[axis]) / gridSpacing)) + 1 for axis in range(2)]
+
+    # Resample both images, zero padded to twice the size so that the correlation does not wrap around
+    rows, columns = numpy.mgrid[0:gridSize[1], 0:gridSize[0]]
+    planeCoordinates = numpy.vstack([lowerBounds[0] + columns.ravel() * gridSpacing, lowerBounds[1] + rows.ravel() * gridSpacing])
+    fixedToIndexMatrix = numpy.array([[1.0/self.fixedSpacing[0], 0.0, 0.0], [0.0, 1.0/self.fixedSpacing[1], 0.0]])
+    fixedGridArray = resampleImageToPlaneGrid(self.fixedArray, fixedToIndexMatrix, planeCoordinates, gridSpacing / min(self.fixedSpacing))
+    movingGridArray = resampleImageToPlaneGrid(self.movingArray, self.planeToMovingIndexMatrix, planeCoordinates, gridSpacing / self.getMovingPixelSize())
+    paddedShape = (2*gridSize[1], 2*gridSize[0])
+    fixedPaddedArray = numpy.zeros(paddedShape)
+    fixedPaddedArray[0:gridSize[1], 0:gridSize[0]] = fixedGridArray.reshape(gridSize[1], gridSize[0])
+    movingPaddedArray = numpy.zeros(paddedShape)
+    movingPaddedArray[0:gridSize[1], 0:gridSize[0]] = movingGridArray.reshape(gridSize[1], gridSize[0])
+
+    (rowShift, columnShift), peak = computePhaseCorrelationShift(fixedPaddedArray, movingPaddedArray)
+    self.parameters = [self.parameters[0], columnShift * gridSpacing, rowShift * gridSpacing]
+    return self.parameters[1:3], peak
+
+  def createLevels(self):
+    """ Image pyramid from the finest to the coarsest level. Each level has the block averaged fixed image,
+        the plane coordinates of its pixels, and the moving image block averaged to a similar resolution
+        with the matching plane to index matrix.
+    """
+    movingPixelSize = self.getMovingPixelSize()
+    self.levels = []
+    for levelIndex in range(self.numberOfLevels):
+      shrinkFactor = 2 ** levelIndex
+      if levelIndex > 0 and min(self.fixedArray.shape) // shrinkFactor < self.minimumLevelSize:
+        break
+      fixedLevelArray = shrinkImage(self.fixedArray, shrinkFactor)
+      levelSpacing = [self.fixedSpacing[0] * shrinkFactor, self.fixedSpacing[1] * shrinkFactor]
+      # Plane coordinates of the centers of the averaged blocks
+      rows, columns = numpy.mgrid[0:fixedLevelArray.shape[0], 0:fixedLevelArray.shape[1]]
+      planeCoordinates = numpy.vstack([
+        (columns.ravel() + 0.5 * (shrinkFactor-1)/shrinkFactor) * levelSpacing[0],
+        (rows.ravel() + 0.5 * (shrinkFactor-1)/shrinkFactor) * levelSpacing[1] ])
+
+      movingShrinkFactor = max(int(min(levelSpacing) / movingPixelSize), 1)
+      planeToMovingIndexMatrix = self.planeToMovingIndexMatrix.copy()
+      planeToMovingIndexMatrix[:,2] -= 0.5 * (movingShrinkFactor-1)
+      planeToMovingIndexMatrix /= movingShrinkFactor
+
+      self.levels.append({
+        'fixedValues': fixedLevelArray.ravel(), 'planeCoordinates': planeCoordinates, 'spacing': min(levelSpacing),
+        'movingArray': shrinkImage(self.movingArray, movingShrinkFactor), 'planeToMovingIndexMatrix': planeToMovingIndexMatrix,
+        'footprintNumberOfPixels': getFootprintNumberOfPixels(fixedLevelArray.size, levelSpacing, self.movingArray.shape, movingPixelSize) })
+    return self.levels
+
+  def createFullResolutionLevel(self):
+    """ Level with the fixed image and the moving image at their original resolution, for scoring results
+    """
+    rows, columns = numpy.mgrid[0:self.fixedArray.shape[0], 0:self.fixedArray.shape[1]]
+    planeCoordinates = numpy.vstack([columns.ravel() * self.fixedSpacing[0], rows.ravel() * self.fixedSpacing[1]])
+    return { 'fixedValues': self.fixedArray.ravel(), 'planeCoordinates': planeCoordinates, 'spacing': min(self.fixedSpacing),
+      'movingArray': self.movingArray, 'planeToMovingIndexMatrix': self.planeToMovingIndexMatrix,
+      'footprintNumberOfPixels': getFootprintNumberOfPixels(self.fixedArray.size, self.fixedSpacing, self.movingArray.shape, self.getMovingPixelSize()) }
+
+  def computeMetric(self, parameters, level):
+    """ Normalized cross correlation of the fixed image and the transformed moving image on the fixed pixels
+        covered by the moving image. Returns None if the overlap is too small, relative to the footprint of the
+        moving image on the fixed grid (so that a film much smaller than the dose slice can be registered).
+    """
+    self.numberOfMetricEvaluations += 1
+    # Moving plane coordinates of the fixed pixels, then moving pixel indices
+    fixedToMovingMatrix = numpy.linalg.inv(self.getPlaneTransformMatrix(parameters))
+    planeToMovingIndexMatrix = numpy.dot(level['planeToMovingIndexMatrix'], fixedToMovingMatrix)
+    movingIndices = numpy.dot(planeToMovingIndexMatrix[:,0:2], level['planeCoordinates']) + planeToMovingIndexMatrix[:,2:3]
+    movingValues, validMask = sampleBilinear(level['movingArray'], movingIndices[0], movingIndices[1])
+
+    numberOfValidPixels = int(numpy.count_nonzero(validMask))
+    if numberOfValidPixels < max(self.minimumOverlapFraction * level['footprintNumberOfPixels'], self.minimumNumberOfOverlapPixels):
+      return None
+    return computeNormalizedCrossCorrelation(level['fixedValues'][validMask], movingValues[validMask])
+
+  def register(self, initialParameters=None):
+    """ Optimize the transform parameters level by level. Returns the rotation angle (degrees) and the translation (mm).
+    """
+    if initialParameters is not None:
+      self.parameters = [float(parameter) for parameter in initialParameters]
+    if self.levels is None:
+      self.createLevels()
+    self.numberOfMetricEvaluations = 0
+
+    for levelIndex in reversed(range(len(self.levels))):
+      level = self.levels[levelIndex]
+      isFinestLevel = (levelIndex == 0)
+      steps = [self.initialAngleStepDegrees / (2 ** (len(self.levels)-1-levelIndex)), level['spacing'], level['spacing']]
+      minimumSteps = [self.minimumAngleStepDegrees if isFinestLevel else 0.1,
+        self.minimumTranslationStepMm if isFinestLevel else 0.125 * level['spacing']]
+      minimumSteps.append(minimumSteps[1])
+      self.parameters, self.normalizedCrossCorrelation = self.optimizeLevel(level, self.parameters, steps, minimumSteps)
+      if self.cancelRequested:
+        break
+      if self.progressCallback is not None:
+        self.progressCallback(float(len(self.levels)-levelIndex) / len(self.levels))
+
+    return self.parameters
+
+  def optimizeLevel(self, level, parameters, steps, minimumSteps):
+    """ Compass search: move along each parameter axis while the metric improves, halve the steps when it does not
+    """
+    parameters = list(parameters)
+    bestMetric = self.computeMetric(parameters, level)
+    if bestMetric is None:
+      bestMetric = -1.0
+    steps = list(steps)
+    for iteration in range(self.maximumNumberOfIterationsPerLevel):
+      if self.cancelRequested:
+        break
+      improved = False
+      for parameterIndex in range(len(parameters)):
+        for direction in [1.0, -1.0]:
+          trialParameters = list(parameters)
+          trialParameters[parameterIndex] += direction * steps[parameterIndex]
+          metric = self.computeMetric(trialParameters, level)
+          if metric is not None and metric > bestMetric:
+            parameters, bestMetric, improved = trialParameters, metric, True
+            break
+      if not improved:
+        if all(step <= minimumStep for step, minimumStep in zip(steps, minimumSteps)):
+          break
+        steps = [max(0.5 * step, minimumStep) for step, minimumStep in zip(steps, minimumSteps)]
+    return parameters, bestMetric
+
+#
+# MultiStartRigidRegistration2D
+#
+class MultiStartRigidRegistration2D(RigidRegistration2D):
+  """ RigidRegistration2D started from several rotations and translations around the initial parameters, so that
+      symmetric dose distributions are less likely to end in a local optimum. The registrations share the image
+      pyramid and run in parallel threads. Each result is scored by normalized cross correlation with the moving
+      image at full resolution, and the best one is kept.
+  """
+
+  def __init__(self, fixedArray, fixedSpacing, movingArray, planeToMovingIndexMatrix):
+    RigidRegistration2D.__init__(self, fixedArray, fixedSpacing, movingArray, planeToMovingIndexMatrix)
+    self.startAngleOffsetsDegrees = [0.0, -8.0, 8.0]
+    self.startTranslationOffsetMm = 10.0 # Starts are also shifted by this along both plane axes in both directions (0 to disable)
+    self.numberOfThreads = 1
+    self.startRegistrations = []
+    self.results = [] # [score, parameters] for each start, best first
+
+  def getStartParameters(self):
+    offset = self.startTranslationOffsetMm
+    translationOffsets = [[0.0, 0.0]]
+    if offset > 0.0:
+      translationOffsets += [[offset, 0.0], [-offset, 0.0], [0.0, offset], [0.0, -offset]]
+    return [[self.parameters[0] + angleOffset, self.parameters[1] + translationOffset[0], self.parameters[2] + translationOffset[1]]
+      for angleOffset in self.startAngleOffsetsDegrees for translationOffset in translationOffsets]
+
+  def createStartRegistration(self):
+    registration = RigidRegistration2D(self.fixedArray, self.fixedSpacing, self.movingArray, self.planeToMovingIndexMatrix)
+    registration.numberOfLevels = self.numberOfLevels
+    registration.minimumOverlapFraction = self.minimumOverlapFraction
+    registration.minimumNumberOfOverlapPixels = self.minimumNumberOfOverlapPixels
+    registration.initialAngleStepDegrees = self.initialAngleStepDegrees
+    registration.minimumAngleStepDegrees = self.minimumAngleStepDegrees
+    registration.minimumTranslationStepMm = self.minimumTranslationStepMm
+    registration.maximumNumberOfIterationsPerLevel = self.maximumNumberOfIterationsPerLevel
+    registration.center = self.center
+    registration.levels = self.levels
+    return registration
+
+  def cancel(self):
+    RigidRegistration2D.cancel(self)
+    for registration in self.startRegistrations:
+      registration.cancel()
+
+  def register(self, initialParameters=None):
+    """ Register from all starts and keep the best result. Returns the rotation angle (degrees) and the translation (mm).
+    """
+    if initialParameters is not None:
+      self.parameters = [float(parameter) for parameter in initialParameters]
+    if self.levels is None:
+      self.createLevels()
+    fullResolutionLevel = self.createFullResolutionLevel()
+    startParameters = self.getStartParameters()
+    self.startRegistrations = [self.createStartRegistration() for start in startParameters]
+    numberOfFinishedStarts = [0]
+    progressLock = threading.Lock()
+
+    def registerFromStart(startIndex):
+      registration = self.startRegistrations[startIndex]
+      if self.cancelRequested:
+        return -1.0
+      registration.register(startParameters[startIndex])
+      score = registration.computeMetric(registration.parameters, fullResolutionLevel)
+      # Starts finish in worker threads, the count is updated and reported under the lock so that progress does not go back
+      with progressLock:
+        numberOfFinishedStarts[0] += 1
+        if self.progressCallback is not None:
+          self.progressCallback(float(numberOfFinishedStarts[0]) / len(startParameters))
+      return score if score is not None else -1.0
+
+    if self.numberOfThreads > 1 and len(startParameters) > 1:
+      from concurrent.futures import ThreadPoolExecutor
+      with ThreadPoolExecutor(max_workers=min(self.numberOfThreads, len(startParameters))) as executor:
+        scores = list(executor.map(registerFromStart, range(len(startParameters))))
+    else:
+      scores = [registerFromStart(startIndex) for startIndex in range(len(startParameters))]
+
+    self.results = sorted([[score, list(registration.parameters)] for score, registration in zip(scores, self.startRegistrations)],
+      key=lambda result: result[0], reverse=True)
+    self.numberOfMetricEvaluations = sum(registration.numberOfMetricEvaluations for registration in self.startRegistrations)
+    self.normalizedCrossCorrelation, self.parameters = self.results[0]
+    return self.parameters
+
+#
+# OrientationSearch2D
+#
+class OrientationSearch2D():
+  """ Search of the orientation of a moving image (film) relative to a fixed image (dose slice): the 8 combinations of
+      flips and 90 degree rotations, then a fine sweep of angles around the best one. Each candidate orientation is
+      applied around the center of the moving image, its translation is found by phase correlation, and it is scored
+      by normalized cross correlation. Images are averaged to about searchGridSize pixels first, and the candidates
+      are evaluated in parallel threads. Candidates that overlap less than minimumOverlapFraction of the footprint of
+      the film on the dose grid score -1. Geometry is given as for RigidRegistration2D.
+  """
+
+  def __init__(self, fixedArray, fixedSpacing, movingArray, planeToMovingIndexMatrix, searchGridSize=128):
+    fixedArray = numpy.asarray(fixedArray, dtype=numpy.float64)
+    movingArray = numpy.asarray(movingArray, dtype=numpy.float64)
+    planeToMovingIndexMatrix = numpy.vstack([numpy.array(planeToMovingIndexMatrix, dtype=numpy.float64).reshape(2,3), [0.0, 0.0, 1.0]])
+    self.fineAngleRangeDegrees = 10.0
+    self.fineAngleStepDegrees = 1.0
+    self.numberOfThreads = 1
+    self.minimumOverlapFraction = 0.25 # See RigidRegistration2D
+    self.results = [] # [score, flip, angle (degrees), plane transform matrix] of all evaluated candidates, best first
+
+    # Center of the moving image in plane coordinates, around which the candidate orientations are applied
+    movingCenterIndex = [0.5 * (movingArray.shape[1]-1), 0.5 * (movingArray.shape[0]-1)]
+    self.movingCenter = numpy.linalg.solve(planeToMovingIndexMatrix[0:2,0:2], numpy.array(movingCenterIndex) - planeToMovingIndexMatrix[0:2,2])
+
+    # Average both images to the search resolution. Plane coordinates of the search are shifted so that they start
+    # at the center of the first averaged fixed pixel.
+    movingPixelSize = math.sqrt(abs(numpy.linalg.det(numpy.linalg.inv(planeToMovingIndexMatrix[0:2,0:2]))))
+    imageSize = max(fixedArray.shape[1] * fixedSpacing[0], fixedArray.shape[0] * fixedSpacing[1], max(movingArray.shape) * movingPixelSize)
+    searchSpacing = max(min(fixedSpacing), imageSize / searchGridSize)
+    fixedShrinkFactor = max(int(searchSpacing / min(fixedSpacing)), 1)
+    self.searchPlaneOffset = numpy.array([0.5 * (fixedShrinkFactor-1) * fixedSpacing[0], 0.5 * (fixedShrinkFactor-1) * fixedSpacing[1]])
+    self.searchFixedArray = shrinkImage(fixedArray, fixedShrinkFactor)
+    self.searchFixedSpacing = [fixedSpacing[0] * fixedShrinkFactor, fixedSpacing[1] * fixedShrinkFactor]
+    movingShrinkFactor = max(int(searchSpacing / movingPixelSize), 1)
+    self.searchMovingArray = shrinkImage(movingArray, movingShrinkFactor)
+    self.searchPlaneToMovingIndexMatrix = numpy.dot(planeToMovingIndexMatrix, getTranslationMatrix(self.searchPlaneOffset))
+    self.searchPlaneToMovingIndexMatrix[0:2,2] -= 0.5 * (movingShrinkFactor-1)
+    self.searchPlaneToMovingIndexMatrix[0:2,:] /= movingShrinkFactor
+
+  def getCandidateMatrix(self, flip, angleDegrees):
+    """ 3x3 matrix that flips the moving image vertically (if requested), then rotates it around its center
+    """
+    angle = math.radians(angleDegrees)
+    linearMatrix = numpy.array([[math.cos(angle), -math.sin(angle)], [math.sin(angle), math.cos(angle)]])
+    if flip:
+      linearMatrix = numpy.dot(linearMatrix, numpy.diag([1.0, -1.0]))
+    matrix = numpy.identity(3)
+    matrix[0:2,0:2] = linearMatrix
+    matrix[0:2,2] = self.movingCenter - numpy.dot(linearMatrix, self.movingCenter)
+    return matrix
+
+  def scoreCandidate(self, candidate):
+    """ Score of a (flip, angle) candidate. Returns [score, flip, angle, plane transform matrix], where the matrix maps
+        moving plane coordinates to fixed plane coordinates including the translation found by phase correlation.
+    """
+    flip, angleDegrees = candidate
+    # Search plane to original plane coordinates and back
+    candidateMatrix = numpy.dot(getTranslationMatrix(-self.searchPlaneOffset), numpy.dot(self.getCandidateMatrix(flip, angleDegrees), getTranslationMatrix(self.searchPlaneOffset)))
+    planeToMovingIndexMatrix = numpy.dot(self.searchPlaneToMovingIndexMatrix, numpy.linalg.inv(candidateMatrix))
+    registration = RigidRegistration2D(self.searchFixedArray, self.searchFixedSpacing, self.searchMovingArray, planeToMovingIndexMatrix[0:2,:])
+    registration.numberOfLevels = 1
+    registration.minimumOverlapFraction = self.minimumOverlapFraction
+    registration.maximumPhaseCorrelationGridSize = 2 * max(self.searchFixedArray.shape)
+    translation, peak = registration.estimateInitialTranslation()
+    score = registration.computeMetric(registration.parameters, registration.createLevels()[0])
+    if score is None:
+      score = -1.0
+    searchPlaneTransformMatrix = numpy.dot(getTranslationMatrix(translation), candidateMatrix)
+    planeTransformMatrix = numpy.dot(getTranslationMatrix(self.searchPlaneOffset), numpy.dot(searchPlaneTransformMatrix, getTranslationMatrix(-self.searchPlaneOffset)))
+    return [score, flip, angleDegrees, planeTransformMatrix]
+
+  def scoreCandidates(self, candidates):
+    # Candidates are independent, numpy releases the GIL in the transforms and array operations
+    if self.numberOfThreads > 1 and len(candidates) > 1:
+      from concurrent.futures import ThreadPoolExecutor
+      with ThreadPoolExecutor(max_workers=min(self.numberOfThreads, len(candidates))) as executor:
+        return list(executor.map(self.scoreCandidate, candidates))
+    return [self.scoreCandidate(candidate) for candidate in candidates]
+
+  def search(self):
+    """ Evaluate the flips and 90 degree rotations, then the fine angles around the best of them.
+        Returns the best [score, flip, angle, plane transform matrix].
+    """
+    self.results = self.scoreCandidates([(flip, angleDegrees) for flip in [False, True] for angleDegrees in [0.0, 90.0, 180.0, 270.0]])
+    bestScore, bestFlip, bestAngleDegrees, bestMatrix = max(self.results, key=lambda result: result[0])
+    numberOfFineSteps = int(round(self.fineAngleRangeDegrees / self.fineAngleStepDegrees))
+    fineAngles = [bestAngleDegrees + step * self.fineAngleStepDegrees for step in range(-numberOfFineSteps, numberOfFineSteps+1) if step != 0]
+    self.results += self.scoreCandidates([(bestFlip, angleDegrees) for angleDegrees in fineAngles])
+    self.results.sort(key=lambda result: result[0], reverse=True)
+    return self.results[0]
+
+#
+# AlignmentMetric2D
+#
+class AlignmentMetric2D():
+  """ Similarity of a fixed image (dose slice) and a moving image (film) for interactive alignment: normalized cross
+      correlation and mean absolute difference on the overlap. The fixed image is averaged to at most maximumGridSize
+      pixels along its axes and the moving image to a similar resolution once, so that an evaluation for a new
+      transform only samples the cached grid and takes a few milliseconds.
+      Geometry is given as for RigidRegistration2D, the moving pixel size is in plane coordinates (mm).
+  """
+
+  def __init__(self, fixedArray, fixedSpacing, movingArray, movingPixelSize, maximumGridSize=64):
+    fixedArray = numpy.asarray(fixedArray, dtype=numpy.float64)
+    self.minimumOverlapFraction = 0.1 # Minimum fraction of the footprint of the moving image on the grid that has to overlap the fixed image
+    self.minimumNumberOfOverlapPixels = 4
+
+    shrinkFactor = max(int(math.ceil(float(max(fixedArray.shape)) / maximumGridSize)), 1)
+    fixedGridArray = shrinkImage(fixedArray, shrinkFactor)
+    gridSpacing = [fixedSpacing[0] * shrinkFactor, fixedSpacing[1] * shrinkFactor]
+    rows, columns = numpy.mgrid[0:fixedGridArray.shape[0], 0:fixedGridArray.shape[1]]
+    self.planeCoordinates = numpy.vstack([
+      (columns.ravel() + 0.5 * (shrinkFactor-1)/shrinkFactor) * gridSpacing[0],
+      (rows.ravel() + 0.5 * (shrinkFactor-1)/shrinkFactor) * gridSpacing[1] ])
+    self.fixedValues = fixedGridArray.ravel()
+
+    self.movingShrinkFactor = max(int(min(gridSpacing) / movingPixelSize), 1)
+    self.movingArray = shrinkImage(numpy.asarray(movingArray, dtype=numpy.float64), self.movingShrinkFactor)
+    self.footprintNumberOfPixels = getFootprintNumberOfPixels(self.fixedValues.size, gridSpacing, numpy.shape(movingArray), movingPixelSize)
+
+  def compute(self, planeToMovingIndexMatrix):
+    """ Normalized cross correlation and mean absolute difference for the moving image placed by the plane to moving
+        index matrix (2x3, original moving resolution). Returns None for both if the overlap is too small, relative to
+        the footprint of the moving image on the grid (see RigidRegistration2D).
+    """
+    planeToMovingIndexMatrix = numpy.array(planeToMovingIndexMatrix, dtype=numpy.float64)[0:2,:]
+    planeToMovingIndexMatrix[:,2] -= 0.5 * (self.movingShrinkFactor-1)
+    planeToMovingIndexMatrix /= self.movingShrinkFactor
+    movingIndices = numpy.dot(planeToMovingIndexMatrix[:,0:2], self.planeCoordinates) + planeToMovingIndexMatrix[:,2:3]
+    movingValues, validMask = sampleBilinear(self.movingArray, movingIndices[0], movingIndices[1])
+    if numpy.count_nonzero(validMask) < max(self.minimumOverlapFraction * self.footprintNumberOfPixels, self.minimumNumberOfOverlapPixels):
+      return None, None
+    fixedValues = self.fixedValues[validMask]
+    movingValues = movingValues[validMask]
+    return computeNormalizedCrossCorrelation(fixedValues, movingValues), float(numpy.mean(numpy.abs(fixedValues - movingValues)))
+
+#------------------------------------------------------------------------------
+def computeImageMoments(array, indexToPlaneMatrix, thresholdFraction=0.1):
+  """ Weighted centroid and covariance of an image in plane coordinates, where the weights are the values above
+      thresholdFraction times the maximum (so that the low dose background does not pull the centroid).
+      indexToPlaneMatrix (2x3) maps pixel indices (column, row, 1) to plane coordinates.
+      Returns the centroid and the 2x2 covariance matrix, or None for both if the image has no weight.
+  """
+  array = numpy.nan_to_num(numpy.asarray(array, dtype=numpy.float64))
+  weights = numpy.clip(array - thresholdFraction * array.max(), 0.0, None) if array.size > 0 else array
+  # All moments from the row and column sums and one matrix product
+  columnSums = weights.sum(axis=0)
+  rowSums = weights.sum(axis=1)
+  totalWeight = float(rowSums.sum())
+  if totalWeight <= 0.0:
+    return None, None
+  columns = numpy.arange(weights.shape[1], dtype=numpy.float64)
+  rows = numpy.arange(weights.shape[0], dtype=numpy.float64)
+  meanColumn = numpy.dot(columnSums, columns) / totalWeight
+  meanRow = numpy.dot(rowSums, rows) / totalWeight
+  columnDeviations = columns - meanColumn
+  rowDeviations = rows - meanRow
+  columnVariance = numpy.dot(columnSums, columnDeviations * columnDeviations) / totalWeight
+  rowVariance = numpy.dot(rowSums, rowDeviations * rowDeviations) / totalWeight
+  covariance = numpy.dot(rowDeviations, numpy.dot(weights, columnDeviations)) / totalWeight
+  indexCovariance = numpy.array([[columnVariance, covariance], [covariance, rowVariance]])
+
+  indexToPlaneMatrix = numpy.array(indexToPlaneMatrix, dtype=numpy.float64).reshape(2,3)
+  linearPart = indexToPlaneMatrix[:,0:2]
+  centroid = numpy.dot(linearPart, [meanColumn, meanRow]) + indexToPlaneMatrix[:,2]
+  return centroid, numpy.dot(linearPart, numpy.dot(indexCovariance, linearPart.T))
+
+#------------------------------------------------------------------------------
+def getPrincipalAxisAngle(covariance):
+  """ Angle (degrees) of the major principal axis from the first plane axis, and the anisotropy of the covariance,
+      (major - minor) / (major + minor) variance, which is 0 if the principal axes are undefined.
+  """
+  trace = covariance[0,0] + covariance[1,1]
+  difference = math.sqrt((covariance[0,0] - covariance[1,1])**2 + 4.0 * covariance[0,1]**2)
+  anisotropy = difference / trace if trace > 0.0 else 0.0
+  return math.degrees(0.5 * math.atan2(2.0 * covariance[0,1], covariance[0,0] - covariance[1,1])), anisotropy
+
+#------------------------------------------------------------------------------
+def computeMomentAlignmentMatrix(fixedArray, fixedSpacing, movingArray, planeToMovingIndexMatrix, minimumAnisotropy=0.05, maximumAngleDegrees=90.0):
+  """ 3x3 plane transform that moves the weighted centroid of the moving image onto that of the fixed image, and
+      rotates it around its centroid so that the principal axes match. Principal axes only define the rotation up to
+      180 degrees, so the smaller of the two rotations is used, and the rotation is skipped if either image is too
+      isotropic (such as a square field) or the rotation exceeds maximumAngleDegrees (0 for translation only).
+      Geometry is given as for RigidRegistration2D. Returns None if an image is empty.
+  """
+  fixedIndexToPlaneMatrix = [[fixedSpacing[0], 0.0, 0.0], [0.0, fixedSpacing[1], 0.0]]
+  planeToMovingIndexMatrix = numpy.vstack([numpy.array(planeToMovingIndexMatrix, dtype=numpy.float64).reshape(2,3), [0.0, 0.0, 1.0]])
+  fixedCentroid, fixedCovariance = computeImageMoments(fixedArray, fixedIndexToPlaneMatrix)
+  movingCentroid, movingCovariance = computeImageMoments(movingArray, numpy.linalg.inv(planeToMovingIndexMatrix)[0:2,:])
+  if fixedCentroid is None or movingCentroid is None:
+    return None
+
+  fixedAngleDegrees, fixedAnisotropy = getPrincipalAxisAngle(fixedCovariance)
+  movingAngleDegrees, movingAnisotropy = getPrincipalAxisAngle(movingCovariance)
+  angleDegrees = 0.0
+  if min(fixedAnisotropy, movingAnisotropy) >= minimumAnisotropy:
+    angleDegrees = (fixedAngleDegrees - movingAngleDegrees + 90.0) % 180.0 - 90.0
+    if abs(angleDegrees) > maximumAngleDegrees:
+      angleDegrees = 0.0
+  angle = math.radians(angleDegrees)
+  rotation = numpy.array([[math.cos(angle), -math.sin(angle)], [math.sin(angle), math.cos(angle)]])
+  matrix = numpy.identity(3)
+  matrix[0:2,0:2] = rotation
+  matrix[0:2,2] = fixedCentroid - numpy.dot(rotation, movingCentroid)
+  return matrix
+
+#------------------------------------------------------------------------------
+def getFootprintNumberOfPixels(numberOfGridPixels, gridSpacing, movingShape, movingPixelSize):
+  """ Number of grid pixels covered by the moving image if it lies completely inside the grid (its area in grid pixels),
+      at most the number of grid pixels. Minimum overlaps are relative to this rather than to the grid, so that they
+      do not depend on how much larger the fixed image is than the moving image.
+  """
+  movingArea = movingShape[0] * movingShape[1] * movingPixelSize * movingPixelSize
+  return min(movingArea / (gridSpacing[0] * gridSpacing[1]), float(numberOfGridPixels))
+
+#------------------------------------------------------------------------------
+def getTranslationMatrix(translation):
+  matrix = numpy.identity(3)
+  matrix[0:2,2] = translation
+  return matrix
+
+#------------------------------------------------------------------------------
+def shrinkImage(array, shrinkFactor):
+  """ Average non-overlapping blocks of shrinkFactor x shrinkFactor pixels (incomplete blocks at the end are dropped)
+  """
+  if shrinkFactor <= 1:
+    return array
+  numberOfRows = max(array.shape[0] // shrinkFactor, 1)
+  numberOfColumns = max(array.shape[1] // shrinkFactor, 1)
+  blockRows = min(shrinkFactor, array.shape[0])
+  blockColumns = min(shrinkFactor, array.shape[1])
+  blocks = array[0:numberOfRows*blockRows, 0:numberOfColumns*blockColumns].reshape(numberOfRows, blockRows, numberOfColumns, blockColumns)
+  return blocks.mean(axis=(1,3))
+
+#------------------------------------------------------------------------------
+def resampleImageToPlaneGrid(array, planeToIndexMatrix, planeCoordinates, pixelsPerGridSpacing):
+  """ Sample an image at plane coordinates (2xN) after averaging it to about the grid resolution.
+      Values outside the image are zero, and the mean inside is subtracted so that the image border does not dominate.
+  """
+  shrinkFactor = max(int(pixelsPerGridSpacing), 1)
+  planeToIndexMatrix = numpy.array(planeToIndexMatrix, dtype=numpy.float64)
+  planeToIndexMatrix[:,2] -= 0.5 * (shrinkFactor-1)
+  planeToIndexMatrix /= shrinkFactor
+  indices = numpy.dot(planeToIndexMatrix[:,0:2], planeCoordinates) + planeToIndexMatrix[:,2:3]
+  values, validMask = sampleBilinear(shrinkImage(numpy.asarray(array, dtype=numpy.float64), shrinkFactor), indices[0], indices[1])
+  if validMask.any():
+    values[validMask] -= values[validMask].mean()
+  return values
+
+#------------------------------------------------------------------------------
+def computePhaseCorrelationShift(fixedArray, movingArray):
+  """ Shift (rows, columns) that moves the moving image onto the fixed image, from the peak of the inverse transform
+      of the normalized cross-power spectrum, refined to sub-pixel by parabolas through the neighbouring values.
+      Returns the shift and the peak value (1 for images that only differ by a cyclic shift).
+  """
+  crossPowerSpectrum = numpy.fft.rfft2(fixedArray) * numpy.conj(numpy.fft.rfft2(movingArray))
+  magnitudes = numpy.abs(crossPowerSpectrum)
+  # Small regularization so that frequencies without signal do not contribute noise
+  crossPowerSpectrum /= numpy.maximum(magnitudes, 1e-3 * magnitudes.max() if magnitudes.size > 0 else 1.0)
+  correlation = numpy.fft.irfft2(crossPowerSpectrum, s=fixedArray.shape)
+
+  peakIndex = numpy.unravel_index(numpy.argmax(correlation), correlation.shape)
+  shift = []
+  for axis in range(2):
+    size = correlation.shape[axis]
+    previousIndex, nextIndex = list(peakIndex), list(peakIndex)
+    previousIndex[axis] = (peakIndex[axis]-1) % size
+    nextIndex[axis] = (peakIndex[axis]+1) % size
+    previousValue, peakValue, nextValue = correlation[tuple(previousIndex)], correlation[peakIndex], correlation[tuple(nextIndex)]
+    curvature = previousValue - 2.0 * peakValue + nextValue
+    offset = 0.5 * (previousValue - nextValue) / curvature if curvature < 0.0 else 0.0
+    # Indices past the middle are negative shifts
+    axisShift = peakIndex[axis] + max(min(offset, 0.5), -0.5)
+    if axisShift > size / 2:
+      axisShift -= size
+    shift.append(float(axisShift))
+  return shift, float(correlation[peakIndex])
+
+#------------------------------------------------------------------------------
+def sampleBilinear(array, columns, rows):
+  """ Bilinear interpolation of a 2D array at continuous pixel indices.
+      Returns the values and the mask of the points inside the image (values outside are zero).
+  """
+  numberOfRows, numberOfColumns = array.shape
+  validMask = (columns >= 0.0) & (columns <= numberOfColumns-1) & (rows >= 0.0) & (rows <= numberOfRows-1)
+  column0 = numpy.clip(numpy.floor(columns), 0, max(numberOfColumns-2, 0)).astype(numpy.intp)
+  row0 = numpy.clip(numpy.floor(rows), 0, max(numberOfRows-2, 0)).astype(numpy.intp)
+  column1 = numpy.minimum(column0 + 1, numberOfColumns-1)
+  row1 = numpy.minimum(row0 + 1, numberOfRows-1)
+  columnWeights = numpy.clip(columns - column0, 0.0, 1.0)
+  rowWeights = numpy.clip(rows - row0, 0.0, 1.0)
+  values = ((array[row0, column0] * (1.0-columnWeights) + array[row0, column1] * columnWeights) * (1.0-rowWeights)
+    + (array[row1, column0] * (1.0-columnWeights) + array[row1, column1] * columnWeights) * rowWeights)
+  values[~validMask] = 0.0
+  return values, validMask
+
+#------------------------------------------------------------------------------
+def computeNormalizedCrossCorrelation(fixedValues, movingValues):
+  fixedDeviations = fixedValues - fixedValues.mean()
+  movingDeviations = movingValues - movingValues.mean()
+  denominator = math.sqrt(float(numpy.dot(fixedDeviations, fixedDeviations)) * float(numpy.dot(movingDeviations, movingDeviations)))
+  if denominator <= 0.0:
+    return 0.0
+  return float(numpy.dot(fixedDeviations, movingDeviations)) / denominator
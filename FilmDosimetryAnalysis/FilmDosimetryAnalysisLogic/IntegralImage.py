@@ -0,0 +1,150 @@
+import numpy
+
+#
+# IntegralImage
+#
+class IntegralImage():
+  """ Summed-area table of an image and of its squared values.
+      Sum, mean and standard deviation of any axis-aligned box of voxels are computed in constant time.
+      Integer images are accumulated in 64-bit integers so that the sums (and the variance) are exact.
+  """
+
+  def __init__(self, array):
+    # Input array is indexed [k,j,i] as returned by vtk_to_numpy after reshaping to the image dimensions
+    array = numpy.asarray(array)
+    if array.ndim == 2:
+      array = array[numpy.newaxis,:,:]
+    self.shape = array.shape
+    self.isExact = numpy.issubdtype(array.dtype, numpy.integer) or numpy.issubdtype(array.dtype, numpy.bool_)
+    accumulatorType = numpy.int64 if self.isExact else numpy.float64
+
+    self.sumTable = self.computeSummedAreaTable(array, accumulatorType)
+    squaredArray = array.astype(accumulatorType)
+    squaredArray *= squaredArray
+    self.sumOfSquaresTable = self.computeSummedAreaTable(squaredArray, accumulatorType)
+
+  def computeSummedAreaTable(self, array, accumulatorType):
+    # The table has an extra leading row of zeros along each axis, so that table[k,j,i] is the sum of array[:k,:j,:i]
+    table = numpy.zeros((array.shape[0]+1, array.shape[1]+1, array.shape[2]+1), dtype=accumulatorType)
+    table[1:,1:,1:] = array
+    for axis in range(3):
+      numpy.cumsum(table, axis=axis, out=table)
+    return table
+
+  def getMemorySize(self):
+    memorySize = self.sumTable.nbytes + self.sumOfSquaresTable.nbytes
+    if hasattr(self, 'sumPlaneTable'):
+      memorySize += self.sumPlaneTable.nbytes + self.sumOfSquaresPlaneTable.nbytes
+    return memorySize
+
+  def getBoxSum(self, table, box):
+    """ Sum of the values in the box [k0,k1,j0,j1,i0,i1] (inclusive array indices) by inclusion-exclusion of the 8 corners
+    """
+    lower = [box[0], box[2], box[4]]
+    upper = [box[1]+1, box[3]+1, box[5]+1]
+    boxSum = 0
+    for corner in range(8):
+      cornerIndex = tuple(upper[axis] if (corner >> axis) & 1 else lower[axis] for axis in range(3))
+      numberOfLowerIndices = 3 - bin(corner).count('1')
+      cornerValue = table[cornerIndex].item() # Python int for integer tables to avoid overflow
+      boxSum += -cornerValue if numberOfLowerIndices % 2 else cornerValue
+    return boxSum
+
+  def getBoxStatistics(self, box):
+    """ Statistics of the box [k0,k1,j0,j1,i0,i1] (inclusive array indices).
+        Returns [mean, standard deviation, number of voxels], or None for an empty box.
+    """
+    numberOfVoxels = (box[1]-box[0]+1) * (box[3]-box[2]+1) * (box[5]-box[4]+1)
+    if numberOfVoxels <= 0:
+      return None
+    boxSum = self.getBoxSum(self.sumTable, box)
+    boxSumOfSquares = self.getBoxSum(self.sumOfSquaresTable, box)
+    # n^2 * variance = n * sum(x^2) - sum(x)^2, exact for integer images
+    varianceTimesNumberOfVoxelsSquared = numberOfVoxels * boxSumOfSquares - boxSum * boxSum
+    variance = max(float(varianceTimesNumberOfVoxelsSquared) / (numberOfVoxels * numberOfVoxels), 0.0)
+    return [ float(boxSum) / numberOfVoxels, variance ** 0.5, numberOfVoxels ]
+
+  def getPlaneTables(self):
+    # Summed-area tables of the (i,j) plane over all slices, in the accumulator type so that window sums stay exact
+    if not hasattr(self, 'sumPlaneTable'):
+      self.sumPlaneTable = self.sumTable[-1] - self.sumTable[0]
+      self.sumOfSquaresPlaneTable = self.sumOfSquaresTable[-1] - self.sumOfSquaresTable[0]
+    return self.sumPlaneTable, self.sumOfSquaresPlaneTable
+
+  def getWindowSums(self, table, upperLeft, upperRight, lowerLeft, lowerRight):
+    # Window sums by inclusion-exclusion of the corners, converted to floating point only after the subtraction
+    windowSum = table[lowerRight] - table[upperRight]
+    windowSum -= table[lowerLeft]
+    windowSum += table[upperLeft]
+    return windowSum.astype(numpy.float64)
+
+  def getSlidingWindowStatistics(self, windowSize, stride=1, searchBox=None):
+    """ Mean and standard deviation of all square windows of the given size in the (i,j) plane, spanning all slices.
+        Windows are placed at every stride-th position within searchBox [j0,j1,i0,i1] (inclusive, whole plane by default).
+        Returns the row and column indices of the window corners and the mean and standard deviation arrays
+        indexed [row,column], or None if the window does not fit.
+    """
+    if searchBox is None:
+      searchBox = [0, self.shape[1]-1, 0, self.shape[2]-1]
+    rows = numpy.arange(searchBox[0], searchBox[1]-windowSize+2, stride)
+    columns = numpy.arange(searchBox[2], searchBox[3]-windowSize+2, stride)
+    if len(rows) == 0 or len(columns) == 0:
+      return None
+
+    sumPlaneTable, sumOfSquaresPlaneTable = self.getPlaneTables()
+    upperLeft = numpy.ix_(rows, columns)
+    upperRight = numpy.ix_(rows, columns+windowSize)
+    lowerLeft = numpy.ix_(rows+windowSize, columns)
+    lowerRight = numpy.ix_(rows+windowSize, columns+windowSize)
+    numberOfVoxels = float(windowSize * windowSize * self.shape[0])
+
+    windowMean = self.getWindowSums(sumPlaneTable, upperLeft, upperRight, lowerLeft, lowerRight)
+    windowMean /= numberOfVoxels
+    windowVariance = self.getWindowSums(sumOfSquaresPlaneTable, upperLeft, upperRight, lowerLeft, lowerRight)
+    windowVariance /= numberOfVoxels
+    windowVariance -= windowMean * windowMean
+    numpy.maximum(windowVariance, 0.0, out=windowVariance)
+    return rows, columns, windowMean, numpy.sqrt(windowVariance)
+
+  def estimateNoiseStandardDeviation(self, windowSize, searchBox=None):
+    """ Estimate pixel noise as the median standard deviation of small windows, which is robust to edges and marks
+    """
+    windowStatistics = self.getSlidingWindowStatistics(windowSize, max(1, windowSize//2), searchBox)
+    if windowStatistics is None:
+      return 0.0
+    return float(numpy.median(windowStatistics[3]))
+
+  def findLargestUniformWindow(self, maximumStandardDeviation, minimumWindowSize, searchBox=None, meanRange=None):
+    """ Find the largest square window in the (i,j) plane whose standard deviation does not exceed the given maximum,
+        using binary search on the window size. Of the uniform windows of that size the one with the lowest
+        standard deviation is chosen. If a mean range [minimum, maximum] is given, then only windows whose mean
+        is strictly within the range are considered (to exclude e.g. scanner background or saturated regions).
+        Returns the box [k0,k1,j0,j1,i0,i1] (inclusive array indices) of the window, or None if no window is uniform.
+    """
+    if searchBox is None:
+      searchBox = [0, self.shape[1]-1, 0, self.shape[2]-1]
+    smallestWindowSize = max(1, minimumWindowSize)
+    largestWindowSize = min(searchBox[1]-searchBox[0]+1, searchBox[3]-searchBox[2]+1)
+
+    bestBox = None
+    while smallestWindowSize <= largestWindowSize:
+      windowSize = (smallestWindowSize + largestWindowSize) // 2
+      # Sparser placement for large windows, which still overlap each other by most of their area
+      windowStatistics = self.getSlidingWindowStatistics(windowSize, max(1, windowSize//8), searchBox)
+      uniformWindowFound = False
+      if windowStatistics is not None:
+        rows, columns, windowMean, windowStandardDeviation = windowStatistics
+        if meanRange is not None:
+          windowStandardDeviation[(windowMean <= meanRange[0]) | (windowMean >= meanRange[1])] = numpy.inf
+        bestRowIndex, bestColumnIndex = numpy.unravel_index(numpy.argmin(windowStandardDeviation), windowStandardDeviation.shape)
+        if windowStandardDeviation[bestRowIndex, bestColumnIndex] <= maximumStandardDeviation:
+          uniformWindowFound = True
+          row = int(rows[bestRowIndex])
+          column = int(columns[bestColumnIndex])
+          bestBox = [0, self.shape[0]-1, row, row+windowSize-1, column, column+windowSize-1]
+      if uniformWindowFound:
+        smallestWindowSize = windowSize + 1
+      else:
+        largestWindowSize = windowSize - 1
+
+    return bestBox
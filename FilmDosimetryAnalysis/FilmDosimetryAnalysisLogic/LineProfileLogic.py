@@ -14,6 +14,7 @@ class LineProfileLogic():
     self.outputPlotSeriesNodes = {} # Map from volume node IDs to plot series nodes
     self.outputTableNode = None
     self.plotChartNode = None
+    self.useSinglePrecision = False # Store the profiles in float instead of double arrays
 
   def __del__(self):
     self.enableAutoUpdate(False)
@@ -35,9 +36,13 @@ class LineProfileLogic():
 
   def getArrayFromTable(self, outputTable, arrayName):
     distanceArray = outputTable.GetTable().GetColumnByName(arrayName)
+    dataType = vtk.VTK_FLOAT if self.useSinglePrecision else vtk.VTK_DOUBLE
     if distanceArray:
-      return distanceArray
-    newArray = vtk.vtkDoubleArray()
+      if distanceArray.GetDataType() == dataType:
+        return distanceArray
+      # Precision changed since the column was created
+      outputTable.GetTable().RemoveColumnByName(arrayName)
+    newArray = vtk.vtkFloatArray() if self.useSinglePrecision else vtk.vtkDoubleArray()
     newArray.SetName(arrayName)
     outputTable.GetTable().AddColumn(newArray)
     return newArray
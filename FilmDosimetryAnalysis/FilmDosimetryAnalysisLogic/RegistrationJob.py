@@ -0,0 +1,203 @@
+from __main__ import qt, slicer
+import threading
+import logging
+import time
+
+#
+# RegistrationJob
+#
+class RegistrationJob():
+  """ Registration that runs without blocking the application. The job is polled by a timer on the main thread,
+      which reports progress, stops the job on timeout, and calls onFinished(job) once the job ended, so that results
+      are only applied to the scene from the main thread and only after they are complete.
+      Subclasses start the work in startWork and report its state in pollWork. If the work cannot be stopped at once
+      (such as a CLI module), then a cancelled job keeps running until pollWork reports that the work ended.
+  """
+  Running = 'Running'
+  Completed = 'Completed'
+  Failed = 'Failed'
+  Cancelled = 'Cancelled'
+  TimedOut = 'Timed out'
+
+  def __init__(self, name, onFinished=None, onProgress=None, timeoutSeconds=None):
+    self.name = name
+    self.onFinished = onFinished # Called with the job when it ended for any reason
+    self.onProgress = onProgress # Called with the job when its progress changed
+    self.timeoutSeconds = timeoutSeconds # Job is cancelled after this time (None for no limit)
+    self.pollIntervalMs = 100
+    self.status = None
+    self.message = '' # Error message if the job did not complete
+    self.progress = 0.0 # Fraction of the work done
+    self.startTime = None
+    self.pollTimer = None
+    self.cancelRequest = None # [status, message] the job finishes with after cancellation was requested
+
+  def start(self):
+    """ Start the job. Returns an error message if it could not be started (then onFinished is not called).
+    """
+    self.startTime = time.time()
+    message = self.startWork()
+    if message != '':
+      self.status = RegistrationJob.Failed
+      self.message = message
+      return message
+    self.status = RegistrationJob.Running
+    self.pollTimer = qt.QTimer()
+    self.pollTimer.setInterval(self.pollIntervalMs)
+    self.pollTimer.connect('timeout()', self.poll)
+    self.pollTimer.start()
+    return ''
+
+  def isRunning(self):
+    return self.status == RegistrationJob.Running
+
+  def getElapsedTime(self):
+    return time.time() - self.startTime if self.startTime is not None else 0.0
+
+  def poll(self):
+    if not self.isRunning():
+      return
+    status, message, progress = self.pollWork()
+    if progress != self.progress:
+      self.progress = progress
+      if self.onProgress is not None:
+        self.onProgress(self)
+    if status != RegistrationJob.Running:
+      if self.cancelRequest is not None:
+        # Work that ended after cancellation was requested is discarded even if it completed
+        self.finish(self.cancelRequest[0], self.cancelRequest[1])
+      else:
+        self.finish(status, message)
+    elif self.cancelRequest is None and self.timeoutSeconds is not None and self.getElapsedTime() > self.timeoutSeconds:
+      self.requestCancel(RegistrationJob.TimedOut, self.name + ' did not finish in ' + str(self.timeoutSeconds) + ' seconds')
+
+  def cancel(self):
+    if not self.isRunning() or self.cancelRequest is not None:
+      return
+    self.requestCancel(RegistrationJob.Cancelled, self.name + ' cancelled')
+
+  def isCancelling(self):
+    return self.isRunning() and self.cancelRequest is not None
+
+  def requestCancel(self, status, message):
+    self.cancelRequest = [status, message]
+    if self.cancelWork():
+      self.finish(status, message)
+
+  def wait(self):
+    """ Block until the job ended (for scripted use), keeping the application responsive
+    """
+    while self.isRunning():
+      slicer.app.processEvents()
+      time.sleep(0.001 * self.pollIntervalMs)
+      self.poll()
+    return self.message
+
+  def finish(self, status, message):
+    if self.pollTimer is not None:
+      self.pollTimer.stop()
+      self.pollTimer = None
+    self.status = status
+    self.message = message
+    logging.info(self.name + ': ' + status + ' in ' + str(round(self.getElapsedTime(),2)) + ' s' + (' (' + message + ')' if message else ''))
+    if self.onFinished is not None:
+      self.onFinished(self)
+
+  def startWork(self):
+    """ Start the work. Returns an error message, empty on success.
+    """
+    raise NotImplementedError()
+
+  def pollWork(self):
+    """ Returns the status, error message and progress of the work
+    """
+    raise NotImplementedError()
+
+  def cancelWork(self):
+    """ Request the work to stop. Returns True if it has stopped (or its result can be safely discarded),
+        False if it stops asynchronously, in which case the job finishes when pollWork reports that it ended.
+    """
+    raise NotImplementedError()
+
+#
+# ThreadRegistrationJob
+#
+class ThreadRegistrationJob(RegistrationJob):
+  """ Job running a function in a background thread. The function is called with a progress callback (taking the
+      fraction done), and must only use data prepared beforehand, not the scene. Its return value is stored in result.
+      cancelFunction is called on the main thread to request the function to return early.
+  """
+
+  def __init__(self, name, function, cancelFunction=None, onFinished=None, onProgress=None, timeoutSeconds=None):
+    RegistrationJob.__init__(self, name, onFinished, onProgress, timeoutSeconds)
+    self.function = function
+    self.cancelFunction = cancelFunction
+    self.result = None
+    self.thread = None
+    self.threadProgress = 0.0
+    self.threadErrorMessage = ''
+
+  def startWork(self):
+    def run():
+      try:
+        self.result = self.function(self.setThreadProgress)
+      except Exception as e:
+        import traceback
+        traceback.print_exc()
+        self.threadErrorMessage = str(e) if str(e) else type(e).__name__
+    self.thread = threading.Thread(target=run, name=self.name)
+    self.thread.daemon = True
+    self.thread.start()
+    return ''
+
+  def setThreadProgress(self, progress):
+    self.threadProgress = progress
+
+  def pollWork(self):
+    if self.thread.is_alive():
+      return RegistrationJob.Running, '', self.threadProgress
+    if self.threadErrorMessage != '':
+      return RegistrationJob.Failed, self.threadErrorMessage, self.threadProgress
+    return RegistrationJob.Completed, '', 1.0
+
+  def cancelWork(self):
+    # The thread is not waited for, its result is discarded
+    if self.cancelFunction is not None:
+      self.cancelFunction()
+    return True
+
+#
+# CliRegistrationJob
+#
+class CliRegistrationJob(RegistrationJob):
+  """ Job running a CLI module (such as BRAINSFit) asynchronously. The CLI writes its outputs into the nodes given
+      in the parameters when it completes, so a cancelled job only finishes when the CLI reports that it stopped.
+  """
+
+  def __init__(self, name, cliModule, parameters, onFinished=None, onProgress=None, timeoutSeconds=None):
+    RegistrationJob.__init__(self, name, onFinished, onProgress, timeoutSeconds)
+    self.cliModule = cliModule
+    self.parameters = parameters
+    self.cliNode = None
+
+  def startWork(self):
+    self.cliNode = slicer.cli.run(self.cliModule, None, self.parameters, wait_for_completion=False)
+    if self.cliNode is None:
+      return 'Failed to start ' + self.name
+    return ''
+
+  def pollWork(self):
+    progress = min(max(self.cliNode.GetProgress() / 100.0, 0.0), 1.0)
+    if self.cliNode.IsBusy():
+      return RegistrationJob.Running, '', progress
+    status = self.cliNode.GetStatus()
+    if status == slicer.vtkMRMLCommandLineModuleNode.Completed:
+      return RegistrationJob.Completed, '', 1.0
+    if status == slicer.vtkMRMLCommandLineModuleNode.Cancelled:
+      return RegistrationJob.Cancelled, self.name + ' cancelled', progress
+    return RegistrationJob.Failed, self.name + ' failed: ' + self.cliNode.GetStatusString() + ' ' + self.cliNode.GetErrorText(), progress
+
+  def cancelWork(self):
+    # Cancel is only a request, the CLI may still write its outputs until it is no longer busy
+    self.cliNode.Cancel()
+    return not self.cliNode.IsBusy()
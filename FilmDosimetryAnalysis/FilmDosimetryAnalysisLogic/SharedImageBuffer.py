@@ -0,0 +1,57 @@
+from __main__ import vtk
+from vtk.util import numpy_support
+import numpy
+
+#
+# SharedImageBufferRegistry
+#
+class SharedImageBufferRegistry():
+  """ Owner of numpy arrays that are used by VTK image data as scalars without copying.
+      numpy_to_vtk without deep copy only attaches the array to the Python wrapper of the VTK array, so the buffer
+      may be freed while the image data still uses it. Here the arrays are held until the image data is deleted
+      or its scalars are replaced through the registry, so numpy and VTK share one allocation for its whole lifetime.
+  """
+
+  def __init__(self):
+    self.buffers = {} # Map from image data addresses to [numpy array, delete event observer tag]
+
+  def getKey(self, imageData):
+    return imageData.GetAddressAsString('vtkImageData')
+
+  def createImageData(self, array, extent):
+    """ Create image data with the given extent that uses the array as scalars.
+        The array is only copied if it is not contiguous.
+    """
+    imageData = vtk.vtkImageData()
+    self.setImageDataScalars(imageData, array, extent)
+    return imageData
+
+  def setImageDataScalars(self, imageData, array, extent=None):
+    """ Set the array as scalars of existing image data without copying (unless it is not contiguous),
+        and release the buffer previously set by the registry. The extent is changed if given.
+    """
+    array = numpy.ascontiguousarray(array).reshape(-1)
+    if extent is not None:
+      numberOfPoints = (extent[1]-extent[0]+1) * (extent[3]-extent[2]+1) * (extent[5]-extent[4]+1)
+      if numberOfPoints != array.size:
+        raise ValueError('Array size ' + str(array.size) + ' does not match image extent ' + str(list(extent)))
+
+    imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(array, 0))
+    if extent is not None:
+      imageData.SetExtent(extent)
+    # Previous buffer is released only after the image data stopped using it
+    self.releaseBuffer(imageData)
+
+    key = self.getKey(imageData)
+    observerTag = imageData.AddObserver(vtk.vtkCommand.DeleteEvent, lambda caller, event: self.buffers.pop(key, None))
+    self.buffers[key] = [array, observerTag]
+
+  def releaseBuffer(self, imageData):
+    """ Stop holding the buffer of the image data. The image data must not use the buffer afterwards.
+    """
+    buffer = self.buffers.pop(self.getKey(imageData), None)
+    if buffer is not None:
+      imageData.RemoveObserver(buffer[1])
+
+  def getMemorySize(self):
+    return sum(buffer[0].nbytes for buffer in self.buffers.values())
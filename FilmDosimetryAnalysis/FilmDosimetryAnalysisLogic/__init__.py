@@ -1,2 +1,9 @@
 from .FilmDosimetryAnalysisLogic import *
 from .LineProfileLogic import *
+from .IntegralImage import *
+from .CalibrationMeasurementCache import *
+from .CalibrationUncertainty import *
+from .CalibrationModels import *
+from .SharedImageBuffer import *
+from .FilmRegistration2D import *
+from .RegistrationJob import *
@@ -0,0 +1,65 @@
+import math
+import unittest
+import numpy
+from FilmDosimetryAnalysisLogic import FilmDosimetryAnalysisLogic
+
+#
+# BoundedMinimizationTest
+#
+class BoundedMinimizationTest(unittest.TestCase):
+  """ Tests of the Brent minimizer used for optimizing the exponent of the power calibration function
+  """
+
+  def setUp(self):
+    self.logic = FilmDosimetryAnalysisLogic()
+
+  #------------------------------------------------------------------------------
+  def test_KnownMinima(self):
+    tolerance = 1e-6
+    for function, lowerBound, upperBound, expectedMinimum in [
+        (lambda x: (x-2.345)**2 + 1.0, 1.0, 4.0, 2.345),
+        (lambda x: math.cosh(x-1.5), 1.0, 4.0, 1.5),
+        (lambda x: abs(x-3.21), 1.0, 4.0, 3.21), # Not smooth at the minimum
+        (lambda x: x**4 - 3.0*x**3, 0.0, 4.0, 2.25) ]:
+      minimum, functionValue, iterations = self.logic.minimizeBounded(function, lowerBound, upperBound, tolerance)
+      self.assertAlmostEqual(minimum, expectedMinimum, delta=10*tolerance)
+      self.assertAlmostEqual(functionValue, function(minimum))
+      self.assertLess(iterations, 100)
+
+  #------------------------------------------------------------------------------
+  def test_MinimumAtBound(self):
+    # Monotonic function: the minimum is approached within the tolerance of the bound, and never evaluated outside
+    evaluatedPoints = []
+    def function(x):
+      evaluatedPoints.append(x)
+      return x
+    minimum, functionValue, iterations = self.logic.minimizeBounded(function, 1.0, 4.0, 1e-4)
+    self.assertLess(minimum - 1.0, 1e-3)
+    self.assertGreaterEqual(min(evaluatedPoints), 1.0)
+    self.assertLessEqual(max(evaluatedPoints), 4.0)
+
+  #------------------------------------------------------------------------------
+  def test_MaximumNumberOfIterations(self):
+    minimum, functionValue, iterations = self.logic.minimizeBounded(lambda x: (x-2.345)**2, 1.0, 4.0, 1e-12, 3)
+    self.assertEqual(iterations, 3)
+
+  #------------------------------------------------------------------------------
+  def test_ExponentOptimizationMatchesGridSearch(self):
+    opticalDensities = numpy.array([0.02, 0.08, 0.15, 0.24, 0.33, 0.45, 0.58, 0.72, 0.85])
+    doses = 5.0 + 300.0 * opticalDensities + 900.0 * opticalDensities ** 2.537 + numpy.random.RandomState(0).normal(0.0, 3.0, len(opticalDensities))
+    self.logic.measuredOpticalDensityToDoseMap = numpy.column_stack([opticalDensities, doses]).tolist()
+
+    self.logic.calibrationExponentGridSearch = True
+    self.logic.findBestFittingCalibrationFunctionCoefficients()
+    gridSearchCoefficients = self.logic.calibrationCoefficients
+    self.logic.calibrationExponentGridSearch = False
+    self.logic.findBestFittingCalibrationFunctionCoefficients()
+    optimizedCoefficients = self.logic.calibrationCoefficients
+
+    # The grid has a 0.001 step, the optimization is at least as good as the best grid point
+    self.assertLessEqual(abs(optimizedCoefficients[3] - gridSearchCoefficients[3]), 0.001)
+    self.assertLessEqual(self.logic.meanSquaredError(*optimizedCoefficients), self.logic.meanSquaredError(*gridSearchCoefficients) + 1e-9)
+    self.assertLess(self.logic.calibrationExponentOptimizationIterations, 100)
+
+if __name__ == '__main__':
+  unittest.main()
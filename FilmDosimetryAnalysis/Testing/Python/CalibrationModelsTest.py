@@ -0,0 +1,90 @@
+import unittest
+import numpy
+from FilmDosimetryAnalysisLogic import FilmDosimetryAnalysisLogic
+from FilmDosimetryAnalysisLogic.CalibrationModels import createCalibrationModel, getCalibrationModelNames, PowerCalibrationModel
+
+#
+# CalibrationModelsTest
+#
+class CalibrationModelsTest(unittest.TestCase):
+  """ Tests of the calibration model fits on calibration points generated by known functions
+  """
+
+  def setUp(self):
+    self.opticalDensities = numpy.array([0.02, 0.08, 0.15, 0.24, 0.33, 0.45, 0.58, 0.72, 0.85])
+    self.numberOfPoints = len(self.opticalDensities)
+    # Full data set and all leave-one-out subsets
+    self.weights = numpy.vstack([numpy.ones(self.numberOfPoints), 1.0 - numpy.eye(self.numberOfPoints)])
+    randomState = numpy.random.RandomState(0)
+    self.noise = randomState.normal(0.0, 5.0, self.numberOfPoints)
+
+  def getExpectedParameters(self, modelName):
+    return { 'Power': [5.0, 300.0, 900.0, 2.5], 'Rational': [-50.0, -40.0, 1.2],
+      'Quadratic': [2.0, 350.0, 1200.0], 'Cubic': [2.0, 350.0, 800.0, 600.0] }[modelName]
+
+  #------------------------------------------------------------------------------
+  def test_ModelsAreRegistered(self):
+    self.assertEqual(getCalibrationModelNames(), ['Power', 'Rational', 'Quadratic', 'Cubic'])
+    self.assertIsInstance(createCalibrationModel('Power'), PowerCalibrationModel)
+    self.assertIsNone(createCalibrationModel('Unknown'))
+
+  #------------------------------------------------------------------------------
+  def test_FitRecoversParameters(self):
+    for modelName in getCalibrationModelNames():
+      calibrationModel = createCalibrationModel(modelName)
+      expectedParameters = self.getExpectedParameters(modelName)
+      doses = calibrationModel.evaluate(self.opticalDensities, expectedParameters)
+      parameters = calibrationModel.fit(self.opticalDensities, doses, self.weights[0:1])
+      self.assertEqual(parameters.shape, (1, calibrationModel.getNumberOfParameters()))
+      numpy.testing.assert_allclose(calibrationModel.evaluate(self.opticalDensities, parameters[0]), doses, atol=0.05, err_msg=modelName)
+      # Nonlinear parameters are refined from a grid of candidates, so the parameters are not exact
+      numpy.testing.assert_allclose(parameters[0], expectedParameters, rtol=1e-2, err_msg=modelName)
+
+  #------------------------------------------------------------------------------
+  def test_LeaveOneOutFitsMatchRefits(self):
+    """ Fits with zero weight on a point are the same as fits to the calibration points without it.
+        The rational model is not compared, as its candidate poles depend on the range of all points.
+    """
+    for modelName in ['Power', 'Quadratic', 'Cubic']:
+      calibrationModel = createCalibrationModel(modelName)
+      doses = calibrationModel.evaluate(self.opticalDensities, self.getExpectedParameters(modelName)) + self.noise
+      parameters = calibrationModel.fit(self.opticalDensities, doses, self.weights)
+      self.assertEqual(parameters.shape, (self.numberOfPoints+1, calibrationModel.getNumberOfParameters()))
+      for pointIndex in range(self.numberOfPoints):
+        keptPoints = numpy.arange(self.numberOfPoints) != pointIndex
+        refitParameters = calibrationModel.fit(self.opticalDensities[keptPoints], doses[keptPoints], numpy.ones((1, self.numberOfPoints-1)))[0]
+        numpy.testing.assert_allclose(parameters[1+pointIndex], refitParameters, rtol=1e-6, atol=1e-6, err_msg=modelName)
+
+  #------------------------------------------------------------------------------
+  def test_EvaluateInPlace(self):
+    for modelName in getCalibrationModelNames():
+      calibrationModel = createCalibrationModel(modelName)
+      parameters = self.getExpectedParameters(modelName)
+      expectedDoses = calibrationModel.evaluate(self.opticalDensities, parameters)
+      doses = self.opticalDensities.copy()
+      self.assertIs(calibrationModel.evaluate(doses, parameters, out=doses), doses)
+      numpy.testing.assert_allclose(doses, expectedDoses, err_msg=modelName)
+
+  #------------------------------------------------------------------------------
+  def test_ModelRankingLeaveOneOutErrors(self):
+    """ Leave-one-out dose errors of the model ranking match the errors of refits without each point
+    """
+    logic = FilmDosimetryAnalysisLogic()
+    doses = createCalibrationModel('Power').evaluate(self.opticalDensities, self.getExpectedParameters('Power')) + self.noise
+    logic.measuredOpticalDensityToDoseMap = numpy.column_stack([self.opticalDensities, doses]).tolist()
+    logic.rankCalibrationModels()
+    self.assertEqual(sorted(rankingEntry[0] for rankingEntry in logic.calibrationModelRanking), sorted(getCalibrationModelNames()))
+
+    for modelName, score, parameters, leaveOneOutRootMeanSquare in logic.calibrationModelRanking:
+      if modelName == 'Rational':
+        continue
+      calibrationModel = logic.getCalibrationModel(modelName)
+      leaveOneOutErrors = []
+      for pointIndex in range(self.numberOfPoints):
+        keptPoints = numpy.arange(self.numberOfPoints) != pointIndex
+        refitParameters = calibrationModel.fit(self.opticalDensities[keptPoints], doses[keptPoints], numpy.ones((1, self.numberOfPoints-1)))[0]
+        leaveOneOutErrors.append(calibrationModel.evaluate(self.opticalDensities[pointIndex], refitParameters) - doses[pointIndex])
+      self.assertAlmostEqual(leaveOneOutRootMeanSquare, numpy.sqrt(numpy.mean(numpy.square(leaveOneOutErrors))), places=6, msg=modelName)
+
+if __name__ == '__main__':
+  unittest.main()
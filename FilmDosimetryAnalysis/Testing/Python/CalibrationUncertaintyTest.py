@@ -0,0 +1,74 @@
+import unittest
+import numpy
+from FilmDosimetryAnalysisLogic.CalibrationUncertainty import CalibrationUncertainty, getFunctionTermsMatrices
+
+#
+# CalibrationUncertaintyTest
+#
+class CalibrationUncertaintyTest(unittest.TestCase):
+  """ Tests of the leave-one-out residuals and the residual bootstrap of the power calibration function
+  """
+
+  def setUp(self):
+    self.opticalDensities = numpy.array([0.02, 0.08, 0.15, 0.24, 0.33, 0.45, 0.58, 0.72, 0.85])
+    self.expectedCoefficients = [5.0, 300.0, 900.0, 2.5]
+    randomState = numpy.random.RandomState(0)
+    self.doses = (self.expectedCoefficients[0] + self.expectedCoefficients[1] * self.opticalDensities
+      + self.expectedCoefficients[2] * self.opticalDensities ** self.expectedCoefficients[3] + randomState.normal(0.0, 5.0, len(self.opticalDensities)))
+    self.calibrationUncertainty = CalibrationUncertainty(self.opticalDensities, self.doses, [1.0, 4.0])
+    # Least squares coefficients a, b, c for the exponent
+    functionTermsMatrix = getFunctionTermsMatrices(self.opticalDensities, [self.expectedCoefficients[3]])[0]
+    self.coefficients = list(numpy.linalg.lstsq(functionTermsMatrix, self.doses, rcond=None)[0]) + [self.expectedCoefficients[3]]
+
+  #------------------------------------------------------------------------------
+  def test_LeaveOneOutResidualsMatchRefits(self):
+    residuals, rootMeanSquare = self.calibrationUncertainty.computeLeaveOneOutResiduals(self.coefficients)
+    functionTermsMatrix = getFunctionTermsMatrices(self.opticalDensities, [self.coefficients[3]])[0]
+    expectedResiduals = []
+    for pointIndex in range(len(self.doses)):
+      keptPoints = numpy.arange(len(self.doses)) != pointIndex
+      refitCoefficients = numpy.linalg.lstsq(functionTermsMatrix[keptPoints], self.doses[keptPoints], rcond=None)[0]
+      expectedResiduals.append(self.doses[pointIndex] - numpy.dot(functionTermsMatrix[pointIndex], refitCoefficients))
+    numpy.testing.assert_allclose(residuals, expectedResiduals, rtol=1e-8, atol=1e-8)
+    self.assertAlmostEqual(rootMeanSquare, numpy.sqrt(numpy.mean(numpy.square(expectedResiduals))))
+
+  #------------------------------------------------------------------------------
+  def test_LeaveOneOutResidualUndefined(self):
+    # Only one point has nonzero optical density, so the slope is determined by that point alone
+    calibrationUncertainty = CalibrationUncertainty([0.0, 0.0, 0.0, 0.5], [1.0, 2.0, 3.0, 100.0], [1.0, 4.0])
+    residuals, rootMeanSquare = calibrationUncertainty.computeLeaveOneOutResiduals([2.0, 196.0, 0.0, 2.0])
+    self.assertTrue(numpy.isnan(residuals[3]))
+    self.assertTrue(numpy.all(numpy.isfinite(residuals[0:3])))
+    self.assertTrue(numpy.isfinite(rootMeanSquare))
+
+  #------------------------------------------------------------------------------
+  def test_BootstrapCoefficients(self):
+    self.calibrationUncertainty.numberOfResamples = 600
+    self.calibrationUncertainty.numberOfResamplesPerTask = 100
+    bootstrapCoefficients = self.calibrationUncertainty.computeBootstrapCoefficients(self.coefficients)
+    self.assertEqual(bootstrapCoefficients.shape, (600, 4))
+    self.assertTrue(numpy.all(bootstrapCoefficients[:,3] >= 1.0))
+    self.assertTrue(numpy.all(bootstrapCoefficients[:,3] <= 4.0))
+
+    # Independent of the number of threads
+    self.calibrationUncertainty.numberOfThreads = 4
+    numpy.testing.assert_array_equal(self.calibrationUncertainty.computeBootstrapCoefficients(self.coefficients), bootstrapCoefficients)
+
+    # The dose uncertainty band contains the fitted calibration function
+    lowerDoses, upperDoses = self.calibrationUncertainty.getDoseUncertaintyBand(self.opticalDensities)
+    functionTermsMatrix = getFunctionTermsMatrices(self.opticalDensities, [self.coefficients[3]])[0]
+    fittedDoses = numpy.dot(functionTermsMatrix, self.coefficients[0:3])
+    self.assertTrue(numpy.all(lowerDoses <= fittedDoses))
+    self.assertTrue(numpy.all(fittedDoses <= upperDoses))
+    confidenceIntervals = self.calibrationUncertainty.getCoefficientConfidenceIntervals()
+    self.assertEqual(confidenceIntervals.shape, (4, 2))
+    self.assertTrue(numpy.all(confidenceIntervals[:,0] <= confidenceIntervals[:,1]))
+
+  #------------------------------------------------------------------------------
+  def test_BootstrapNeedsMorePointsThanParameters(self):
+    calibrationUncertainty = CalibrationUncertainty(self.opticalDensities[0:4], self.doses[0:4], [1.0, 4.0])
+    self.assertIsNone(calibrationUncertainty.computeBootstrapCoefficients(self.coefficients))
+    self.assertIsNone(calibrationUncertainty.getDoseUncertaintyBand(self.opticalDensities))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,192 @@
+import math
+import unittest
+import numpy
+from __main__ import vtk, slicer
+from vtk.util import numpy_support
+from FilmDosimetryAnalysisLogic import FilmDosimetryAnalysisLogic
+
+#
+# DoseConversionTest
+#
+class DoseConversionTest(unittest.TestCase):
+  """ Tests of the film to dose conversion against the calibration function evaluated pixel by pixel
+  """
+
+  def setUp(self):
+    slicer.mrmlScene.Clear(0)
+    self.logic = FilmDosimetryAnalysisLogic()
+    # Negative constant term, so that the dose of low optical densities is clamped to zero
+    self.logic.calibrationCoefficients = [-2.0, 300.0, 900.0, 2.5]
+
+    # 16-bit scans with invalid (zero) pixels on the film and on the flood field, and film pixels brighter than the flood field
+    self.numberOfRows = 40
+    self.numberOfColumns = 50
+    randomState = numpy.random.RandomState(0)
+    self.filmArray = randomState.randint(2000, 60000, size=self.numberOfRows*self.numberOfColumns).astype(numpy.uint16)
+    self.filmArray[[3, 17, 1234]] = 0
+    self.floodFieldArray = randomState.randint(59000, 61000, size=self.numberOfRows*self.numberOfColumns).astype(numpy.uint16)
+    self.floodFieldArray[[5, 17, 1500]] = 0
+    self.filmArray[[20, 21]] = 65000
+
+  def tearDown(self):
+    slicer.mrmlScene.Clear(0)
+
+  def createVolumeNode(self, array, name):
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(self.numberOfColumns, self.numberOfRows, 1)
+    imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(array, deep=1))
+    volumeNode = slicer.vtkMRMLScalarVolumeNode()
+    volumeNode.SetName(name)
+    slicer.mrmlScene.AddNode(volumeNode)
+    volumeNode.SetAndObserveImageData(imageData)
+    return volumeNode
+
+  def calculateExpectedDose(self, pixelValues, floodFieldPixelValues):
+    """ Dose (Gy) and number of invalid pixels by evaluating dose = a + b*OD + c*OD^n (cGy) for each pixel
+    """
+    a, b, c, n = self.logic.calibrationCoefficients
+    doses = []
+    numberOfInvalidPixels = 0
+    for pixelValue, floodFieldPixelValue in zip(pixelValues, numpy.broadcast_to(floodFieldPixelValues, pixelValues.shape)):
+      if pixelValue <= 0 or floodFieldPixelValue <= 0:
+        numberOfInvalidPixels += 1
+        doses.append(0.0)
+        continue
+      opticalDensity = max(math.log10(float(floodFieldPixelValue) / float(pixelValue)), 0.0)
+      doses.append(max((a + b * opticalDensity + c * opticalDensity ** n) / 100.0, 0.0))
+    return numpy.array(doses), numberOfInvalidPixels
+
+  def assertDoseEqual(self, doseArrayGy, numberOfInvalidPixels, expectedDoseArrayGy, expectedNumberOfInvalidPixels, tolerance=1e-12):
+    self.assertEqual(doseArrayGy.shape, expectedDoseArrayGy.shape)
+    self.assertEqual(numberOfInvalidPixels, expectedNumberOfInvalidPixels)
+    maximumDoseErrorGy = float(numpy.abs(numpy.asarray(doseArrayGy, dtype=numpy.float64) - expectedDoseArrayGy).max())
+    self.assertLessEqual(maximumDoseErrorGy, tolerance * expectedDoseArrayGy.max())
+
+  #------------------------------------------------------------------------------
+  def test_PixelValueArrayConversion(self):
+    expectedDoseArrayGy, expectedNumberOfInvalidPixels = self.calculateExpectedDose(self.filmArray, self.floodFieldArray)
+    self.assertEqual(expectedNumberOfInvalidPixels, 5)
+    doseArrayGy, numberOfInvalidPixels = self.logic.calculateDoseFromPixelValueArray(self.filmArray, self.floodFieldArray)
+    self.assertDoseEqual(doseArrayGy, numberOfInvalidPixels, expectedDoseArrayGy, expectedNumberOfInvalidPixels)
+
+    # Scalar flood field value
+    floodFieldPixelValue = float(self.floodFieldArray.mean())
+    doseArrayGy, numberOfInvalidPixels = self.logic.calculateDoseFromPixelValueArray(self.filmArray, floodFieldPixelValue)
+    self.assertDoseEqual(doseArrayGy, numberOfInvalidPixels, *self.calculateExpectedDose(self.filmArray, floodFieldPixelValue))
+
+  #------------------------------------------------------------------------------
+  def test_LookupTableConversion(self):
+    """ Integer films normalized by the mean of the flood field are converted by a lookup table
+    """
+    self.logic.useExperimentalFloodFieldMeanValue = True
+    experimentalFilmVolumeNode = self.createVolumeNode(self.filmArray, 'Film')
+    experimentalFloodFieldVolumeNode = self.createVolumeNode(self.floodFieldArray, 'FloodField')
+    doseArrayGy = self.logic.calculateDoseFromExperimentalFilmImage(experimentalFilmVolumeNode, experimentalFloodFieldVolumeNode)
+    floodFieldPixelValue = self.floodFieldArray.mean(dtype=numpy.float64)
+    self.assertDoseEqual(doseArrayGy, self.logic.experimentalFilmInvalidPixelCount, *self.calculateExpectedDose(self.filmArray, floodFieldPixelValue))
+    self.assertIsNotNone(self.logic.pixelValueToDoseLookupTable)
+
+    # Signed and 8-bit pixel types, negative pixel values are invalid
+    for pixelValueArray in [self.filmArray.astype(numpy.int32).astype(numpy.int16), (self.filmArray // 256).astype(numpy.uint8)]:
+      doseArrayGy, numberOfInvalidPixels = self.logic.calculateDoseFromPixelValueArrayUsingLookupTable(pixelValueArray, 200.0)
+      self.assertDoseEqual(doseArrayGy, numberOfInvalidPixels, *self.calculateExpectedDose(pixelValueArray, 200.0))
+
+  #------------------------------------------------------------------------------
+  def test_FloodFieldLogarithmMapConversion(self):
+    """ Films normalized pixel by pixel with the flood field image are converted using its cached log10 map
+    """
+    self.logic.doseConversionTileNumberOfRows = 0
+    experimentalFilmVolumeNode = self.createVolumeNode(self.filmArray, 'Film')
+    experimentalFloodFieldVolumeNode = self.createVolumeNode(self.floodFieldArray, 'FloodField')
+    expectedDoseArrayGy, expectedNumberOfInvalidPixels = self.calculateExpectedDose(self.filmArray, self.floodFieldArray)
+    doseArrayGy = self.logic.calculateDoseFromExperimentalFilmImage(experimentalFilmVolumeNode, experimentalFloodFieldVolumeNode)
+    self.assertDoseEqual(doseArrayGy, self.logic.experimentalFilmInvalidPixelCount, expectedDoseArrayGy, expectedNumberOfInvalidPixels)
+
+    # The map is reused for the next film, including films of floating point pixel type
+    floodFieldLogarithmArray = self.logic.getFloodFieldLogarithmArray(experimentalFloodFieldVolumeNode)
+    self.assertEqual(floodFieldLogarithmArray.dtype, numpy.float64)
+    floatFilmArray = self.filmArray.astype(numpy.float32)
+    floatFilmArray[7] = -1.0
+    experimentalFilmVolumeNode = self.createVolumeNode(floatFilmArray, 'FloatFilm')
+    doseArrayGy = self.logic.calculateDoseFromExperimentalFilmImage(experimentalFilmVolumeNode, experimentalFloodFieldVolumeNode)
+    self.assertDoseEqual(doseArrayGy, self.logic.experimentalFilmInvalidPixelCount, *self.calculateExpectedDose(floatFilmArray, self.floodFieldArray))
+    self.assertIs(self.logic.getFloodFieldLogarithmArray(experimentalFloodFieldVolumeNode), floodFieldLogarithmArray)
+
+    # Single precision pipeline uses a float32 map
+    self.logic.useSinglePrecisionPipeline = True
+    self.assertEqual(self.logic.getFloodFieldLogarithmArray(experimentalFloodFieldVolumeNode).dtype, numpy.float32)
+
+  #------------------------------------------------------------------------------
+  def test_TiledConversion(self):
+    """ Films converted tile by tile, with streamed flood field rows or a scalar flood field value, into an in-memory or memory-mapped buffer
+    """
+    experimentalFilmVolumeNode = self.createVolumeNode(self.filmArray, 'Film')
+    experimentalFloodFieldVolumeNode = self.createVolumeNode(self.floodFieldArray, 'FloodField')
+    floodFieldPixelValue = self.floodFieldArray.mean(dtype=numpy.float64)
+    floatFilmArray = self.filmArray.astype(numpy.float32)
+    # Tile size that does not divide the number of rows
+    self.logic.doseConversionTileNumberOfRows = 7
+    for useMemoryMappedDoseBuffer in [False, True]:
+      self.logic.useMemoryMappedDoseBuffer = useMemoryMappedDoseBuffer
+      doseArrayGy, numberOfInvalidPixels = self.logic.calculateDoseFromFilmRows(self.filmArray, self.numberOfColumns, experimentalFloodFieldVolumeNode)
+      self.assertEqual(isinstance(doseArrayGy, numpy.memmap), useMemoryMappedDoseBuffer)
+      self.assertDoseEqual(doseArrayGy, numberOfInvalidPixels, *self.calculateExpectedDose(self.filmArray, self.floodFieldArray))
+      # Floating point films are not converted by lookup table
+      doseArrayGy, numberOfInvalidPixels = self.logic.calculateDoseFromFilmRows(floatFilmArray, self.numberOfColumns, experimentalFloodFieldVolumeNode, floodFieldPixelValue)
+      self.assertDoseEqual(doseArrayGy, numberOfInvalidPixels, *self.calculateExpectedDose(floatFilmArray, floodFieldPixelValue))
+
+    # Selected rows only
+    self.logic.useMemoryMappedDoseBuffer = False
+    rowIndices = [0, 5, 6, 7, 39]
+    doseArrayGy, numberOfInvalidPixels = self.logic.calculateDoseFromFilmRows(self.filmArray, self.numberOfColumns, experimentalFloodFieldVolumeNode, rowIndices=rowIndices)
+    selectRows = lambda array: array.reshape(self.numberOfRows, self.numberOfColumns)[rowIndices].ravel()
+    self.assertDoseEqual(doseArrayGy, numberOfInvalidPixels, *self.calculateExpectedDose(selectRows(self.filmArray), selectRows(self.floodFieldArray)))
+
+  #------------------------------------------------------------------------------
+  def test_ThreadedConversion(self):
+    """ Tiles converted by multiple threads give the same dose as a single thread, with and without a tile size
+    """
+    experimentalFloodFieldVolumeNode = self.createVolumeNode(self.floodFieldArray, 'FloodField')
+    expectedDoseArrayGy, expectedNumberOfInvalidPixels = self.calculateExpectedDose(self.filmArray, self.floodFieldArray)
+    for tileNumberOfRows in [0, 3, 7]:
+      self.logic.doseConversionTileNumberOfRows = tileNumberOfRows
+      self.logic.numberOfDoseConversionThreads = 1
+      singleThreadDoseArrayGy, singleThreadNumberOfInvalidPixels = self.logic.calculateDoseFromFilmRows(self.filmArray, self.numberOfColumns, experimentalFloodFieldVolumeNode)
+      self.logic.numberOfDoseConversionThreads = 4
+      doseArrayGy, numberOfInvalidPixels = self.logic.calculateDoseFromFilmRows(self.filmArray, self.numberOfColumns, experimentalFloodFieldVolumeNode)
+      numpy.testing.assert_array_equal(doseArrayGy, singleThreadDoseArrayGy)
+      self.assertEqual(numberOfInvalidPixels, singleThreadNumberOfInvalidPixels)
+      self.assertDoseEqual(doseArrayGy, numberOfInvalidPixels, expectedDoseArrayGy, expectedNumberOfInvalidPixels)
+
+      # Scalar flood field value on a floating point film
+      floodFieldPixelValue = self.floodFieldArray.mean(dtype=numpy.float64)
+      floatFilmArray = self.filmArray.astype(numpy.float64)
+      doseArrayGy, numberOfInvalidPixels = self.logic.calculateDoseFromFilmRows(floatFilmArray, self.numberOfColumns, experimentalFloodFieldVolumeNode, floodFieldPixelValue)
+      self.assertDoseEqual(doseArrayGy, numberOfInvalidPixels, *self.calculateExpectedDose(floatFilmArray, floodFieldPixelValue))
+
+  #------------------------------------------------------------------------------
+  def test_SinglePrecisionAccuracyCheck(self):
+    """ The reported single precision error is the error of the float32 dose against the exact dose, on each conversion path
+    """
+    experimentalFilmVolumeNode = self.createVolumeNode(self.filmArray, 'Film')
+    experimentalFloodFieldVolumeNode = self.createVolumeNode(self.floodFieldArray, 'FloodField')
+    self.logic.singlePrecisionAccuracyCheckNumberOfRows = self.numberOfRows
+    for useExperimentalFloodFieldMeanValue, tileNumberOfRows in [(True, 0), (False, 0), (False, 7)]:
+      self.logic.useExperimentalFloodFieldMeanValue = useExperimentalFloodFieldMeanValue
+      self.logic.doseConversionTileNumberOfRows = tileNumberOfRows
+      floodFieldPixelValue = self.floodFieldArray.mean(dtype=numpy.float64) if useExperimentalFloodFieldMeanValue else self.floodFieldArray
+      expectedDoseArrayGy, expectedNumberOfInvalidPixels = self.calculateExpectedDose(self.filmArray, floodFieldPixelValue)
+
+      self.logic.useSinglePrecisionPipeline = True
+      doseArrayGy = self.logic.calculateDoseFromExperimentalFilmImage(experimentalFilmVolumeNode, experimentalFloodFieldVolumeNode)
+      self.assertEqual(doseArrayGy.dtype, numpy.float32)
+      self.assertDoseEqual(doseArrayGy, self.logic.experimentalFilmInvalidPixelCount, expectedDoseArrayGy, expectedNumberOfInvalidPixels, tolerance=1e-5)
+
+      maximumDoseErrorGy, maximumRelativeDoseErrorPercent = self.logic.checkSinglePrecisionDoseAccuracy(experimentalFilmVolumeNode, experimentalFloodFieldVolumeNode)
+      expectedMaximumDoseErrorGy = numpy.abs(doseArrayGy.astype(numpy.float64) - expectedDoseArrayGy).max()
+      self.assertAlmostEqual(maximumDoseErrorGy, expectedMaximumDoseErrorGy, delta=1e-9*expectedDoseArrayGy.max())
+      self.assertAlmostEqual(maximumRelativeDoseErrorPercent, 100.0 * expectedMaximumDoseErrorGy / expectedDoseArrayGy.max(), delta=1e-7)
+      self.assertTrue(self.logic.useSinglePrecisionPipeline)
+
+if __name__ == '__main__':
+  unittest.main()
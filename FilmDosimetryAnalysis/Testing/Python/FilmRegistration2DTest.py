@@ -0,0 +1,235 @@
+import math
+import unittest
+import numpy
+from FilmDosimetryAnalysisLogic.FilmRegistration2D import AlignmentMetric2D, RigidRegistration2D, MultiStartRigidRegistration2D, OrientationSearch2D, computeMomentAlignmentMatrix, computePhaseCorrelationShift
+
+#------------------------------------------------------------------------------
+def getSyntheticDose(u, v):
+  """ Asymmetric dose distribution (two peaks and a rectangular field with a 2 mm penumbra) at plane coordinates u, v (mm)
+  """
+  def edge(x, position):
+    return 1.0 / (1.0 + numpy.exp(-(x-position) / 2.0))
+  return (numpy.exp(-((u-60.0)**2/500.0 + (v-70.0)**2/900.0))
+    + 0.6 * numpy.exp(-((u-100.0)**2/200.0 + (v-40.0)**2/150.0))
+    + 0.3 * edge(u, 40.0) * edge(-u, -85.0) * edge(v, 30.0) * edge(-v, -110.0))
+
+#
+# FilmRegistration2DTest
+#
+class FilmRegistration2DTest(unittest.TestCase):
+  """ Tests of the numpy in-plane film to dose registration on synthetic images with a known transform
+  """
+
+  def setUp(self):
+    # Dose slice: 2 mm pixels, 60 rows and 70 columns
+    self.fixedSpacing = [2.0, 2.0]
+    self.doseOffset = 0.0 # Shift of the synthetic dose distribution along both plane axes (mm)
+    self.fixedArray = self.createFixedArray((60, 70))
+    # Film: 0.5 mm pixels covering the plane from (-10,-10) mm, pixel index = (plane coordinate + 10) / 0.5
+    self.movingPixelSize = 0.5
+    self.movingOrigin = -10.0
+    self.movingShape = (320, 360)
+    self.planeToMovingIndexMatrix = [[1.0/self.movingPixelSize, 0.0, -self.movingOrigin/self.movingPixelSize],
+      [0.0, 1.0/self.movingPixelSize, -self.movingOrigin/self.movingPixelSize]]
+
+  def createRegistration(self, movingArray):
+    return RigidRegistration2D(self.fixedArray, self.fixedSpacing, movingArray, self.planeToMovingIndexMatrix)
+
+  def createFixedArray(self, shape):
+    rows, columns = numpy.mgrid[0:shape[0], 0:shape[1]]
+    return getSyntheticDose(columns * self.fixedSpacing[0] - self.doseOffset, rows * self.fixedSpacing[1] - self.doseOffset)
+
+  def createMovingArray(self, movingToFixedPlaneMatrix):
+    """ Film image whose pixel at moving plane coordinates q shows the dose at fixed plane coordinates M q
+    """
+    rows, columns = numpy.mgrid[0:self.movingShape[0], 0:self.movingShape[1]]
+    movingPlaneCoordinates = numpy.vstack([self.movingOrigin + columns.ravel() * self.movingPixelSize,
+      self.movingOrigin + rows.ravel() * self.movingPixelSize, numpy.ones(rows.size)])
+    fixedPlaneCoordinates = numpy.dot(movingToFixedPlaneMatrix, movingPlaneCoordinates)
+    return getSyntheticDose(fixedPlaneCoordinates[0] - self.doseOffset, fixedPlaneCoordinates[1] - self.doseOffset).reshape(self.movingShape)
+
+  #------------------------------------------------------------------------------
+  def test_PhaseCorrelationShift(self):
+    """ The shift moves the moving image onto the fixed image, including its sign on both axes
+    """
+    randomState = numpy.random.RandomState(0)
+    fixedArray = randomState.rand(64, 80)
+    fixedArray -= fixedArray.mean()
+    movingArray = numpy.roll(fixedArray, (3, -5), axis=(0, 1))
+    (rowShift, columnShift), peak = computePhaseCorrelationShift(fixedArray, movingArray)
+    self.assertAlmostEqual(rowShift, -3.0, places=6)
+    self.assertAlmostEqual(columnShift, 5.0, places=6)
+    self.assertGreater(peak, 0.9)
+
+  #------------------------------------------------------------------------------
+  def test_InitialTranslation(self):
+    """ Small and large offsets, the large one on a film much smaller than the dose slice
+    """
+    movingToFixedPlaneMatrix = self.createRegistration(numpy.zeros((2,2))).getPlaneTransformMatrix([0.0, 6.0, -4.0])
+    registration = self.createRegistration(self.createMovingArray(movingToFixedPlaneMatrix))
+    translation, peak = registration.estimateInitialTranslation()
+    self.assertLess(abs(translation[0] - 6.0), self.fixedSpacing[0])
+    self.assertLess(abs(translation[1] + 4.0), self.fixedSpacing[1])
+
+    self.doseOffset = 90.0
+    self.fixedArray = self.createFixedArray((150, 150))
+    self.movingOrigin = 40.0
+    self.movingShape = (200, 200)
+    self.planeToMovingIndexMatrix = [[1.0/self.movingPixelSize, 0.0, -self.movingOrigin/self.movingPixelSize],
+      [0.0, 1.0/self.movingPixelSize, -self.movingOrigin/self.movingPixelSize]]
+    movingToFixedPlaneMatrix = self.createRegistration(numpy.zeros((2,2))).getPlaneTransformMatrix([0.0, 63.0, 52.0])
+    registration = self.createRegistration(self.createMovingArray(movingToFixedPlaneMatrix))
+    translation, peak = registration.estimateInitialTranslation()
+    self.assertLess(abs(translation[0] - 63.0), self.fixedSpacing[0])
+    self.assertLess(abs(translation[1] - 52.0), self.fixedSpacing[1])
+
+  #------------------------------------------------------------------------------
+  def test_RegistrationRecoversTransform(self):
+    expectedParameters = [3.0, 4.2, -2.7]
+    movingToFixedPlaneMatrix = self.createRegistration(numpy.zeros((2,2))).getPlaneTransformMatrix(expectedParameters)
+    registration = self.createRegistration(self.createMovingArray(movingToFixedPlaneMatrix))
+    parameters = registration.register()
+    self.assertLess(abs(parameters[0] - expectedParameters[0]), 0.05)
+    self.assertLess(abs(parameters[1] - expectedParameters[1]), 0.05)
+    self.assertLess(abs(parameters[2] - expectedParameters[2]), 0.05)
+    self.assertGreater(registration.normalizedCrossCorrelation, 0.99)
+
+    # The plane transform matrix of the result converts back to the same parameters
+    recoveredParameters = registration.getParametersFromPlaneTransformMatrix(registration.getPlaneTransformMatrix())
+    numpy.testing.assert_allclose(recoveredParameters, parameters, atol=1e-9)
+
+  #------------------------------------------------------------------------------
+  def test_FilmMuchSmallerThanDoseSlice(self):
+    """ 10x10 cm film on a 30x30 cm dose slice, where the film covers about a tenth of the slice
+    """
+    self.doseOffset = 90.0
+    self.fixedArray = self.createFixedArray((150, 150))
+    self.movingOrigin = 100.0
+    self.movingShape = (200, 200)
+    self.planeToMovingIndexMatrix = [[1.0/self.movingPixelSize, 0.0, -self.movingOrigin/self.movingPixelSize],
+      [0.0, 1.0/self.movingPixelSize, -self.movingOrigin/self.movingPixelSize]]
+    expectedParameters = [2.0, 3.0, -2.0]
+    movingToFixedPlaneMatrix = self.createRegistration(numpy.zeros((2,2))).getPlaneTransformMatrix(expectedParameters)
+    registration = self.createRegistration(self.createMovingArray(movingToFixedPlaneMatrix))
+    self.assertIsNotNone(registration.computeMetric([0.0, 0.0, 0.0], registration.createFullResolutionLevel()))
+    parameters = registration.register()
+    numpy.testing.assert_allclose(parameters, expectedParameters, atol=0.05)
+    self.assertGreater(registration.normalizedCrossCorrelation, 0.99)
+
+    # Film moved to the edge of the dose slice
+    self.assertIsNone(registration.computeMetric([0.0, 190.0, 0.0], registration.createFullResolutionLevel()))
+
+  #------------------------------------------------------------------------------
+  def test_MultiStartRegistration(self):
+    """ Starts registered in parallel threads give the same results as in one thread, and the progress reaches 1 once
+    """
+    expectedParameters = [-4.0, 6.0, 5.0]
+    movingToFixedPlaneMatrix = self.createRegistration(numpy.zeros((2,2))).getPlaneTransformMatrix(expectedParameters)
+    movingArray = self.createMovingArray(movingToFixedPlaneMatrix)
+    results = []
+    for numberOfThreads in [1, 4]:
+      registration = MultiStartRigidRegistration2D(self.fixedArray, self.fixedSpacing, movingArray, self.planeToMovingIndexMatrix)
+      registration.numberOfThreads = numberOfThreads
+      progressValues = []
+      registration.progressCallback = progressValues.append
+      parameters = registration.register()
+      numpy.testing.assert_allclose(parameters, expectedParameters, atol=0.05)
+      numberOfStarts = len(registration.getStartParameters())
+      self.assertEqual(len(registration.results), numberOfStarts)
+      self.assertEqual(progressValues, [float(index+1) / numberOfStarts for index in range(numberOfStarts)])
+      results.append(registration.results)
+    self.assertEqual(sorted(results[0]), sorted(results[1]))
+
+  #------------------------------------------------------------------------------
+  def test_OrientationSearchFindsFlippedFilm(self):
+    """ Film scanned upside down (flipped vertically) and rotated by 90 degrees. The search finds the orientation
+        approximately, and the registration initialized by its result recovers the transform.
+    """
+    angle = math.radians(90.0)
+    linearMatrix = numpy.dot(numpy.array([[math.cos(angle), -math.sin(angle)], [math.sin(angle), math.cos(angle)]]), numpy.diag([1.0, -1.0]))
+    movingToFixedPlaneMatrix = numpy.identity(3)
+    movingToFixedPlaneMatrix[0:2,0:2] = linearMatrix
+    movingToFixedPlaneMatrix[0:2,2] = [5.0, 3.0]
+    movingArray = self.createMovingArray(movingToFixedPlaneMatrix)
+
+    orientationSearch = OrientationSearch2D(self.fixedArray, self.fixedSpacing, movingArray, self.planeToMovingIndexMatrix, 64)
+    score, flip, angleDegrees, planeTransformMatrix = orientationSearch.search()
+    self.assertTrue(flip)
+    self.assertLessEqual(abs(angleDegrees - 90.0), orientationSearch.fineAngleRangeDegrees)
+    # All other flips and 90 degree rotations score lower
+    otherScores = [result[0] for result in orientationSearch.results if result[1] != flip or (result[2] % 90.0 == 0.0 and result[2] != 90.0)]
+    self.assertGreater(score, max(otherScores))
+
+    # Register the film oriented by the search result
+    orientedPlaneToMovingIndexMatrix = numpy.dot(numpy.vstack([self.planeToMovingIndexMatrix, [0.0, 0.0, 1.0]]), numpy.linalg.inv(planeTransformMatrix))
+    registration = RigidRegistration2D(self.fixedArray, self.fixedSpacing, movingArray, orientedPlaneToMovingIndexMatrix[0:2,:])
+    registration.register()
+    recoveredMatrix = numpy.dot(registration.getPlaneTransformMatrix(), planeTransformMatrix)
+    numpy.testing.assert_allclose(recoveredMatrix[0:2,0:2], linearMatrix, atol=0.002)
+    numpy.testing.assert_allclose(recoveredMatrix[0:2,2], movingToFixedPlaneMatrix[0:2,2], atol=0.2)
+
+  #------------------------------------------------------------------------------
+  def test_OrientationSearchOnSmallFilm(self):
+    """ Film rotated by 180 degrees, much smaller than the dose slice
+    """
+    self.doseOffset = 90.0
+    self.fixedArray = self.createFixedArray((150, 150))
+    self.movingOrigin = 100.0
+    self.movingShape = (200, 200)
+    self.planeToMovingIndexMatrix = [[1.0/self.movingPixelSize, 0.0, -self.movingOrigin/self.movingPixelSize],
+      [0.0, 1.0/self.movingPixelSize, -self.movingOrigin/self.movingPixelSize]]
+    # Rotation around the center of the film
+    movingToFixedPlaneMatrix = numpy.diag([-1.0, -1.0, 1.0])
+    movingToFixedPlaneMatrix[0:2,2] = [2.0 * 150.0 + 4.0, 2.0 * 150.0 - 3.0]
+    orientationSearch = OrientationSearch2D(self.fixedArray, self.fixedSpacing, self.createMovingArray(movingToFixedPlaneMatrix), self.planeToMovingIndexMatrix, 64)
+    score, flip, angleDegrees, planeTransformMatrix = orientationSearch.search()
+    self.assertFalse(flip)
+    self.assertLessEqual(abs(angleDegrees - 180.0), orientationSearch.fineAngleRangeDegrees)
+    self.assertGreater(score, 0.9)
+
+  #------------------------------------------------------------------------------
+  def test_MomentAlignment(self):
+    """ Film rotated and shifted with its dose distribution inside the dose slice
+    """
+    angle = math.radians(20.0)
+    movingToFixedPlaneMatrix = numpy.identity(3)
+    movingToFixedPlaneMatrix[0:2,0:2] = [[math.cos(angle), -math.sin(angle)], [math.sin(angle), math.cos(angle)]]
+    movingToFixedPlaneMatrix[0:2,2] = [30.0, -12.0]
+    movingArray = self.createMovingArray(movingToFixedPlaneMatrix)
+    matrix = computeMomentAlignmentMatrix(self.fixedArray, self.fixedSpacing, movingArray, self.planeToMovingIndexMatrix)
+    numpy.testing.assert_allclose(matrix[0:2,0:2], movingToFixedPlaneMatrix[0:2,0:2], atol=0.002)
+    numpy.testing.assert_allclose(matrix[0:2,2], movingToFixedPlaneMatrix[0:2,2], atol=0.1)
+
+    # Translation only
+    matrix = computeMomentAlignmentMatrix(self.fixedArray, self.fixedSpacing, movingArray, self.planeToMovingIndexMatrix, maximumAngleDegrees=0.0)
+    numpy.testing.assert_array_equal(matrix[0:2,0:2], numpy.identity(2))
+    self.assertIsNone(computeMomentAlignmentMatrix(self.fixedArray, self.fixedSpacing, numpy.zeros(self.movingShape), self.planeToMovingIndexMatrix))
+
+  #------------------------------------------------------------------------------
+  def test_AlignmentMetricOnSmallFilm(self):
+    """ Similarity of an 8x8 cm film on a 30x30 cm dose slice is computed, and is highest at the transform of the film
+    """
+    self.doseOffset = 90.0
+    self.fixedArray = self.createFixedArray((150, 150))
+    self.movingOrigin = 100.0
+    self.movingShape = (160, 160)
+    self.planeToMovingIndexMatrix = [[1.0/self.movingPixelSize, 0.0, -self.movingOrigin/self.movingPixelSize],
+      [0.0, 1.0/self.movingPixelSize, -self.movingOrigin/self.movingPixelSize]]
+    registration = self.createRegistration(numpy.zeros((2,2)))
+    movingToFixedPlaneMatrix = registration.getPlaneTransformMatrix([5.0, -3.0, 4.0])
+    alignmentMetric = AlignmentMetric2D(self.fixedArray, self.fixedSpacing, self.createMovingArray(movingToFixedPlaneMatrix), self.movingPixelSize)
+    planeToMovingIndexMatrix = numpy.vstack([self.planeToMovingIndexMatrix, [0.0, 0.0, 1.0]])
+
+    normalizedCrossCorrelation, meanAbsoluteDifference = alignmentMetric.compute(numpy.dot(planeToMovingIndexMatrix, numpy.linalg.inv(movingToFixedPlaneMatrix)))
+    self.assertGreater(normalizedCrossCorrelation, 0.99)
+    self.assertLess(meanAbsoluteDifference, 0.01)
+    misalignedNormalizedCrossCorrelation, misalignedMeanAbsoluteDifference = alignmentMetric.compute(self.planeToMovingIndexMatrix)
+    self.assertLess(misalignedNormalizedCrossCorrelation, normalizedCrossCorrelation)
+    self.assertGreater(misalignedMeanAbsoluteDifference, meanAbsoluteDifference)
+
+    # Film moved to the edge of the dose slice
+    movedPlaneToMovingIndexMatrix = numpy.dot(planeToMovingIndexMatrix, registration.getPlaneTransformMatrix([0.0, -195.0, 0.0]))
+    self.assertEqual(alignmentMetric.compute(movedPlaneToMovingIndexMatrix), (None, None))
+
+if __name__ == '__main__':
+  unittest.main()
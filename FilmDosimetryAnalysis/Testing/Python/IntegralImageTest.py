@@ -0,0 +1,84 @@
+import unittest
+import numpy
+from FilmDosimetryAnalysisLogic.IntegralImage import IntegralImage
+
+#
+# IntegralImageTest
+#
+class IntegralImageTest(unittest.TestCase):
+  """ Tests of the summed-area table statistics against brute force computation on the array
+  """
+
+  def setUp(self):
+    randomState = numpy.random.RandomState(0)
+    # Scanner-like 16-bit image with large values, where the variance of float sums would lose precision
+    self.integerArray = randomState.randint(60000, 65536, size=(3, 40, 50)).astype(numpy.uint16)
+    self.floatArray = randomState.normal(100.0, 5.0, size=(2, 30, 45))
+    self.boxes = [[0,0,0,0,0,0], [0,1,0,29,0,44], [1,1,5,17,3,30], [0,1,29,29,10,44]]
+
+  #------------------------------------------------------------------------------
+  def test_BoxStatistics(self):
+    for array in [self.integerArray, self.floatArray]:
+      integralImage = IntegralImage(array)
+      for box in self.boxes:
+        values = array[box[0]:box[1]+1, box[2]:box[3]+1, box[4]:box[5]+1].astype(numpy.float64)
+        self.assertAlmostEqual(integralImage.getBoxSum(integralImage.sumTable, box), values.sum(), delta=1e-9*abs(values.sum()))
+        mean, standardDeviation, numberOfVoxels = integralImage.getBoxStatistics(box)
+        self.assertEqual(numberOfVoxels, values.size)
+        self.assertAlmostEqual(mean, values.mean(), delta=1e-9*abs(values.mean()))
+        self.assertAlmostEqual(standardDeviation, values.std(), delta=1e-6)
+
+  #------------------------------------------------------------------------------
+  def test_IntegerSumsAreExact(self):
+    integralImage = IntegralImage(self.integerArray)
+    self.assertTrue(integralImage.isExact)
+    box = [0, 2, 0, 39, 0, 49]
+    self.assertEqual(integralImage.getBoxSum(integralImage.sumTable, box), int(self.integerArray.astype(numpy.int64).sum()))
+    self.assertEqual(integralImage.getBoxSum(integralImage.sumOfSquaresTable, box), int((self.integerArray.astype(numpy.int64)**2).sum()))
+    # Constant image has exactly zero standard deviation
+    self.assertEqual(IntegralImage(numpy.full((2, 10, 10), 65535, dtype=numpy.uint16)).getBoxStatistics([0,1,0,9,0,9])[1], 0.0)
+
+  #------------------------------------------------------------------------------
+  def test_EmptyBox(self):
+    self.assertIsNone(IntegralImage(self.floatArray).getBoxStatistics([0,1,5,4,0,10]))
+
+  #------------------------------------------------------------------------------
+  def test_SlidingWindowStatistics(self):
+    for array in [self.integerArray, self.floatArray]:
+      integralImage = IntegralImage(array)
+      for windowSize, stride, searchBox in [(1, 1, None), (7, 3, None), (5, 2, [4, 25, 6, 40])]:
+        rows, columns, windowMean, windowStandardDeviation = integralImage.getSlidingWindowStatistics(windowSize, stride, searchBox)
+        rowRange = [0, array.shape[1]-1] if searchBox is None else searchBox[0:2]
+        columnRange = [0, array.shape[2]-1] if searchBox is None else searchBox[2:4]
+        numpy.testing.assert_array_equal(rows, numpy.arange(rowRange[0], rowRange[1]-windowSize+2, stride))
+        numpy.testing.assert_array_equal(columns, numpy.arange(columnRange[0], columnRange[1]-windowSize+2, stride))
+        for rowIndex, row in enumerate(rows):
+          for columnIndex, column in enumerate(columns):
+            values = array[:, row:row+windowSize, column:column+windowSize].astype(numpy.float64)
+            self.assertAlmostEqual(windowMean[rowIndex, columnIndex], values.mean(), delta=1e-9*abs(values.mean()))
+            self.assertAlmostEqual(windowStandardDeviation[rowIndex, columnIndex], values.std(), delta=1e-6)
+
+    # Window larger than the search box
+    self.assertIsNone(IntegralImage(self.floatArray).getSlidingWindowStatistics(10, 1, [0, 5, 0, 20]))
+
+  #------------------------------------------------------------------------------
+  def test_LargestUniformWindow(self):
+    """ Noisy image with a uniform square region and a larger saturated region that is excluded by the mean range
+    """
+    randomState = numpy.random.RandomState(1)
+    array = numpy.round(randomState.normal(1000.0, 50.0, size=(1, 60, 80))).astype(numpy.uint16)
+    array[0, 10:30, 20:40] = 500
+    array[0, 35:60, 45:75] = 65535
+    integralImage = IntegralImage(array)
+
+    box = integralImage.findLargestUniformWindow(1.0, 4, meanRange=[0.0, 65535.0])
+    self.assertEqual(box, [0, 0, 10, 29, 20, 39])
+    # Without the mean range the larger saturated region is found
+    box = integralImage.findLargestUniformWindow(1.0, 4)
+    self.assertGreater(box[3]-box[2]+1, 20)
+    self.assertTrue(numpy.all(array[0, box[2]:box[3]+1, box[4]:box[5]+1] == 65535))
+    # No window is uniform within the noise
+    self.assertIsNone(integralImage.findLargestUniformWindow(1.0, 4, [0, 59, 0, 19]))
+
+if __name__ == '__main__':
+  unittest.main()
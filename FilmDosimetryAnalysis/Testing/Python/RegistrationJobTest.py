@@ -0,0 +1,126 @@
+import threading
+import unittest
+from FilmDosimetryAnalysisLogic.RegistrationJob import RegistrationJob, ThreadRegistrationJob
+
+#
+# StubRegistrationJob
+#
+class StubRegistrationJob(RegistrationJob):
+  """ Job whose work is controlled by the test. Like a CLI module, it does not stop at once when cancelled.
+  """
+
+  def __init__(self, onFinished=None):
+    RegistrationJob.__init__(self, 'Stub registration', onFinished)
+    self.workStatus = RegistrationJob.Running
+    self.workProgress = 0.0
+    self.numberOfCancelRequests = 0
+
+  def startWork(self):
+    return ''
+
+  def pollWork(self):
+    return self.workStatus, '', self.workProgress
+
+  def cancelWork(self):
+    self.numberOfCancelRequests += 1
+    return self.workStatus != RegistrationJob.Running
+
+#
+# RegistrationJobTest
+#
+class RegistrationJobTest(unittest.TestCase):
+  """ Tests of the non-blocking registration jobs, polled directly instead of by the timer
+  """
+
+  def setUp(self):
+    self.finishedJobs = []
+    self.progressValues = []
+    self.stopEvent = threading.Event()
+
+  def tearDown(self):
+    # Let threads of unfinished jobs return
+    self.stopEvent.set()
+
+  def createThreadJob(self, function, timeoutSeconds=None):
+    job = ThreadRegistrationJob('Test registration', function, cancelFunction=self.stopEvent.set,
+      onFinished=self.finishedJobs.append, onProgress=lambda job: self.progressValues.append(job.progress), timeoutSeconds=timeoutSeconds)
+    job.pollIntervalMs = 5
+    return job
+
+  def waitUntilStopped(self, progressCallback):
+    progressCallback(0.5)
+    self.stopEvent.wait(10.0)
+    return 'Stopped'
+
+  #------------------------------------------------------------------------------
+  def test_ThreadJobCompleted(self):
+    job = self.createThreadJob(lambda progressCallback: 42)
+    self.assertEqual(job.start(), '')
+    self.assertEqual(job.wait(), '')
+    self.assertEqual(job.status, RegistrationJob.Completed)
+    self.assertEqual(job.result, 42)
+    self.assertEqual(self.finishedJobs, [job])
+    self.assertEqual(self.progressValues[-1], 1.0)
+
+  #------------------------------------------------------------------------------
+  def test_ThreadJobFailed(self):
+    def fail(progressCallback):
+      raise ValueError('Images do not overlap')
+    job = self.createThreadJob(fail)
+    job.start()
+    self.assertEqual(job.wait(), 'Images do not overlap')
+    self.assertEqual(job.status, RegistrationJob.Failed)
+    self.assertIsNone(job.result)
+    self.assertEqual(self.finishedJobs, [job])
+
+  #------------------------------------------------------------------------------
+  def test_ThreadJobCancelled(self):
+    job = self.createThreadJob(self.waitUntilStopped)
+    job.start()
+    job.poll()
+    self.assertTrue(job.isRunning())
+    job.cancel()
+    # The thread is not waited for, the job finishes at once
+    self.assertTrue(self.stopEvent.is_set())
+    self.assertEqual(job.status, RegistrationJob.Cancelled)
+    self.assertEqual(self.finishedJobs, [job])
+    # Cancelling again or polling the finished job has no effect
+    job.cancel()
+    job.poll()
+    self.assertEqual(self.finishedJobs, [job])
+
+  #------------------------------------------------------------------------------
+  def test_ThreadJobTimedOut(self):
+    job = self.createThreadJob(self.waitUntilStopped, timeoutSeconds=0.05)
+    job.start()
+    self.assertNotEqual(job.wait(), '')
+    self.assertEqual(job.status, RegistrationJob.TimedOut)
+    self.assertTrue(self.stopEvent.is_set())
+    self.assertEqual(self.finishedJobs, [job])
+
+  #------------------------------------------------------------------------------
+  def test_CancelledJobFinishesWhenWorkStopped(self):
+    finishedJobs = []
+    job = StubRegistrationJob(finishedJobs.append)
+    job.start()
+    job.workProgress = 0.3
+    job.poll()
+    self.assertEqual(job.progress, 0.3)
+
+    job.cancel()
+    self.assertTrue(job.isCancelling())
+    self.assertEqual(job.status, RegistrationJob.Running)
+    job.poll()
+    self.assertEqual(finishedJobs, [])
+    job.cancel()
+    self.assertEqual(job.numberOfCancelRequests, 1)
+
+    # Work that completed after the cancel request is discarded
+    job.workStatus = RegistrationJob.Completed
+    job.poll()
+    self.assertEqual(job.status, RegistrationJob.Cancelled)
+    self.assertFalse(job.isCancelling())
+    self.assertEqual(finishedJobs, [job])
+
+if __name__ == '__main__':
+  unittest.main()
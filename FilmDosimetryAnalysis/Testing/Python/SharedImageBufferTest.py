@@ -0,0 +1,64 @@
+import unittest
+import numpy
+from __main__ import vtk
+from vtk.util import numpy_support
+from FilmDosimetryAnalysisLogic.SharedImageBuffer import SharedImageBufferRegistry
+
+#
+# SharedImageBufferTest
+#
+class SharedImageBufferTest(unittest.TestCase):
+  """ Tests of the numpy arrays shared with VTK image data without copying
+  """
+
+  def setUp(self):
+    self.registry = SharedImageBufferRegistry()
+    self.extent = [0, 9, 0, 7, 0, 0]
+    self.array = numpy.arange(80, dtype=numpy.float32)
+
+  #------------------------------------------------------------------------------
+  def test_MemoryIsShared(self):
+    imageData = self.registry.createImageData(self.array, self.extent)
+    self.assertEqual(list(imageData.GetExtent()), self.extent)
+    self.assertEqual(self.registry.getMemorySize(), self.array.nbytes)
+    # Changes are visible on both sides
+    self.array[5] = -1.0
+    self.assertEqual(imageData.GetPointData().GetScalars().GetValue(5), -1.0)
+    numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())[6] = -2.0
+    self.assertEqual(self.array[6], -2.0)
+
+    # Non-contiguous arrays are copied
+    strided = numpy.arange(160, dtype=numpy.float32)[::2]
+    imageData = self.registry.createImageData(strided, self.extent)
+    strided[0] = -1.0
+    self.assertEqual(imageData.GetPointData().GetScalars().GetValue(0), 0.0)
+
+  #------------------------------------------------------------------------------
+  def test_BufferIsReleased(self):
+    imageData = self.registry.createImageData(self.array, self.extent)
+    # Replacing the scalars releases the previous buffer
+    otherArray = numpy.zeros(20, dtype=numpy.float64)
+    self.registry.setImageDataScalars(imageData, otherArray, [0, 4, 0, 3, 0, 0])
+    self.assertEqual(self.registry.getMemorySize(), otherArray.nbytes)
+    self.assertEqual(list(imageData.GetDimensions()), [5, 4, 1])
+
+    # Deleting the image data releases its buffer
+    del imageData
+    self.assertEqual(self.registry.getMemorySize(), 0)
+    self.assertEqual(len(self.registry.buffers), 0)
+
+    imageData = self.registry.createImageData(self.array, self.extent)
+    self.registry.releaseBuffer(imageData)
+    self.assertEqual(self.registry.getMemorySize(), 0)
+
+  #------------------------------------------------------------------------------
+  def test_SizeMismatch(self):
+    imageData = self.registry.createImageData(self.array, self.extent)
+    with self.assertRaises(ValueError):
+      self.registry.setImageDataScalars(imageData, numpy.zeros(10), self.extent)
+    # Image data keeps its scalars
+    self.assertEqual(self.registry.getMemorySize(), self.array.nbytes)
+    self.assertEqual(imageData.GetPointData().GetScalars().GetNumberOfTuples(), self.array.size)
+
+if __name__ == '__main__':
+  unittest.main()